@@ -191,6 +191,7 @@ class Drone {
             this._tcpSock = sock;
             myConsole.log(`Establish connection with Pi-${this.getCID()} from ${sock.remoteAddress}:${sock.remotePort}(TCP)`);
             this.getEventNotifier().emit('new-drone-add');
+            var pending = '';   // Part of a message not ended yet
             sock.on('data', (msg_buf) => {
                 if (this._taskDone) {
                     this._server.close(() => {
@@ -204,36 +205,43 @@ class Drone {
                 if (!addr === this._host) {
                     return;
                 }
-                // Whether the message is a json string or not
-                try {
-                    msg_obj = JSON.parse(msg_buf.toString('utf8'));
-                } catch (err) {
-                    if (err instanceof SyntaxError) {
-                        return;
+                // Messages from the Pi end with '$$', a segment may carry several of them or a part of one
+                var msg_strs = (pending + msg_buf.toString('utf8')).split('$$');
+                pending = msg_strs.pop();
+                msg_strs.forEach((msg_str) => {
+                    // Whether the message is a json string or not
+                    try {
+                        msg_obj = JSON.parse(msg_str);
+                    } catch (err) {
+                        if (err instanceof SyntaxError) {
+                            return;
+                        }
+                        console.error(err)
                     }
-                    console.error(err)
-                }
-                // Whether the message is a MAVC message from Pi
-                try {
-                    if (msg_obj[0]['Header'] === 'MAVCluster_Drone') {
-                        var Type = msg_obj[0]['Type'];
-                        if (Type === MAVC.MAVC_ARRIVED) {
-                            myConsole.log(`Drone - CID: ${msg_obj[1]['CID']} arrive at step:${msg_obj[1]['Step']}!`)
-                            if (msg_obj[1]['CID'] === this.getCID()) {
-                                // Notify that the drone has arrived
-                                this._drone.emit('arrive', this._drone);
-                            } else {
-                                // to-do: handler for wrone receiver
+                    // Whether the message is a MAVC message from Pi
+                    try {
+                        if (msg_obj[0]['Header'] === 'MAVCluster_Drone') {
+                            var Type = msg_obj[0]['Type'];
+                            if (Type === MAVC.MAVC_ARRIVED) {
+                                myConsole.log(`Drone - CID: ${msg_obj[1]['CID']} arrive at step:${msg_obj[1]['Step']}!`)
+                                if (msg_obj[1]['CID'] === this.getCID()) {
+                                    // Notify that the drone has arrived
+                                    this._drone.emit('arrive', this._drone);
+                                } else {
+                                    // to-do: handler for wrone receiver
+                                }
+                            } else if (Type === MAVC.MAVC_FAILED) {
+                                myConsole.log(`Drone - CID: ${msg_obj[1]['CID']} failed step:${msg_obj[1]['Step']}, ${msg_obj[1]['Result']}!`)
                             }
+                            this._drone.emit('message-in', this.getCID(), msg_obj);
                         }
-                        this._drone.emit('message-in', this.getCID(), msg_obj);
-                    }
-                } catch (err) {
-                    if (err instanceof TypeError) {
-                        return;
+                    } catch (err) {
+                        if (err instanceof TypeError) {
+                            return;
+                        }
+                        console.error(err)
                     }
-                    console.error(err)
-                }
+                });
             });
         })
         this._server.listen(port, host);
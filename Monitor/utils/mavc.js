@@ -7,6 +7,7 @@ module.exports.MAVC = {
     "MAVC_ACTION": 4,             // Action to be performed
     "MAVC_ARRIVED": 5,            // Tell the monitor that the drone has arrived at the target
     "MAVC_DONE": 6,               // Close the connection between RPi and monitor 
+    "MAVC_FAILED": 10,            // Tell the monitor that the drone has failed the actions of a step
     "MAVC_DELAY_TEST": 101,       // To test the communication delay
     "MAVC_DELAY_RESPONSE": 102,   // Response to MAVC_DELAY_TEST
     // Definitions of action type
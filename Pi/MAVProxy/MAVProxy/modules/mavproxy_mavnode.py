@@ -1,13 +1,26 @@
-import socket
+import os
 import sys
-import json
 import math
-import time
+from functools import partial
+from threading import Condition
 
 from MAVProxy.modules.lib import mp_module
-from threading import Thread, Timer
+from MAVProxy.modules.lib import mp_settings
 from pymavlink import mavutil
 
+# Modules shared with the DroneKit script live in CoUAS/Pi, MAVProxy is started from CoUAS/Pi/MAVProxy/MAVProxy
+sys.path.append(os.environ.get('COUAS_PI', os.path.abspath(os.path.join(os.getcwd(), '..', '..'))))
+from Modules.agent_loop import MAVCLink, get_loop
+from Modules.barrier import BARRIER_CANCELLED, PeerBarrier
+from Modules.clock import monotonic
+from Modules.executor import ActionExecutor
+from Modules.geofence import GeofenceMonitor, parse_geofence
+from Modules.params import REQUIRED_PARAMETERS, ParamCache, ParamSync
+from Modules.mission import MAV_CMD_NAV_WAYPOINT, MAV_FRAME_GLOBAL_RELATIVE_ALT, compile_waypoints, plan_actions
+from Modules.subtask import SubtaskStage, is_held, unpack_actions
+from Modules.path_follow import MAV_FRAME_LOCAL_NED, VELOCITY_TYPE_MASK, LocalFrame, PathFollower, PathSettings
+from Modules.telemetry import TelemetrySender, AdaptiveReport, get_scheduler
+
 
 class MAVNode(mp_module.MPModule):
     # Constant value definition of communication type
@@ -17,6 +30,9 @@ class MAVNode(mp_module.MPModule):
     MAVC_SET_GEOFENCE = 3  # Set geofence of the drone
     MAVC_ACTION = 4  # Action to be performed
     MAVC_ARRIVED = 5  # Tell the monitor that the drone has arrived at the target
+    MAVC_CID_ACTION = 7  # Actions of this drone only
+    MAVC_RELEASE = 8  # Start the subtask held for a step
+    MAVC_FAILED = 10  # Tell the monitor that the drone has failed the actions of a step
     MAVC_DELAY_TEST = 101  # To test the communication delay
     MAVC_DELAY_RESPONSE = 102 # Response to MAVC_DELAY_TEST
 
@@ -26,6 +42,11 @@ class MAVNode(mp_module.MPModule):
     ACTION_GO_BY = 2  # Ask drone to fly to next target specified by distance in both North and East directions
     ACTION_LAND = 3  # Ask drone to land at current or a specific location
 
+    # Result of a movement which fails the subtask, as the DroneKit script reports it
+    MODE_CHANGED = 'mode_changed'  # No longer in the mode of the movement, e.g. switched to RTL by the pilot
+    STALLED = 'stalled'  # Hardly moved after the command has been resent, or too slow along the path
+    MAX_RESENDS = 5  # Times the command of a movement is resent before giving up
+
     def __init__(self, mpstate):
         super(MAVNode, self).__init__(mpstate, "MAVNode", "Node of MAVCluster")
 
@@ -33,12 +54,44 @@ class MAVNode(mp_module.MPModule):
         self.__host = None
         self.__port = 4396
         self.__done = False
-        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__loop = get_loop()
+        self.__link = None
+        self.__executor = ActionExecutor(self.__loop.pool)  # Perform actions one after another in order
+        self.__stage = SubtaskStage()   # Subtasks received ahead of time, waiting for MAVC_RELEASE
+        self.__origin = None    # Where the previous action in the queue should have left the drone
+        self.__state = NodeState()  # Latest state of the drone fed by mavlink_packet()
+        self.__mission = None       # Waypoints being uploaded, item 0 is replaced by the home location
+        self.__geofence = GeofenceMonitor(self.__on_breach)    # Check every position against the geofence
+        self.__params = None        # ParamSync of the required parameters, fed by PARAM_VALUE
+        self.__barrier = None       # PeerBarrier to synchronize steps among drones, or None to wait for the monitor
+        self.__telemetry = TelemetrySender()
+        self.__report_stream = None
+        self.__report_policy = None
+        self.node_settings = mp_settings.MPSettings([
+            ('report_rate', float, 2.0),        # Number of MAVC_STAT messages per second without adaptive
+            ('adaptive', int, 0),               # Report only on changes, at min_rate at least
+            ('min_rate', float, 0.5),           # Number of MAVC_STAT messages per second while nothing changes
+            ('max_rate', float, 10.0),          # Max number of MAVC_STAT messages per second of adaptive reporting
+            ('pos_deadband', float, 0.5),       # Horizontal movement in meters to be reported
+            ('alt_deadband', float, 0.3),       # Change of altitude in meters to be reported
+            ('arrival_radius', float, 1.0),     # Distance in meters to the target at which the drone has arrived
+            ('batch_missions', int, 0),         # Fly runs of movements in a subtask as one mission in AUTO mode
+            ('follow_paths', int, 0),           # Fly runs of movements in a subtask continuously in GUIDED mode
+            ('path_speed', float, 4.0),         # Speed in m/s along the path
+            ('lookahead', float, 3.0),          # Distance in meters ahead along the path the drone heads for
+            ('peers', int, 0),                  # Synchronize steps among this number of drones, 0 to use the monitor
+            ('peer_address', str, '255.255.255.255'),   # Broadcast or multicast address of drones
+            ('peer_port', int, 4397),           # UDP port of drones synchronizing steps among themselves
+            ('peer_timeout', float, 30.0),      # Seconds to wait for the other drones at a step before going on
+            ('fence_lookahead', float, 0.0),    # Seconds ahead at the current velocity checked against the geofence
+            ('param_cache', str, os.path.join(os.path.expanduser('~'), '.mavcluster_params.json'))  # Empty not to cache
+        ])
         self.__wp_str = None
         self.__msg_handler = {
             MAVNode.MAVC_SET_GEOFENCE: self.msg_set_geofence,
             MAVNode.MAVC_ACTION: self.msg_action,
-            MAVNode.MAVC_DELAY_TEST: self.msg_delay_test
+            MAVNode.MAVC_CID_ACTION: self.msg_action,
+            MAVNode.MAVC_RELEASE: self.msg_release
         }
         self.__action_handler = {
             MAVNode.ACTION_ARM_AND_TAKEOFF: self.action_arm_and_takeoff,
@@ -49,6 +102,27 @@ class MAVNode(mp_module.MPModule):
 
         self.add_command('node-connect', self.cmd_connect, "Connect to monitor via IP address")
         self.add_command('last-update', self.cmd_last_update, "To tell the time of last update")
+        self.add_command('node-stats', self.cmd_stats, "Statistics of messages sent to monitor")
+        self.add_command('node-set', self.cmd_set, "Settings of MAVNode, applied at node-connect")
+
+    def mavlink_packet(self, m):
+        """Keep the state of the drone up to date, waking up the actions waiting for it."""
+        mtype = m.get_type()
+        if mtype == 'GLOBAL_POSITION_INT':
+            self.__state.update_position(m)
+            self.__geofence.update(m.lat * 1.0e-7, m.lon * 1.0e-7, m.vx * 0.01, m.vy * 0.01)
+        elif mtype == 'HEARTBEAT':
+            self.__state.update_status(self.master.flightmode, self.master.motors_armed())
+        elif mtype in ('MISSION_REQUEST', 'MISSION_REQUEST_INT'):
+            self.__send_mission_item(m.seq)
+        elif mtype == 'MISSION_ACK':
+            if self.__mission is not None:
+                self.__mission = None
+                self.__state.update_mission(ack=m.type)
+        elif mtype == 'MISSION_ITEM_REACHED':
+            self.__state.update_mission(reached=m.seq)
+        elif mtype == 'PARAM_VALUE' and self.__params is not None:
+            self.__params.on_param_value(m.param_id.rstrip('\x00'), m.param_value)
 
     def cmd_connect(self, args):
         """node-connect command"""
@@ -63,160 +137,282 @@ class MAVNode(mp_module.MPModule):
             return
 
         self.__host = args[0]
-
-        # Request for CID
-        home = self.master.messages['GLOBAL_POSITION_INT']
-        s = self.send_msg_to_monitor([
-            {
-                'Header': 'MAVCluster_Drone',
-                'Type': MAVNode.MAVC_REQ_CID
-            },
-            {
-                'Lat': home.lat * 1.0e-7,
-                'Lon': home.lon * 1.0e-7
-            }
-        ])
-
-        # Listen to the monitor to get CID
-        while True:
-            data_json, addr = s.recvfrom(1024)
-            print(data_json)
-            if not addr[0] == self.__host:  # This message is not sent from the Monitor
-                continue
-
-            data_dict = json.loads(data_json)
-            try:
-                if data_dict[0]['Header'] == 'MAVCluster_Monitor' and data_dict[0]['Type'] == MAVNode.MAVC_CID:
-                    self.__CID = data_dict[1]['CID']
-                    self.__port = self.__port + self.__CID
-                    s.close()
-                    # Build TCP connection to monitor
-                    self.__sock.connect((self.__host, self.__port))
-                    break
-            except KeyError:  # This message is not a MAVC message
-                continue
-
-        # Battery failsafe
-        self.module('param').cmd_param(['set', 'FS_BATT_ENABLE', '2'])
-        # Restart mission when switch to AUTO again
-        self.module('param').cmd_param(['set', 'MIS_RESTART', '1'])
-
-        # Start listening and reporting
+        if self.node_settings.peers > 0 and self.__barrier is None:
+            self.__barrier = PeerBarrier(self.node_settings.peers, port=self.node_settings.peer_port,
+                                         address=self.node_settings.peer_address,
+                                         timeout=self.node_settings.peer_timeout)
+
+        # Request for CID and connect to the monitor on the event loop
+        if self.__state.lat is None:
+            self.__state.update_position(self.master.messages['GLOBAL_POSITION_INT'])
+        self.__link = MAVCLink(self.__loop, self.__telemetry, self.__host, self.__port,
+                               (self.__state.lat, self.__state.lon), self.__on_message,
+                               on_connected=self.__on_connected)
+        self.__link.start()
+
+    def __on_connected(self):
+        """Prepare the drone before handling any message from monitor."""
+        self.__CID = self.__link.cid
+        if self.__barrier is not None:
+            self.__barrier.register(self.__CID)
+        self.__executor.submit('prepare', self.__prepare)
+
+    def __prepare(self, cancel=None):
+        """Set parameters and start reporting once the connection has been established.
+
+        It is the first job of the executor, so no action is performed before it is done.
+        """
+        # Battery failsafe and restarting mission, confirmed by the vehicle
+        cache = ParamCache(self.node_settings.param_cache) if self.node_settings.param_cache else None
+        self.__params = ParamSync(self.master.param_set_send, self.master.param_fetch_one, cache,
+                                  'sysid%d' % self.master.target_system)
+        failed = self.__params.apply(REQUIRED_PARAMETERS, cancel)
+        sys.stdout.write('>>>>Parameters ready in %.2fs\n' % self.__params.get_stats()['ready_time'])
+        if failed:
+            sys.stdout.write('!!!!!!Parameters not confirmed: %s!!!!!!\n' % ', '.join(sorted(failed)))
+
+        # Start reporting
         self.mode('GUIDED')
-        Thread(target=self.__listen_to_monitor, name='Hear-From-Monitor').start()
-        Thread(target=self.__report_to_monitor, name='Report-To-Monitor').start()
+        rate = self.node_settings.report_rate
+        if self.node_settings.adaptive:
+            self.__report_policy = AdaptiveReport(max_rate=self.node_settings.max_rate,
+                                                  min_rate=self.node_settings.min_rate,
+                                                  pos_deadband=self.node_settings.pos_deadband,
+                                                  alt_deadband=self.node_settings.alt_deadband)
+            rate = self.__report_policy.max_rate
+        self.__report_stream = get_scheduler().add_stream('MAVNode-%d' % self.__CID, self.__report_to_monitor, rate)
 
     def cmd_last_update(self, args):
         print('2018/4/17 16:23am')
 
+    def cmd_stats(self, args):
+        """node-stats command"""
+        if self.__link is not None:
+            print('Link: %s' % self.__link.stats)
+            print('Clock: %s' % self.__link.clock.get_stats())
+        print('UDP: %s' % self.__telemetry.get_stats())
+        actions = self.__executor.get_stats()
+        records = actions.pop('records')
+        print('Actions: %s' % actions)
+        for record in records[-5:]:
+            print('  %s' % record)
+        print('Subtasks: %s' % self.__stage.get_stats())
+        if self.__barrier is not None:
+            print('Barrier: %s' % self.__barrier.get_stats())
+        print('Geofence: %s' % self.__geofence.get_stats())
+        if self.__params is not None:
+            print('Params: %s' % self.__params.get_stats())
+        if self.__report_stream is not None:
+            print('Report: %s' % self.__report_stream.get_stats())
+        if self.__report_policy is not None:
+            print('Adaptive: %s' % self.__report_policy.get_stats())
+
+    def cmd_set(self, args):
+        """node-set command"""
+        self.node_settings.command(args)
+
         
     def msg_set_geofence(self, args):
-        """Handle the msg of set_geofence"""
-        pass
+        """Handle the msg of set_geofence, the geofence is checked on every GLOBAL_POSITION_INT"""
+        self.__geofence.set_geofence(parse_geofence(args[0][1], self.node_settings.fence_lookahead))
+
+    def __on_breach(self, breach):
+        """Return to launch once the drone is out of the geofence, or about to be"""
+        sys.stdout.write('!!!!!!Geofence breached %s, return to launch!!!!!!\n' % breach.get_record())
+        self.__loop.run_in_executor(self.abort)
 
     def msg_action(self, args):
-        """Handle the msg of action"""
-        data_dict = args[0]
-
-        pos = self.master.messages['GLOBAL_POSITION_INT']
-        pos = {
-            'lat': pos.lat * 1.0e-7,
-            'lon': pos.lon * 1.0e-7,
-            'alt': pos.relative_alt * 1.0e-3
-        }
+        """Handle the msg of action by putting the actions into the queue of executor, or holding them until released
+
+        Args:
+            args: Tuple of the message and its type, MAVC_ACTION by default.
+        """
+        mavc_type = args[1] if len(args) > 1 else MAVNode.MAVC_ACTION
+
         sys.stdout.write('>>>>Prepare to parse acionts\n')
-        for n in range(1, len(data_dict)):
-            # Pick actions about this drone out
-            if data_dict[n]['CID'] == self.__CID:
-                action = data_dict[n]
-                # Perform the action
-                action_type = action['Action_type']
-                action['O'] = pos
-                pos = self.__action_handler[action_type](action)
-
-        # Send report back if needed
-        if data_dict[-1]['Sync']:
-            self.__sock.send(json.dumps([
+        # Pick actions about this drone out, unless only those have been sent
+        actions, step, sync = unpack_actions(mavc_type, args[0], self.__CID)
+        if self.node_settings.batch_missions or self.node_settings.follow_paths:
+            plan = plan_actions(actions)
+        else:
+            plan = [(False, [action]) for action in actions]
+        if is_held(mavc_type, args[0]) and self.__stage.hold(step, (plan, step, sync)):
+            return
+        self.__start_subtask(plan, step, sync)
+
+    def msg_release(self, args):
+        """Handle the msg of release by starting the subtask held for the step, or once it is received"""
+        subtask = self.__stage.release(args[0][1]['Step'])
+        if subtask is not None:
+            self.__start_subtask(*subtask)
+
+    def __start_subtask(self, plan, step, sync):
+        """Put the actions of a subtask planned by plan_actions() into the queue of executor.
+
+        A movement which ends stalled or out of its mode fails the subtask: the rest of its actions are skipped and
+        MAVC_FAILED is sent instead of MAVC_ARRIVED.
+        """
+        release = monotonic()   # Time of each action is relative to the instant the subtask is started
+        failure = {}            # Result of the movement the subtask has failed at, shared by its actions
+        self.__stage.mark_busy()
+        first = True
+        for is_run, group in plan:
+            # A run is started at the time of its first movement, the origin is staged ahead of it
+            at = release + group[0]['Time'] if group[0].get('Time') else None
+            prepare = self.__stage_first if first else self.__stage_next
+            if is_run:
+                self.__submit_action('action_mission' if self.node_settings.batch_missions else 'action_follow_path',
+                                     step, partial(self.__perform, failure, step, self.__perform_run), group, at=at,
+                                     prepare=prepare)
+            else:
+                self.__submit_action(self.__action_handler[group[0]['Action_type']].__name__, step,
+                                     partial(self.__perform, failure, step, self.__perform_action), group[0],
+                                     at=at, prepare=prepare)
+            first = False
+
+        # Send report back if needed, it is dropped with the actions once they are preempted
+        if sync:
+            self.__submit_action('arrived', step, self.__report_arrived, failure, step)
+
+    def __submit_action(self, name, step, fn, *args, **kwargs):
+        """Put an action into the queue of executor, warn if it is discarded as the queue is full."""
+        if not self.__executor.submit(name, fn, *args, step=step, **kwargs):
+            sys.stdout.write('!!!!!!Action queue is full, %s of step %d discarded!!!!!!\n' % (name, step))
+
+    def __stage_first(self, payload):
+        """The first action of a step begins where the drone is once the previous step is done."""
+        self.__origin = self.__state.position()
+        return payload,
+
+    def __stage_next(self, payload):
+        """The following actions begin where the previous one of the same step has left the drone."""
+        if self.__origin is None:
+            self.__origin = self.__state.position()
+        return payload,
+
+    def __perform(self, failure, step, fn, payload, cancel=None):
+        """Perform an action of the subtask unless it has failed, and fail it if the drone could not get there."""
+        if failure:
+            return None
+        try:
+            fn(payload, cancel)
+        except MovementFailed as e:
+            self.__origin = None
+            failure['Result'] = e.result
+            sys.stdout.write('!!!!!!Step %d failed, %s!!!!!!\n' % (step, e.result))
+            self.write_data_to_monitor([
                 {
                     'Header': 'MAVCluster_Drone',
-                    'Type': MAVNode.MAVC_ARRIVED
+                    'Type': MAVNode.MAVC_FAILED
                 },
                 {
                     'CID': self.__CID,
-                    'Step': data_dict[-1]['Step']
+                    'Step': step,
+                    'Result': e.result,
+                    'Time': self.__link.clock.to_monitor_time(monotonic())
                 }
-            ]))
+            ])
+            return {'Result': e.result}
+        return None
+
+    def __perform_action(self, action, cancel=None):
+        """Perform the action from the origin staged."""
+        action['O'] = self.__origin
+        self.__origin = self.__action_handler[action['Action_type']](action, cancel)
+
+    def __perform_run(self, actions, cancel=None):
+        """Fly the run of movements from the origin staged."""
+        if self.node_settings.batch_missions:
+            self.__origin = self.action_mission(actions, self.__origin, cancel)
+        else:
+            self.__origin = self.action_follow_path(actions, self.__origin, cancel)
+
+    def __report_arrived(self, failure, step, cancel=None):
+        """Tell the monitor that actions of the step have been done, then wait for the other drones if any.
 
-    def msg_delay_test(self, args):
-        data_dict = args[0]
-        self.__sock.send(json.dumps([
+        Nothing is reported if the subtask has failed, neither the monitor nor the other drones should go on as if
+        the drone had arrived.
+        """
+        if failure:
+            return {'Skipped': failure['Result']}
+        if not self.__executor.pending():
+            # Waiting at the barrier from now on, marked before the monitor can release the next subtask
+            self.__stage.mark_idle()
+        self.write_data_to_monitor([
             {
                 'Header': 'MAVCluster_Drone',
-                'Type': MAVNode.MAVC_DELAY_RESPONSE
+                'Type': MAVNode.MAVC_ARRIVED
             },
             {
                 'CID': self.__CID,
-                'Send_time': data_dict[1]['Send_time'],
-                'Get_time': int(round(time.time() * 1000))
+                'Step': step,
+                'Time': self.__link.clock.to_monitor_time(monotonic())
             }
-        ]))
-
-    def action_arm_and_takeoff(self, args):
+        ])
+        if self.__barrier is None:
+            return None
+        result = self.__barrier.wait(step, self.__CID, cancel)
+        if result != BARRIER_CANCELLED:
+            subtask = self.__stage.release_after(step)
+            if subtask is not None:
+                self.__start_subtask(*subtask)
+        return {'Barrier': result}
+
+    def abort(self):
+        """Discard the actions in the queue and those held, stop the current one and return to launch."""
+        self.__stage.clear()
+        self.__executor.preempt('return_to_launch', self.__return_to_launch)
+
+    def __return_to_launch(self, cancel=None):
+        self.__origin = None
+        self.mode('RTL')
+
+    def action_arm_and_takeoff(self, args, cancel=None):
         """Arm and takeoff"""
         alt = args['Alt']
+        state = self.__state
 
         sys.stdout.write('>>>>Prepare to arm and take off\n')
         # Change mode to GUIDED
-        if self.master.flightmode != 'GUIDED':
-            self.mode('GUIDED')
-            while not self.master.flightmode == 'GUIDED':
-                sys.stdout.write('>>>>Changing to GUIDED mode\n')
+        if not self.wait_for_mode('GUIDED', cancel):
+            return None
 
-        # Arm throttle
-        counter = 0
+        # Arm throttle, ask again if it is not armed in a few seconds
         self.master.arducopter_arm()
-        while not self.master.motors_armed():
+        while not state.wait_for(lambda st: st.armed, 3.5, cancel):
+            if cancel is not None and cancel.is_set():
+                return None
             sys.stdout.write('>>>>Waiting for arming......\n')
-            counter += 1
-            if counter > 5:
-                self.master.arducopter_arm()
-                counter = 0
-            time.sleep(0.7)
-
-        # Takeoff
-        counter = 0
-        self.master.mav.command_long_send(
-            self.settings.target_system,  # target_system
-            mavutil.mavlink.MAV_COMP_ID_SYSTEM_CONTROL,  # target_component
-            mavutil.mavlink.MAV_CMD_NAV_TAKEOFF,  # command
-            0,  # confirmation
-            0,  # param1
-            0,  # param2
-            0,  # param3
-            0,  # param4
-            0,  # param5
-            0,  # param6
-            float(alt))  # param7
+            self.master.arducopter_arm()
+
+        # Takeoff, again if it is still on the ground after a few seconds
+        takeoff = True
         while True:
-            current_alt = self.master.messages['GLOBAL_POSITION_INT'].relative_alt * 1.0e-3
-            print("Altitude: %f" % current_alt)
-            if current_alt < 1:
-                counter += 1
-            if counter == 5:
-                sys.stdout.write('>>>>Re-takeoff!!!!\n')
-                return self.action_arm_and_takeoff(args)
-            if current_alt >= alt * 0.7:
+            if takeoff:
+                self.master.mav.command_long_send(
+                    self.settings.target_system,  # target_system
+                    mavutil.mavlink.MAV_COMP_ID_SYSTEM_CONTROL,  # target_component
+                    mavutil.mavlink.MAV_CMD_NAV_TAKEOFF,  # command
+                    0,  # confirmation
+                    0,  # param1
+                    0,  # param2
+                    0,  # param3
+                    0,  # param4
+                    0,  # param5
+                    0,  # param6
+                    float(alt))  # param7
+            if state.wait_for(lambda st: st.relative_alt >= alt * 0.7, 3.5, cancel):
                 break
-            time.sleep(0.7)
+            if cancel is not None and cancel.is_set():
+                return None
+            print("Altitude: %f" % state.relative_alt)
+            takeoff = state.relative_alt < 1
+            if takeoff:
+                sys.stdout.write('>>>>Re-takeoff!!!!\n')
 
-        pos = self.master.messages['GLOBAL_POSITION_INT']
-        return {
-            'lat': pos.lat * 1.0e-7,
-            'lon': pos.lon * 1.0e-7,
-            'alt': pos.alt * 1.0e-3
-        }
+        return state.position()
 
-    def action_go_by(self, args):
+    def action_go_by(self, args, cancel=None):
         """Add go_by waypoint to file of mission"""
         d_north = args['N']
         d_east = args['E']
@@ -224,7 +420,7 @@ class MAVNode(mp_module.MPModule):
         current_location = args['O']
         target_location = get_location_metres(current_location, d_north, d_east)
 
-        self.fly_to(target_location)
+        self.fly_to(target_location, cancel)
 
         return {
             'lat': target_location['lat'],
@@ -232,13 +428,13 @@ class MAVNode(mp_module.MPModule):
             'alt': alt
         }
 
-    def action_go_to(self, args):
+    def action_go_to(self, args, cancel=None):
         """Add go_to waypoint to file of mission"""
         lat = args['Lat']
         lon = args['Lon']
         alt = args['Alt']
 
-        self.fly_to({'lat': lat, 'lon': lon, 'alt': alt})
+        self.fly_to({'lat': lat, 'lon': lon, 'alt': alt}, cancel)
 
         return {
             'lat': lat,
@@ -246,7 +442,7 @@ class MAVNode(mp_module.MPModule):
             'alt': alt
         }
 
-    def action_land(self, args):
+    def action_land(self, args, cancel=None):
         """Add land waypoint to file of mission"""
         lat = args['Lat']
         lon = args['Lon']
@@ -256,8 +452,8 @@ class MAVNode(mp_module.MPModule):
         land_locally = lat == 0 and lon == 0
         (lat, lon) = (pos['lat'], pos['lon']) if land_locally else (lat, lon)
         
-        if not land_locally:
-            self.fly_to({'lat': lat, 'lon': lon, 'alt': pos['alt']})
+        if not land_locally and not self.fly_to({'lat': lat, 'lon': lon, 'alt': pos['alt']}, cancel):
+            return None
         self.mode('LAND')
 
         return {
@@ -266,6 +462,114 @@ class MAVNode(mp_module.MPModule):
             'alt': 0
         }
 
+    def action_mission(self, actions, origin, cancel=None):
+        """Fly through the targets of a run of go_by and go_to actions as one mission in AUTO mode
+
+        The drone is switched back to GUIDED mode once MISSION_ITEM_REACHED of the last waypoint is received. If the
+        mission is not accepted, the targets are flown one by one in GUIDED mode instead.
+        """
+        state = self.__state
+        waypoints = compile_waypoints(actions, origin)
+
+        if not self.upload_mission(waypoints, cancel):
+            if cancel is not None and cancel.is_set():
+                return None
+            sys.stdout.write('>>>>Mission not accepted, fly to waypoints one by one\n')
+            for waypoint in waypoints:
+                if not self.fly_to(waypoint, cancel):
+                    return None
+            return waypoints[-1]
+
+        if not self.wait_for_mode('AUTO', cancel):
+            return None
+        # Item 0 is the home location, so the last waypoint is the item len(waypoints). Stop action if we are no
+        # longer in auto mode.
+        if not state.wait_for(lambda st: st.mission_reached >= len(waypoints) or st.mode != 'AUTO', None, cancel):
+            return None
+        if state.mode != 'AUTO':
+            raise MovementFailed(MAVNode.MODE_CHANGED)
+        sys.stdout.write('>>>>Mission completed\n')
+        self.wait_for_mode('GUIDED', cancel)
+        return waypoints[-1]
+
+    def action_follow_path(self, actions, origin, cancel=None):
+        """Fly along the targets of a run of go_by and go_to actions continuously in GUIDED mode
+
+        Velocity setpoints are streamed towards a point ahead along the path, so the drone cuts corners instead of
+        stopping at every target. It is asked to hold the last target at the end.
+        """
+        if not self.wait_for_mode('GUIDED', cancel):
+            return None
+        state = self.__state
+        settings = PathSettings(speed=self.node_settings.path_speed, lookahead=self.node_settings.lookahead,
+                                radius=self.node_settings.arrival_radius)
+        waypoints = compile_waypoints(actions, origin)
+        start = state.position()
+        frame = LocalFrame(start['lat'], start['lon'])
+        follower = PathFollower([frame.to_local(start)] + [frame.to_local(waypoint) for waypoint in waypoints],
+                                settings)
+        period = 1.0 / settings.rate
+        deadline = monotonic()
+        # Give up if the drone is far slower than expected, e.g. blocked by wind
+        timeout = deadline + follower.length / settings.speed * 3 + 10
+
+        sys.stdout.write('>>>>Follow path of %d waypoints (%.1f m)\n' % (len(waypoints), follower.length))
+        while True:
+            velocity = follower.update(frame.to_local(state.position()))
+            if velocity is None:
+                break
+            self.master.mav.set_position_target_local_ned_send(0, self.settings.target_system,
+                                                               self.settings.target_component,
+                                                               MAV_FRAME_LOCAL_NED, VELOCITY_TYPE_MASK,
+                                                               0, 0, 0, velocity[0], velocity[1], velocity[2],
+                                                               0, 0, 0, 0, 0)
+            now = monotonic()
+            deadline = max(deadline + period, now)
+            # Stop action if we are no longer in guided mode
+            if state.wait_for(lambda st: st.mode != 'GUIDED', deadline - now, cancel):
+                raise MovementFailed(MAVNode.MODE_CHANGED)
+            if cancel is not None and cancel.is_set():
+                return None
+            if now > timeout:
+                sys.stdout.write('>>>>Path not finished in time\n')
+                raise MovementFailed(MAVNode.STALLED)
+
+        sys.stdout.write('>>>>End of path reached\n')
+        self.__send_guided_target(waypoints[-1])
+        return waypoints[-1]
+
+    def upload_mission(self, waypoints, cancel=None, timeout=5.0, retries=3):
+        """Upload the waypoints as the mission, items are sent by mavlink_packet() on request of the drone.
+
+        Returns:
+            Whether the mission has been accepted.
+        """
+        state = self.__state
+        for attempt in range(retries):
+            state.update_mission(ack=None, reached=-1)
+            self.__mission = [state.position()] + waypoints
+            self.master.mav.mission_count_send(self.settings.target_system, self.settings.target_component,
+                                               len(self.__mission))
+            if state.wait_for(lambda st: st.mission_ack is not None, timeout, cancel):
+                return state.mission_ack == mavutil.mavlink.MAV_MISSION_ACCEPTED
+            if cancel is not None and cancel.is_set():
+                break
+            sys.stdout.write('>>>>Uploading mission again\n')
+        self.__mission = None
+        return False
+
+    def __send_mission_item(self, seq):
+        """Send the item of the mission being uploaded."""
+        mission = self.__mission
+        if mission is None or seq >= len(mission):
+            # Asked by someone else, e.g. the wp module
+            return
+        waypoint = mission[seq]
+        self.master.mav.mission_item_send(self.settings.target_system, self.settings.target_component, seq,
+                                          MAV_FRAME_GLOBAL_RELATIVE_ALT, MAV_CMD_NAV_WAYPOINT,
+                                          0, 1, 0, 0, 0, 0,
+                                          waypoint['lat'], waypoint['lon'], waypoint['alt'])
+
     def mode(self, md):
         """set arbitrary mode"""
         mode_mapping = self.master.mode_mapping()
@@ -282,30 +586,65 @@ class MAVNode(mp_module.MPModule):
             modenum = mode_mapping[mode]
         self.master.set_mode(modenum)
 
-    def fly_to(self, target_pos):
-        if self.master.flightmode != 'GUIDED':
-            self.mode('GUIDED')
-            while not self.master.flightmode == 'GUIDED':
-                pass
-
-        current_pos = self.master.messages['GLOBAL_POSITION_INT']
-        current_pos = {
-            'lat': current_pos.lat * 1.0e-7,
-            'lon': current_pos.lon * 1.0e-7,
-            'alt': current_pos.relative_alt * 1.0e-3
-        }
-        target_distance = get_distance_metres(current_pos, target_pos)
-        sys.stdout.write('Target distance: {}\n'.format(target_distance))
-
-        init_pos = self.master.messages['GLOBAL_POSITION_INT']
-        init_pos = {
-                'lat': init_pos.lat * 1.0e-7,
-                'lon': init_pos.lon * 1.0e-7,
-                'alt': init_pos.relative_alt * 1.0e-3
-        }
-        wait_time = 0
-        resend_cmd = False
+    def wait_for_mode(self, mode, cancel=None, timeout=5.0):
+        """Change the flight mode and wait for the heartbeat telling it has changed.
+
+        Returns:
+            False if the action has been cancelled.
+        """
+        while self.__state.mode != mode:
+            self.mode(mode)
+            if self.__state.wait_for(lambda st: st.mode == mode, timeout, cancel):
+                break
+            if cancel is not None and cancel.is_set():
+                return False
+            sys.stdout.write('>>>>Changing to %s mode\n' % mode)
+        return True
+
+    def fly_to(self, target_pos, cancel=None):
+        """Fly to the target in GUIDED mode and wait for the arrival.
+
+        The command is resent if the drone has hardly moved a few seconds after it was sent.
+
+        Returns:
+            False if the action has been cancelled.
 
+        Raises:
+            MovementFailed: The drone is no longer in GUIDED mode, or it still stalls after MAX_RESENDS resends.
+        """
+        if not self.wait_for_mode('GUIDED', cancel):
+            return False
+        state = self.__state
+        radius = self.node_settings.arrival_radius
+
+        sys.stdout.write('Target distance: {}\n'.format(get_distance_metres(state.position(), target_pos)))
+
+        def arrived(st):
+            # Stop action if we are no longer in guided mode
+            return st.mode != 'GUIDED' or get_distance_metres(st.position(), target_pos) <= radius
+
+        for _ in range(MAVNode.MAX_RESENDS + 1):
+            init_pos = state.position()
+            self.__send_guided_target(target_pos)
+
+            # Wait for the arrival while the drone keeps moving, resend the command once it stalls
+            while not state.wait_for(arrived, 4.0, cancel):
+                if cancel is not None and cancel.is_set():
+                    return False
+                current_pos = state.position()
+                if get_distance_metres(init_pos, current_pos) < 2:
+                    break
+                init_pos = current_pos
+                sys.stdout.write('>>>>Remaining distance: {}\n'.format(get_distance_metres(current_pos, target_pos)))
+            else:
+                if state.mode != 'GUIDED':
+                    raise MovementFailed(MAVNode.MODE_CHANGED)
+                sys.stdout.write('>>>>Target reached\n')
+                return True
+        raise MovementFailed(MAVNode.STALLED)
+
+    def __send_guided_target(self, target_pos):
+        """Ask the drone to fly to the target in GUIDED mode."""
         self.master.mav.mission_item_send(self.settings.target_system,
                                           self.settings.target_component,
                                           0,
@@ -314,50 +653,32 @@ class MAVNode(mp_module.MPModule):
                                           2, 0, 0, 0, 0, 0,
                                           target_pos['lat'], target_pos['lon'], target_pos['alt'])
 
-        while True:
-            time.sleep(0.7)
-            wait_time += 0.7
-
-            current_pos = self.master.messages['GLOBAL_POSITION_INT']
-            current_pos = {
-                'lat': current_pos.lat * 1.0e-7,
-                'lon': current_pos.lon * 1.0e-7,
-                'alt': current_pos.relative_alt * 1.0e-3
-            }
-
-            moved_distance = get_distance_metres(init_pos, current_pos)
-            # if wait_time > 4 and moved_distance < vehicle.groundspeed * wait_time * 0.3:
-            if wait_time > 4 and moved_distance < 2:
-                resend_cmd = True
-                break
-
-            remaining_distance = get_distance_metres(current_pos, target_pos)
-            if remaining_distance <= 1.0:
-                sys.stdout.write('>>>>Target reached\n')
-                break
-            sys.stdout.write('>>>>Remaining distance: {}\n'.format(remaining_distance))
-
-        if resend_cmd:
-            self.fly_to(target_pos)
-
     def send_msg_to_monitor(self, msg):
         """Send message to monitor using UDP protocol.
 
         By Deafult we use port 4396 on Monitor to handle the request of CID and port 4396+cid to handle other
-        messages from the the Pi whose CID=cid.
+        messages from the the Pi whose CID=cid. Every message goes through the same socket, a newer message of the
+        same type replaces the one still waiting to be sent.
 
         Args:
             msg: MAVC message.
         """
 
-        msg = json.dumps(msg)
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.sendto(msg, (self.__host, self.__port))
-        return s
+        self.__link.send(msg)
+
+    def write_data_to_monitor(self, data):
+        """Send data to monitor using TCP protocol
+
+        Args:
+            data: MAVC message.
+        """
+        self.__link.write(data)
 
     def __report_to_monitor(self):
-        """Report the states of drone to the monitor on time while task hasn't done."""
-        location = self.master.messages['GLOBAL_POSITION_INT']
+        """Report the states of drone to the monitor, called by the scheduler while task hasn't done."""
+        current = self.__state
+        # Stamped with the time the state was decoded from MAVLink, so the monitor can tell how stale it is
+        captured = current.updated if current.updated is not None else monotonic()
         state = [
             {
                 'Header': 'MAVCluster_Drone',
@@ -365,54 +686,45 @@ class MAVNode(mp_module.MPModule):
             },
             {
                 'CID': self.__CID,
-                'Armed': self.master.motors_armed(),
-                'Mode': self.master.flightmode,
-                'Lat': location.lat * 1.0e-7,
-                'Lon': location.lon * 1.0e-7,
-                'Alt': location.relative_alt * 1.0e-3
+                'Armed': current.armed,
+                'Mode': current.mode,
+                'Lat': current.lat,
+                'Lon': current.lon,
+                'Alt': current.relative_alt,
+                'Time': self.__link.clock.to_monitor_time(captured)
             }
         ]
-        self.send_msg_to_monitor(state)
-        if not self.__done:
-            Timer(0.5, self.__report_to_monitor).start()
+        if self.__report_policy is None or self.__report_policy.should_report(state[1]):
+            self.send_msg_to_monitor(state)
 
-    def __listen_to_monitor(self):
-        """Deal with instructions sent by monitor.
+    def __on_message(self, mavc_type, data_dict):
+        """Handle the messages received from monitor.
 
-        Keep listening the message sent by monitor, once messages arrived this method will push the specified actions
-        sent from monitor into a queue and perfome them one by one in another thread.
+        Actions are only put into the queue of executor or held, which is done on the event loop to keep their order,
+        and so are releases of the subtasks held. Other messages are handled by the worker threads.
         """
-
-        buf = ''
-        # Listen to the monitor
-        try:
-            while not self.__done:
-                data_json = self.__sock.recv(1024)
-                print(data_json)
-
-                buf += data_json
-                # Not a complete message yet
-                if not buf.endswith('$$'):
-                    continue
-                # A complete message has been received
-                data_dict = json.loads(buf[:-2])
-                buf = ''
-                try:
-                    if data_dict[0]['Header'] == 'MAVCluster_Monitor':
-                        mavc_type = data_dict[0]['Type']
-                        self.__msg_handler[mavc_type]((data_dict,))
-                except KeyError:  # This message is not a MAVC message
-                    sys.stdout.write('!!!!!!KeyError!!!!!!')
-                    continue
-        except socket.error:
-            pass
-            # self.close_connection()
+        if mavc_type not in self.__msg_handler:
+            sys.stdout.write('!!!!!!Unknown MAVC message %s!!!!!!\n' % mavc_type)
+            return
+        if mavc_type in (MAVNode.MAVC_ACTION, MAVNode.MAVC_CID_ACTION):
+            self.msg_action((data_dict, mavc_type))
+        elif mavc_type == MAVNode.MAVC_RELEASE:
+            self.msg_release((data_dict,))
+        else:
+            self.__loop.run_in_executor(self.__msg_handler[mavc_type], (data_dict,))
 
     def close_connection(self):
         """Close the connection that maintained by the instance"""
         self.__done = True
-        if self.master.motors_armed():
-            self.mode("RTL")
+        if self.__report_stream is not None:
+            get_scheduler().remove_stream(self.__report_stream)
+        if self.__link is not None:
+            self.__link.close()
+        self.__telemetry.close()
+        if self.__barrier is not None:
+            self.__barrier.close()
+        if self.__state.armed:
+            self.abort()
 
     @staticmethod
     def is_ipv4_addr(str):
@@ -421,6 +733,110 @@ class MAVNode(mp_module.MPModule):
             return True
 
 
+class MovementFailed(Exception):
+    """The drone could not get to the target of a movement, which fails the subtask."""
+
+    def __init__(self, result):
+        super(MovementFailed, self).__init__(result)
+        self.result = result    # MODE_CHANGED or STALLED
+
+
+class NodeState(object):
+    """Latest state of the drone decoded from MAVLink packets.
+
+    Actions block on it until a condition of the state is met instead of polling the messages of master.
+    """
+
+    __slots__ = ('lat', 'lon', 'alt', 'relative_alt', 'mode', 'armed', 'mission_ack', 'mission_reached', 'updated',
+                 '_cond')
+
+    _CANCEL_PERIOD = 0.25   # Seconds between checks of cancellation while waiting
+
+    def __init__(self):
+        self.lat = None             # Degrees
+        self.lon = None             # Degrees
+        self.alt = None             # Altitude above mean sea level in meters
+        self.relative_alt = 0.0     # Altitude above home in meters
+        self.mode = None            # Name of flight mode
+        self.armed = False
+        self.mission_ack = None     # Result of the last mission uploaded, None if not acknowledged yet
+        self.mission_reached = -1   # Sequence number of the last mission item reached
+        self.updated = None         # Monotonic time of the last update
+        self._cond = Condition()
+
+    def update_position(self, m):
+        """Update from GLOBAL_POSITION_INT."""
+        with self._cond:
+            self.lat = m.lat * 1.0e-7
+            self.lon = m.lon * 1.0e-7
+            self.alt = m.alt * 1.0e-3
+            self.relative_alt = m.relative_alt * 1.0e-3
+            self.updated = monotonic()
+            self._cond.notify_all()
+
+    def update_status(self, mode, armed):
+        """Update from HEARTBEAT."""
+        with self._cond:
+            if mode == self.mode and armed == self.armed:
+                return
+            self.mode = mode
+            self.armed = armed
+            self.updated = monotonic()
+            self._cond.notify_all()
+
+    def update_mission(self, **kwargs):
+        """Update from MISSION_ACK or MISSION_ITEM_REACHED, or reset before uploading a mission.
+
+        Args:
+            ack: Result of MISSION_ACK.
+            reached: Sequence number of MISSION_ITEM_REACHED.
+        """
+        with self._cond:
+            if 'ack' in kwargs:
+                self.mission_ack = kwargs['ack']
+            if 'reached' in kwargs:
+                self.mission_reached = kwargs['reached']
+            self._cond.notify_all()
+
+    def position(self):
+        """Current position, the altitude is relative to home."""
+        return {
+            'lat': self.lat,
+            'lon': self.lon,
+            'alt': self.relative_alt
+        }
+
+    def wait_for(self, predicate, timeout=None, cancel=None):
+        """Block until the predicate of the state is true.
+
+        Args:
+            predicate: Function taking this object, called with the state locked.
+            timeout: Max seconds to wait, None to wait forever.
+            cancel: Event set to stop waiting.
+
+        Returns:
+            Whether the predicate is true.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._cond:
+            while not self.__test(predicate):
+                if cancel is not None and cancel.is_set():
+                    return False
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                if cancel is not None:
+                    remaining = self._CANCEL_PERIOD if remaining is None else min(remaining, self._CANCEL_PERIOD)
+                self._cond.wait(remaining)
+            return True
+
+    def __test(self, predicate):
+        if self.lat is None:
+            # Nothing received yet
+            return False
+        return predicate(self)
+
+
 def get_location_metres(original_location, d_north, d_east):
     """
     Returns a LocationGlobal object containing the latitude/longitude `d_north` and `d_east` metres from the
@@ -0,0 +1,557 @@
+#  -*- coding: utf-8 -*-
+
+"""
+Modules.agent_loop
+~~~~~~~~~~~~~~~~~~
+
+Event loop serving the network of every agent (Drone or MAVNode) in the process from one thread.
+
+The CID handshake, the TCP stream of commands, the MAVC_DELAY_TEST responder and the exchanges estimating the clock of
+the monitor run on the loop with timeouts, while commands which block on the vehicle are handed to a pool of worker
+threads.
+"""
+
+import errno
+import heapq
+import json
+import socket
+import select
+import sys
+import time
+import traceback
+from collections import deque
+from threading import Condition, Lock, Thread
+from Modules.clock import ClockSync, monotonic
+from Modules.codec import CODEC_JSON, SUPPORTED_CODECS, encode_msg, encode_stream_msg, decode_msg
+from Modules.framing import FrameDecoder
+
+# Constant value definition of communication type
+MAVC_REQ_CID = 0            # Request the Connection ID
+MAVC_CID = 1                # Response to the ask of Connection ID
+MAVC_DELAY_TEST = 101       # To test the communication delay
+MAVC_DELAY_RESPONSE = 102   # Response to MAVC_DELAY_TEST
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS, getattr(errno, 'WSAEWOULDBLOCK', -1))
+
+
+class TimerHandle(object):
+    """Callback scheduled by AgentLoop.call_later()."""
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Do not call the callback, must be called in the thread of the loop."""
+        self.cancelled = True
+
+
+class WorkerPool(object):
+    """Threads running blocking functions, idle threads are reused and exit after a while."""
+
+    def __init__(self, idle_timeout=30.0):
+        self.__tasks = deque()
+        self.__cond = Condition()
+        self.__idle = 0
+        self.__idle_timeout = idle_timeout
+        self.threads = 0
+
+    def submit(self, fn, *args):
+        """Run the function in a worker thread."""
+        with self.__cond:
+            self.__tasks.append((fn, args))
+            if self.__idle > 0:
+                self.__cond.notify()
+                return
+            self.threads += 1
+        worker = Thread(target=self.__work, name='Agent-Worker')
+        worker.daemon = True
+        worker.start()
+
+    def __work(self):
+        while True:
+            with self.__cond:
+                if not self.__tasks:
+                    self.__idle += 1
+                    self.__cond.wait(self.__idle_timeout)
+                    self.__idle -= 1
+                    if not self.__tasks:
+                        self.threads -= 1
+                        return
+                fn, args = self.__tasks.popleft()
+            try:
+                fn(*args)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
+
+class AgentLoop(object):
+    """Single-threaded event loop based on select().
+
+    Readers, writers and timers must be managed in the thread of the loop, i.e. from callbacks, other threads go
+    through call_soon_threadsafe().
+    """
+
+    def __init__(self):
+        self.__readers = {}     # Socket -> callback
+        self.__writers = {}     # Socket -> callback
+        self.__timers = []      # Heap of (deadline, sequence, TimerHandle)
+        self.__seq = 0
+        self.__posted = deque()     # Callbacks posted from other threads
+        self.__lock = Lock()
+        self.__thread = None
+        self.__running = False
+        self.pool = WorkerPool()
+
+        # Wake the loop up from select() when a callback is posted, a UDP socket sending to itself works everywhere
+        self.__wakeup = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__wakeup.bind(('127.0.0.1', 0))
+        self.__wakeup.setblocking(0)
+        self.__readers[self.__wakeup] = self.__drain_wakeup
+
+    def add_reader(self, sock, callback):
+        """Call the callback whenever the socket is readable."""
+        self.__readers[sock] = callback
+
+    def remove_reader(self, sock):
+        self.__readers.pop(sock, None)
+
+    def add_writer(self, sock, callback):
+        """Call the callback whenever the socket is writable."""
+        self.__writers[sock] = callback
+
+    def remove_writer(self, sock):
+        self.__writers.pop(sock, None)
+
+    def call_later(self, delay, callback, *args):
+        """Call the callback after delay seconds.
+
+        Returns:
+            TimerHandle which can be cancelled.
+        """
+        handle = TimerHandle(monotonic() + delay, callback, args)
+        self.__seq += 1
+        heapq.heappush(self.__timers, (handle.deadline, self.__seq, handle))
+        return handle
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Call the callback in the thread of the loop, can be called from any thread."""
+        with self.__lock:
+            self.__posted.append((callback, args))
+        try:
+            self.__wakeup.sendto(b'\0', self.__wakeup.getsockname())
+        except socket.error:
+            # The loop will notice the callback in the next round anyway
+            pass
+
+    def run_in_executor(self, fn, *args):
+        """Run a blocking function in the worker pool."""
+        self.pool.submit(fn, *args)
+
+    def start(self):
+        """Run the loop in a daemon thread."""
+        with self.__lock:
+            if self.__thread is not None:
+                return
+            self.__running = True
+            self.__thread = Thread(target=self.run_forever, name='Agent-Loop')
+            self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """Stop the loop, can be called from any thread."""
+        self.call_soon_threadsafe(self.__stop)
+
+    def run_forever(self):
+        """Run the loop in current thread till stop() is called."""
+        self.__running = True
+        while self.__running:
+            timeout = None
+            if self.__posted:
+                timeout = 0
+            elif self.__timers:
+                timeout = max(0, self.__timers[0][0] - monotonic())
+
+            readers = list(self.__readers)
+            writers = list(self.__writers)
+            try:
+                readable, writable, _ = select.select(readers, writers, [], timeout)
+            except (select.error, socket.error, ValueError):
+                # One of the sockets has been closed, drop it
+                self.__remove_closed()
+                continue
+
+            for sock in readable:
+                self.__dispatch(self.__readers.get(sock))
+            for sock in writable:
+                self.__dispatch(self.__writers.get(sock))
+
+            now = monotonic()
+            while self.__timers and self.__timers[0][0] <= now:
+                _, _, handle = heapq.heappop(self.__timers)
+                if not handle.cancelled:
+                    self.__dispatch(handle.callback, *handle.args)
+
+            with self.__lock:
+                posted, self.__posted = self.__posted, deque()
+            for callback, args in posted:
+                self.__dispatch(callback, *args)
+
+    def __dispatch(self, callback, *args):
+        if callback is None:
+            return
+        try:
+            callback(*args)
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+
+    def __drain_wakeup(self):
+        try:
+            while True:
+                self.__wakeup.recv(64)
+        except socket.error:
+            pass
+
+    def __remove_closed(self):
+        for sockets in (self.__readers, self.__writers):
+            for sock in list(sockets):
+                try:
+                    if sock.fileno() < 0:
+                        raise socket.error
+                    select.select([sock], [], [], 0)
+                except (select.error, socket.error, ValueError):
+                    del sockets[sock]
+
+    def __stop(self):
+        self.__running = False
+
+
+class DatagramRouter(object):
+    """Dispatch the datagrams received from a socket shared by agents according to the address of sender."""
+
+    def __init__(self, loop, sock):
+        """
+        Args:
+            loop: AgentLoop to read the socket.
+            sock: UDP socket shared by agents.
+        """
+        self.__loop = loop
+        self.__sock = sock
+        self.__routes = {}      # Address of sender -> callback
+        self.dropped = 0        # Datagrams from unknown senders
+        loop.call_soon_threadsafe(loop.add_reader, sock, self.__read)
+
+    def register(self, addr, callback):
+        """Call the callback with the data and address of every datagram from the address."""
+        self.__routes[addr] = callback
+
+    def unregister(self, addr):
+        self.__routes.pop(addr, None)
+
+    def __read(self):
+        try:
+            data, addr = self.__sock.recvfrom(65536)
+        except socket.error:
+            return
+        callback = self.__routes.get(addr)
+        if callback is None:
+            self.dropped += 1
+            return
+        callback(data, addr)
+
+
+class MAVCLink(object):
+    """Network of one agent running on an AgentLoop.
+
+    The link requests the CID through UDP, resending MAVC_REQ_CID when there's no response in time, then connects
+    to the monitor through TCP. Messages received are decoded on the loop, MAVC_DELAY_TEST is answered at once and
+    the others are passed to the handler of the agent. If the monitor says in MAVC_CID that it answers MAVC_DELAY_TEST,
+    the link sends it now and then once connected to estimate the clock of the monitor, see ClockSync.
+
+    Callbacks are called in the thread of the loop so they must not block, blocking work such as commanding the
+    vehicle should be handed to loop.run_in_executor() or an executor.ActionExecutor.
+    """
+
+    def __init__(self, loop, telemetry, host, port, home, on_message, on_connected=None, on_closed=None, index=0,
+                 router=None, timeout=2.0, retries=5, connect_timeout=5.0, clock_interval=10.0, clock_burst=4):
+        """
+        Args:
+            loop: AgentLoop the link runs on.
+            telemetry: TelemetrySender of the agent, whose socket is used for the CID handshake.
+            host: The host of monitor.
+            port: Base port of monitor, usually 4396.
+            home: Tuple of latitude and longitude of home.
+            on_message: Called with the type and the message for every MAVC message from the monitor.
+            on_connected: Called once the TCP connection has been established.
+            on_closed: Called with the reason when the link is closed.
+            index: Index of simulator, the CID is requested from port+index.
+            router: DatagramRouter of the socket of telemetry if it's shared with other agents.
+            timeout: Seconds to wait for MAVC_CID before resending MAVC_REQ_CID.
+            retries: Times to resend MAVC_REQ_CID.
+            connect_timeout: Seconds to wait for the TCP connection.
+            clock_interval: Seconds between exchanges of MAVC_DELAY_TEST with the monitor, 0 not to estimate the clock.
+            clock_burst: Number of exchanges right after connected, half a second apart.
+        """
+        self.__loop = loop
+        self.__telemetry = telemetry
+        self.__host = host
+        self.__port = port
+        self.__home = home
+        self.__on_message = on_message
+        self.__on_connected = on_connected
+        self.__on_closed = on_closed
+        self.__index = index
+        self.__router = router
+        self.__timeout = timeout
+        self.__retries = retries
+        self.__connect_timeout = connect_timeout
+        self.__clock_interval = clock_interval
+        self.__clock_burst = clock_burst
+
+        self.cid = -1
+        self.codec = CODEC_JSON
+        self.clock = ClockSync()    # Clock of the monitor
+        self.__monitor_clock = False
+        self.__sock = None
+        self.__decoder = FrameDecoder()
+        self.__out = bytearray()
+        self.__timer = None
+        self.__closed = False
+        self.__started_at = None
+        self.stats = {
+            'attempts': 0,          # MAVC_REQ_CID sent
+            'handshake_time': None,  # Seconds from the first MAVC_REQ_CID to TCP connected
+            'bytes_in': 0,
+            'messages_in': 0,
+            'delay_tests': 0
+        }
+
+    def start(self):
+        """Start the CID handshake, can be called from any thread."""
+        self.__loop.call_soon_threadsafe(self.__request_cid)
+
+    def send(self, msg):
+        """Send a MAVC message through UDP, can be called from any thread."""
+        self.__telemetry.send(encode_msg(msg, self.codec), (self.__host, self.__port + self.__data_port_offset()),
+                              key=msg[0]['Type'])
+
+    def write(self, msg):
+        """Send a MAVC message through TCP, can be called from any thread."""
+        self.__loop.call_soon_threadsafe(self.__write, encode_stream_msg(msg, self.codec))
+
+    def close(self):
+        """Close the connection, can be called from any thread."""
+        self.__loop.call_soon_threadsafe(self.__close, 'closed by agent')
+
+    def __data_port_offset(self):
+        return self.__index if self.cid < 0 else self.cid
+
+    def __request_cid(self):
+        """Send MAVC_REQ_CID and wait for MAVC_CID."""
+        if self.__closed:
+            return
+        if self.stats['attempts'] > self.__retries:
+            self.__close('no response to MAVC_REQ_CID')
+            return
+        if self.__started_at is None:
+            self.__started_at = monotonic()
+            if self.__router is None:
+                self.__loop.add_reader(self.__telemetry.socket, self.__read_cid)
+            else:
+                self.__router.register(self.__cid_addr(), self.__handle_cid)
+        self.stats['attempts'] += 1
+        self.send([
+            {
+                'Header': 'MAVCluster_Drone',
+                'Type': MAVC_REQ_CID
+            },
+            {
+                'Lat': self.__home[0],
+                'Lon': self.__home[1],
+                'Codec': SUPPORTED_CODECS
+            }
+        ])
+        self.__timer = self.__loop.call_later(self.__timeout, self.__request_cid)
+
+    def __cid_addr(self):
+        """Where MAVC_REQ_CID is sent to."""
+        return self.__host, self.__port + self.__index
+
+    def __stop_waiting_cid(self):
+        if self.__router is None:
+            self.__loop.remove_reader(self.__telemetry.socket)
+        else:
+            self.__router.unregister(self.__cid_addr())
+
+    def __read_cid(self):
+        """Receive the reply of MAVC_REQ_CID."""
+        try:
+            data_json, addr = self.__telemetry.socket.recvfrom(1024)
+        except socket.error:
+            return
+        self.__handle_cid(data_json, addr)
+
+    def __handle_cid(self, data_json, addr):
+        """Handle the reply of MAVC_REQ_CID."""
+        if not addr[0] == self.__host:  # This message is not sent from the Monitor
+            return
+        try:
+            data_dict = json.loads(data_json)
+            if not (data_dict[0]['Header'] == 'MAVCluster_Monitor' and data_dict[0]['Type'] == MAVC_CID):
+                return
+            self.cid = data_dict[1]['CID']
+            self.codec = data_dict[1].get('Codec', CODEC_JSON)  # Monitor may not know other codecs
+            self.__monitor_clock = bool(data_dict[1].get('Clock'))  # Whether it answers MAVC_DELAY_TEST
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError):  # This message is not a MAVC message
+            return
+
+        self.__timer.cancel()
+        self.__stop_waiting_cid()
+        print('Drone-%d receives the CID from %s:%s' % (self.cid, addr[0], addr[1]))
+
+        # Build TCP connection to monitor
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__sock.setblocking(0)
+        err = self.__sock.connect_ex((self.__host, self.__port + self.cid))
+        if err not in (0,) + _WOULD_BLOCK:
+            self.__close('unable to connect: %s' % errno.errorcode.get(err, err))
+            return
+        self.__loop.add_writer(self.__sock, self.__check_connected)
+        self.__timer = self.__loop.call_later(self.__connect_timeout, self.__close, 'timeout of TCP connection')
+
+    def __check_connected(self):
+        """The socket is writable once the connection has been established or refused."""
+        self.__loop.remove_writer(self.__sock)
+        self.__timer.cancel()
+        err = self.__sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            self.__close('unable to connect: %s' % errno.errorcode.get(err, err))
+            return
+
+        self.stats['handshake_time'] = monotonic() - self.__started_at
+        self.__loop.add_reader(self.__sock, self.__read)
+        if self.__out:
+            self.__flush()
+        if self.__monitor_clock and self.__clock_interval > 0:
+            self.__probe_clock(0)
+        if self.__on_connected is not None:
+            self.__on_connected()
+
+    def __read(self):
+        """Receive data from the monitor and handle every complete message."""
+        try:
+            n = self.__decoder.recv_into(self.__sock)
+        except socket.error as e:
+            if e.args[0] in _WOULD_BLOCK:
+                return
+            self.__close('connection lost: %s' % e)
+            return
+        if n == 0:
+            self.__close('connection closed by monitor')
+            return
+        self.stats['bytes_in'] += n
+
+        for data_json in self.__decoder.frames():
+            try:
+                data_dict = decode_msg(data_json)
+                if not data_dict[0]['Header'] == 'MAVCluster_Monitor':
+                    continue
+                mavc_type = data_dict[0]['Type']
+            except (ValueError, KeyError, IndexError, TypeError):  # This message is not a MAVC message
+                continue
+            self.stats['messages_in'] += 1
+            if mavc_type == MAVC_DELAY_TEST:
+                self.__answer_delay_test(data_dict)
+            elif mavc_type == MAVC_DELAY_RESPONSE:
+                try:
+                    self.clock.on_response(data_dict[1]['Send_time'], data_dict[1]['Get_time'])
+                except (KeyError, IndexError, TypeError):
+                    continue
+            else:
+                self.__on_message(mavc_type, data_dict)
+
+    def __answer_delay_test(self, data_dict):
+        """Echo the time of sending with the time of receiving right on the loop."""
+        self.stats['delay_tests'] += 1
+        self.__write(encode_stream_msg([
+            {
+                'Header': 'MAVCluster_Drone',
+                'Type': MAVC_DELAY_RESPONSE
+            },
+            {
+                'CID': self.cid,
+                'Send_time': data_dict[1]['Send_time'],
+                'Get_time': int(round(time.time() * 1000))
+            }
+        ], self.codec))
+
+    def __probe_clock(self, sent):
+        """Send MAVC_DELAY_TEST to the monitor, which answers with its time of receiving it."""
+        if self.__closed:
+            return
+        # JSON keeps the CID and the fraction of millisecond, which the binary form does not have
+        self.__write(encode_stream_msg([
+            {
+                'Header': 'MAVCluster_Drone',
+                'Type': MAVC_DELAY_TEST
+            },
+            {
+                'CID': self.cid,
+                'Send_time': self.clock.request_time()
+            }
+        ]))
+        sent += 1
+        self.__loop.call_later(0.5 if sent < self.__clock_burst else self.__clock_interval, self.__probe_clock, sent)
+
+    def __write(self, data):
+        if self.__closed:
+            return
+        self.__out += data
+        if self.__sock is not None and self.stats['handshake_time'] is not None:
+            self.__flush()
+
+    def __flush(self):
+        """Send as much data as the socket accepts, the rest is sent when it's writable again."""
+        try:
+            while self.__out:
+                n = self.__sock.send(bytes(self.__out[:65536]))
+                del self.__out[:n]
+        except socket.error as e:
+            if e.args[0] not in _WOULD_BLOCK:
+                self.__close('connection lost: %s' % e)
+                return
+        if self.__out:
+            self.__loop.add_writer(self.__sock, self.__flush)
+        else:
+            self.__loop.remove_writer(self.__sock)
+
+    def __close(self, reason):
+        if self.__closed:
+            return
+        self.__closed = True
+        if self.__timer is not None:
+            self.__timer.cancel()
+        self.__stop_waiting_cid()
+        if self.__sock is not None:
+            self.__loop.remove_reader(self.__sock)
+            self.__loop.remove_writer(self.__sock)
+            self.__sock.close()
+        print('Link of Drone-%d closed: %s' % (self.cid, reason))
+        if self.__on_closed is not None:
+            self.__on_closed(reason)
+
+
+_loop = None
+_loop_lock = Lock()
+
+
+def get_loop():
+    """The loop shared by every agent in this process, started on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = AgentLoop()
+            _loop.start()
+        return _loop
@@ -0,0 +1,244 @@
+#  -*- coding: utf-8 -*-
+
+"""
+Modules.barrier
+~~~~~~~~~~~~~~~
+
+Synchronize the steps of drones among themselves over UDP broadcast or multicast on the LAN.
+
+Every drone arriving at the barrier of a step broadcasts MAVC_BARRIER with its CID and the step, and resends it until
+the barrier is passed. A drone passes the barrier once it has heard from a quorum of drones, or from any drone which
+has passed it already, and then tells so to the drones still resending. The monitor is only an observer of the
+MAVC_ARRIVED messages, so neither its event loop nor a round trip to it is on the way of a barrier.
+
+Drones hosted by one process share one barrier and its socket, each of them registers its CID. The arrivals of the
+drones of the process are counted at once, without a round trip through the network.
+"""
+
+import socket
+import struct
+import sys
+import traceback
+from threading import Condition, Thread
+from Modules import codec
+from Modules.clock import monotonic
+
+MAVC_BARRIER = 9            # Arrival at the barrier of a step, among drones
+
+# Results of waiting at a barrier
+BARRIER_PASSED = 'passed'
+BARRIER_TIMEOUT = 'timeout'
+BARRIER_CANCELLED = 'cancelled'
+
+
+class PeerBarrier(object):
+    """Barrier of steps shared by the drones on the LAN, one per process."""
+
+    def __init__(self, quorum, port=4397, address='255.255.255.255', timeout=30.0, resend_interval=0.2, linger=60.0):
+        """
+        Args:
+            quorum: Number of drones, this one included, to be heard from to pass a barrier.
+            port: UDP port every drone of the fleet sends to and listens on.
+            address: Broadcast or multicast address of the fleet.
+            timeout: Seconds to wait for the quorum before passing the barrier anyway, None to wait forever.
+            resend_interval: Seconds between arrivals resent while waiting.
+            linger: Seconds a barrier passed is remembered to answer the drones which have missed it, after which the
+                step may be used again by another task.
+        """
+        self.__quorum = quorum
+        self.__address = (address, port)
+        self.__timeout = timeout
+        self.__resend_interval = resend_interval
+        self.__linger = linger
+        self.__cids = set()         # CIDs of the drones of this process
+        self.__waiting = {}         # Step -> CIDs of this process waiting
+        self.__arrivals = {}        # Step -> CIDs heard from
+        self.__passed = {}          # Step -> time passed with the quorum
+        self.__cond = Condition()
+        self.__closed = False
+        self.__stats = {
+            'passed': 0,            # Barriers passed with the quorum
+            'timeout': 0,           # Barriers passed as the quorum was not heard from in time
+            'cancelled': 0,         # Waiting stopped, e.g. by returning to launch
+            'sent': 0,              # Datagrams sent
+            'resent': 0,            # Arrivals resent while waiting
+            'received': 0,          # Datagrams received
+            'wait_total': 0.0,      # Seconds from arriving at a barrier to passing it
+            'wait_max': 0.0,
+            'latency_total': 0.0,   # Seconds from the last arrival needed heard to passing, of barriers passed
+            'latency_max': 0.0
+        }
+        self.__heard_at = {}        # Step -> time the latest arrival or passing was heard
+
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            # Processes on one machine listen on the same port
+            self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.__sock.bind(('', port))
+        self.__sock.settimeout(1.0)    # Check whether it has been closed once a second
+        if _is_multicast(address):
+            self.__sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                                   struct.pack('4sl', socket.inet_aton(address), socket.INADDR_ANY))
+            self.__sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+            self.__sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+
+        receiver = Thread(target=self.__receive, name='Peer-Barrier')
+        receiver.daemon = True
+        receiver.start()
+
+    def register(self, cid):
+        """Add a drone of this process, which answers the drones having missed a barrier passed."""
+        with self.__cond:
+            self.__cids.add(cid)
+
+    def wait(self, step, cid, cancel=None):
+        """Arrive at the barrier of the step and wait until it is passed.
+
+        Args:
+            step: Step of the barrier.
+            cid: CID of the drone arriving.
+            cancel: threading.Event to stop waiting.
+
+        Returns:
+            BARRIER_PASSED, BARRIER_TIMEOUT or BARRIER_CANCELLED.
+        """
+        arrived = monotonic()
+        deadline = arrived + self.__timeout if self.__timeout is not None else None
+        next_send = arrived
+        with self.__cond:
+            for passed_step, passed_at in list(self.__passed.items()):
+                if arrived - passed_at > self.__linger:
+                    del self.__passed[passed_step]
+            self.__cids.add(cid)
+            self.__waiting.setdefault(step, set()).add(cid)
+            self.__arrivals.setdefault(step, set()).add(cid)
+            self.__cond.notify_all()    # The drones of this process waiting count it at once
+        while True:
+            with self.__cond:
+                now = monotonic()
+                if step in self.__passed or len(self.__arrivals.get(step, ())) >= self.__quorum:
+                    result = BARRIER_PASSED
+                    break
+                if cancel is not None and cancel.is_set():
+                    result = BARRIER_CANCELLED
+                    break
+                if deadline is not None and now >= deadline:
+                    result = BARRIER_TIMEOUT
+                    break
+                if now < next_send:
+                    wake = next_send if deadline is None else min(next_send, deadline)
+                    self.__cond.wait(wake - now)
+                    continue
+            if next_send > arrived:
+                self.__count('resent')
+            self.__send(cid, step, False)
+            next_send = monotonic() + self.__resend_interval
+
+        with self.__cond:
+            waiting = self.__waiting[step]
+            waiting.discard(cid)
+            if result == BARRIER_CANCELLED and step in self.__arrivals:
+                self.__arrivals[step].discard(cid)
+            if waiting and result != BARRIER_PASSED:
+                # Other drones of this process are still waiting with the arrivals heard
+                heard_at = self.__heard_at.get(step, arrived)
+            else:
+                if not waiting:
+                    del self.__waiting[step]
+                self.__arrivals.pop(step, None)
+                heard_at = self.__heard_at.pop(step, arrived)
+            self.__stats[result] += 1
+            announce = result == BARRIER_PASSED and step not in self.__passed   # Once per process
+            if result == BARRIER_PASSED:
+                self.__passed.setdefault(step, monotonic())
+                self.__cond.notify_all()
+                latency = max(0.0, monotonic() - max(heard_at, arrived))
+                self.__stats['latency_total'] += latency
+                self.__stats['latency_max'] = max(self.__stats['latency_max'], latency)
+            if result != BARRIER_CANCELLED:
+                wait = monotonic() - arrived
+                self.__stats['wait_total'] += wait
+                self.__stats['wait_max'] = max(self.__stats['wait_max'], wait)
+        if announce:
+            # Drones still resending their arrivals are answered by the receiver
+            self.__send(cid, step, True)
+        return result
+
+    def get_stats(self):
+        """Counters, mean waiting time and latency of barriers."""
+        with self.__cond:
+            stats = dict(self.__stats)
+        over = stats['passed'] + stats['timeout']
+        stats['wait_mean'] = stats['wait_total'] / over if over else None
+        stats['latency_mean'] = stats['latency_total'] / stats['passed'] if stats['passed'] else None
+        return stats
+
+    def close(self):
+        """Close the socket and stop the receiver."""
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify_all()
+        self.__sock.close()
+
+    def __send(self, cid, step, passed):
+        msg = [{'Header': 'MAVCluster_Drone', 'Type': MAVC_BARRIER}, {'CID': cid, 'Step': step, 'Passed': passed}]
+        try:
+            self.__sock.sendto(codec.encode_msg(msg), self.__address)
+            self.__count('sent')
+        except socket.error as e:
+            print('Peer barrier: failed to send: %s' % e)
+
+    def __count(self, key):
+        with self.__cond:
+            self.__stats[key] += 1
+
+    def __receive(self):
+        while not self.__closed:
+            try:
+                data, address = self.__sock.recvfrom(1024)
+                msg = codec.decode_msg(data)
+                if msg[0].get('Type') != MAVC_BARRIER:
+                    continue
+                body = msg[1]
+                cid, step, passed = body['CID'], body['Step'], body['Passed']
+            except socket.error:
+                if self.__closed:
+                    return
+                continue
+            except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+                # Not a barrier message
+                continue
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+                continue
+
+            reply = None
+            with self.__cond:
+                self.__stats['received'] += 1
+                if passed:
+                    if step in self.__arrivals:
+                        self.__heard_at[step] = monotonic()
+                    self.__passed.setdefault(step, monotonic())
+                elif step in self.__passed:
+                    if cid not in self.__cids:
+                        # The drone has missed the barrier being passed
+                        reply = min(self.__cids)
+                elif step in self.__arrivals and cid not in self.__arrivals[step]:
+                    self.__arrivals[step].add(cid)
+                    self.__heard_at[step] = monotonic()
+                elif step not in self.__arrivals:
+                    # Heard from a drone before this one has arrived
+                    self.__arrivals[step] = set([cid])
+                    self.__heard_at[step] = monotonic()
+                self.__cond.notify_all()
+            if reply is not None:
+                self.__send(reply, step, True)
+
+
+def _is_multicast(address):
+    try:
+        return 224 <= int(address.split('.')[0]) <= 239
+    except ValueError:
+        return False
@@ -0,0 +1,180 @@
+#  -*- coding: utf-8 -*-
+
+"""
+Modules.clock
+~~~~~~~~~~~~~
+
+Monotonic clock for measuring intervals and scheduling, which is not affected by changes of the system time.
+
+The clock of the monitor is estimated from the monotonic clock NTP-style: every exchange of MAVC_DELAY_TEST gives the
+round-trip time and an offset which is wrong by half the asymmetry of the trip at most, so the offset of the exchange
+with the least round-trip time among the latest ones is trusted. Events captured on the monotonic clock can then be
+stamped with the time of the monitor.
+"""
+
+import bisect
+import time
+from collections import deque
+from threading import Lock
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    # Python 2.7 has no monotonic clock in the standard library
+    try:
+        from monotonic import monotonic
+    except ImportError:
+        import ctypes
+        import ctypes.util
+
+        class _Timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        _CLOCK_MONOTONIC = 1
+        try:
+            _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'),
+                                         use_errno=True).clock_gettime
+            _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+        except (OSError, AttributeError, TypeError):
+            # Not a POSIX system, the best we can do
+            monotonic = time.time
+        else:
+            def monotonic():
+                """Seconds elapsed since an arbitrary point which never goes backwards."""
+                ts = _Timespec()
+                if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+                    raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+                return ts.tv_sec + ts.tv_nsec * 1.0e-9
+
+
+class ClockSync(object):
+    """Offset between the monotonic clock of the agent and the clock of the monitor.
+
+    Times exchanged with the monitor are in milliseconds, as the Electron monitor uses Date.now().
+    """
+
+    def __init__(self, window=8):
+        """
+        Args:
+            window: Number of latest exchanges the best one is picked from.
+        """
+        self.__samples = deque(maxlen=window)   # (round-trip time, offset) in milliseconds
+        self.__offset = None        # Offset of the exchange with the least round-trip time
+        self.__rtt = None
+        self.__lock = Lock()
+        self.__uplink = LatencyHistogram()
+        self.__downlink = LatencyHistogram()
+        self.__stats = {
+            'exchanges': 0,         # MAVC_DELAY_RESPONSE received
+            'rejected': 0           # Responses which can not be right, e.g. from the future
+        }
+
+    @staticmethod
+    def request_time():
+        """Send_time of a new MAVC_DELAY_TEST, the monotonic clock in milliseconds."""
+        return monotonic() * 1.0e3
+
+    def on_response(self, send_time, get_time):
+        """Feed the MAVC_DELAY_RESPONSE of an exchange.
+
+        Args:
+            send_time: Send_time of the MAVC_DELAY_TEST, from request_time().
+            get_time: Time of the monitor when it received the MAVC_DELAY_TEST, in milliseconds.
+        """
+        now = monotonic() * 1.0e3
+        rtt = now - send_time
+        with self.__lock:
+            if rtt < 0 or rtt > 60.0e3:
+                self.__stats['rejected'] += 1
+                return
+            self.__stats['exchanges'] += 1
+            self.__samples.append((rtt, get_time - (send_time + now) / 2.0))
+            self.__rtt, self.__offset = min(self.__samples)
+            # One-way latencies taking the best offset as the truth
+            self.__uplink.add(get_time - (send_time + self.__offset))
+            self.__downlink.add(now + self.__offset - get_time)
+
+    @property
+    def synced(self):
+        """Whether any exchange has been done."""
+        return self.__offset is not None
+
+    def to_monitor_time(self, captured):
+        """Time of the monitor in milliseconds of a moment on the monotonic clock.
+
+        Args:
+            captured: Seconds of the monotonic clock.
+
+        Returns:
+            Milliseconds, of the system clock of the agent before any exchange.
+        """
+        offset = self.__offset
+        if offset is None:
+            return int(round((captured - monotonic() + time.time()) * 1.0e3))
+        return int(round(captured * 1.0e3 + offset))
+
+    def get_stats(self):
+        """Offset and round-trip time in milliseconds, with histograms of one-way latency."""
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats.update({
+                'offset': self.__offset,
+                'rtt': self.__rtt,
+                'error': self.__rtt / 2.0 if self.__rtt is not None else None,    # Bound of the error of offset
+                'uplink': self.__uplink.get_stats(),
+                'downlink': self.__downlink.get_stats()
+            })
+            return stats
+
+
+class LatencyHistogram(object):
+    """Histogram of latencies in milliseconds on buckets of fixed bounds."""
+
+    BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self, bounds=BOUNDS):
+        """
+        Args:
+            bounds: Upper bounds of the buckets in milliseconds, in ascending order. Latencies above the last one
+                fall into an extra bucket.
+        """
+        self.__bounds = bounds
+        self.__counts = [0] * (len(bounds) + 1)
+        self.__count = 0
+        self.__total = 0.0
+        self.__max = None
+
+    def add(self, latency):
+        """Count a latency in milliseconds, negative ones due to errors of the offset are counted as 0."""
+        latency = max(0.0, latency)
+        self.__counts[bisect.bisect_left(self.__bounds, latency)] += 1
+        self.__count += 1
+        self.__total += latency
+        self.__max = latency if self.__max is None else max(self.__max, latency)
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile, the max for the last bucket."""
+        if not self.__count:
+            return None
+        rank = p / 100.0 * self.__count
+        seen = 0
+        for bound, count in zip(self.__bounds, self.__counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.__max)
+        return self.__max
+
+    def get_stats(self):
+        """Count, mean, max, percentiles and the counts of non-empty buckets keyed by their upper bounds."""
+        buckets = dict(('<=%g' % bound, count) for bound, count in zip(self.__bounds, self.__counts) if count)
+        if self.__counts[-1]:
+            buckets['>%g' % self.__bounds[-1]] = self.__counts[-1]
+        return {
+            'count': self.__count,
+            'mean': self.__total / self.__count if self.__count else None,
+            'max': self.__max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': buckets
+        }
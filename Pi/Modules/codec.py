@@ -0,0 +1,276 @@
+#  -*- coding: utf-8 -*-
+
+"""
+Modules.codec
+~~~~~~~~~~~~~
+
+Encode MAVC messages into JSON strings or compact binary strings.
+
+The binary encoding only covers the messages whose shape is fixed (MAVC_STAT, MAVC_ARRIVED, MAVC_DELAY_TEST,
+MAVC_DELAY_RESPONSE, MAVC_ACTION, MAVC_CID_ACTION and MAVC_RELEASE), the drone offers it in MAVC_REQ_CID and uses it
+only if the monitor accepts it in MAVC_CID. A message that can not be represented in binary is always sent as JSON,
+and the receiver tells them apart by the first byte, so both of them can be mixed on the same link.
+"""
+
+import json
+import struct
+from Modules.framing import FRAMING_DELIMITED, FRAMING_LENGTH_PREFIXED, encode_frame
+
+CODEC_JSON = 'json'
+CODEC_BINARY = 'binary'
+SUPPORTED_CODECS = [CODEC_BINARY, CODEC_JSON]   # In order of preference
+
+# Types of MAVC message which have a binary form
+MAVC_STAT = 2
+MAVC_ACTION = 4
+MAVC_ARRIVED = 5
+MAVC_CID_ACTION = 7
+MAVC_RELEASE = 8
+MAVC_DELAY_TEST = 101
+MAVC_DELAY_RESPONSE = 102
+
+ACTION_ARM_AND_TAKEOFF = 0
+ACTION_GO_TO = 1
+ACTION_GO_BY = 2
+ACTION_LAND = 3
+
+BINARY_MAGIC = 0xCA     # First byte of a binary message, a JSON string always begins with '['
+
+# Flight modes of ArduCopter, the index is sent instead of the name
+MODES = ('STABILIZE', 'ACRO', 'ALT_HOLD', 'AUTO', 'GUIDED', 'LOITER', 'RTL', 'CIRCLE', 'POSITION', 'LAND',
+         'OF_LOITER', 'DRIFT', 'SPORT', 'FLIP', 'AUTOTUNE', 'POSHOLD', 'BRAKE', 'THROW', 'AVOID_ADSB',
+         'GUIDED_NOGPS', 'SMART_RTL', 'INITIALISING')
+MODE_INDEX = dict((mode, index) for index, mode in enumerate(MODES))
+
+_HEADER = struct.Struct('!BB')                      # Magic, Type
+_STAT = struct.Struct('!HBBiii')                    # CID, Armed, Mode, Lat(1e-7 deg), Lon(1e-7 deg), Alt(mm)
+_ARRIVED = struct.Struct('!HI')                     # CID, Step
+_TIME = struct.Struct('!q')                         # Time(ms) of monitor appended to MAVC_STAT and MAVC_ARRIVED
+_DELAY_TEST = struct.Struct('!q')                   # Send_time(ms)
+_DELAY_RESPONSE = struct.Struct('!Hqq')             # CID, Send_time(ms), Get_time(ms)
+_ACTION_COUNT = struct.Struct('!H')                 # Number of actions
+_CID_ACTION = struct.Struct('!HIB')                 # CID, Step, flags of the subtask
+_RELEASE = struct.Struct('!I')                      # Step
+_FLAG_SYNC = 0x01
+_FLAG_HOLD = 0x02
+_ACTION = struct.Struct('!BHIB')                    # Action_type, CID, Step, Sync
+_ACTION_ARGS = {
+    ACTION_ARM_AND_TAKEOFF: (struct.Struct('!f'), ('Alt',)),
+    ACTION_GO_TO: (struct.Struct('!iiff'), ('Lat', 'Lon', 'Alt', 'Time')),
+    ACTION_GO_BY: (struct.Struct('!ffff'), ('N', 'E', 'Alt', 'Time')),
+    ACTION_LAND: (struct.Struct('!ii'), ('Lat', 'Lon'))
+}
+_ACTION_KEYS = dict((action_type, set(('Action_type', 'CID', 'Step', 'Sync')) | set(keys))
+                    for action_type, (_, keys) in _ACTION_ARGS.items())
+_DEGREE_KEYS = ('Lat', 'Lon')
+
+_SENDER = {
+    MAVC_STAT: 'MAVCluster_Drone',
+    MAVC_ARRIVED: 'MAVCluster_Drone',
+    MAVC_DELAY_RESPONSE: 'MAVCluster_Drone',
+    MAVC_ACTION: 'MAVCluster_Monitor',
+    MAVC_CID_ACTION: 'MAVCluster_Monitor',
+    MAVC_RELEASE: 'MAVCluster_Monitor',
+    MAVC_DELAY_TEST: 'MAVCluster_Monitor'
+}
+
+
+def choose_codec(offered):
+    """Pick the codec to be used from the ones offered by the peer.
+
+    Args:
+        offered: List of codecs offered, None if the peer offered nothing.
+
+    Returns:
+        The most preferred codec supported by both sides.
+    """
+    for codec in SUPPORTED_CODECS:
+        if offered is not None and codec in offered:
+            return codec
+    return CODEC_JSON
+
+
+def encode_msg(msg, codec=CODEC_JSON):
+    """Encode the MAVC message.
+
+    Args:
+        msg: MAVC message.
+        codec: CODEC_BINARY to use the binary form whenever the message has one.
+
+    Returns:
+        Bytes to be sent.
+    """
+    if codec == CODEC_BINARY:
+        try:
+            return _encode_binary(msg)
+        except (KeyError, TypeError, ValueError, struct.error):
+            # No binary form for this message
+            pass
+    msg = json.dumps(msg)
+    return msg if isinstance(msg, bytes) else msg.encode('utf-8')
+
+
+def encode_stream_msg(msg, codec=CODEC_JSON):
+    """Encode the MAVC message to be written into a TCP stream.
+
+    JSON strings are followed by the end-string '$$', as the Electron monitor sends them. Binary messages are
+    length-prefixed since they could contain anything.
+
+    Args:
+        msg: MAVC message.
+        codec: CODEC_BINARY to use the binary form whenever the message has one.
+
+    Returns:
+        Bytes to be written.
+    """
+    payload = encode_msg(msg, codec)
+    return encode_frame(payload, FRAMING_LENGTH_PREFIXED if is_binary(payload) else FRAMING_DELIMITED)
+
+
+def decode_msg(payload):
+    """Decode a MAVC message encoded in either of the codecs.
+
+    Args:
+        payload: Bytes received.
+
+    Returns:
+        MAVC message.
+
+    Raises:
+        ValueError: The payload is not a valid message, e.g. a binary one cut short or of an unknown type, action
+            type or mode.
+    """
+    if is_binary(payload):
+        try:
+            return _decode_binary(bytearray(payload))
+        except (struct.error, KeyError, IndexError) as e:
+            raise ValueError('Invalid binary message: %r' % e)
+    if not isinstance(payload, str):
+        payload = payload.decode('utf-8')
+    return json.loads(payload)
+
+
+def is_binary(payload):
+    """Whether the payload is a message in binary form."""
+    return len(payload) > 0 and bytearray(payload[:1])[0] == BINARY_MAGIC
+
+
+def _encode_binary(msg):
+    header, body = msg[0], msg[1:]
+    mavc_type = header['Type']
+    if header['Header'] != _SENDER[mavc_type]:
+        raise ValueError('Unexpected sender')
+
+    data = _HEADER.pack(BINARY_MAGIC, mavc_type)
+    if mavc_type == MAVC_ACTION:
+        return data + _encode_actions(body)
+    if mavc_type == MAVC_CID_ACTION:
+        meta = body[0]
+        if not set(('CID', 'Step', 'Sync')) <= set(meta) <= set(('CID', 'Step', 'Sync', 'Hold')):
+            raise KeyError('Unexpected keys in subtask')
+        flags = (_FLAG_SYNC if meta['Sync'] else 0) | (_FLAG_HOLD if meta.get('Hold') else 0)
+        return data + _CID_ACTION.pack(meta['CID'], meta['Step'], flags) + _encode_actions(body[1:])
+    if mavc_type == MAVC_RELEASE:
+        return data + _RELEASE.pack(body[0]['Step'])
+
+    if len(body) != 1:
+        raise ValueError('Unexpected length of message')
+    body = body[0]
+    if mavc_type == MAVC_STAT:
+        if not set(('CID', 'Armed', 'Mode', 'Lat', 'Lon', 'Alt')) <= set(body) <= \
+                set(('CID', 'Armed', 'Mode', 'Lat', 'Lon', 'Alt', 'Time')):
+            raise KeyError('Unexpected keys in state')
+        return data + _STAT.pack(body['CID'], bool(body['Armed']), MODE_INDEX[body['Mode']],
+                                 _to_degree_e7(body['Lat']), _to_degree_e7(body['Lon']),
+                                 int(round(body['Alt'] * 1.0e3))) + _encode_time(body)
+    if mavc_type == MAVC_ARRIVED:
+        if not set(body) <= set(('CID', 'Step', 'Time')):
+            raise KeyError('Unexpected keys in arrival')
+        return data + _ARRIVED.pack(body['CID'], body['Step']) + _encode_time(body)
+    if mavc_type == MAVC_DELAY_TEST:
+        return data + _DELAY_TEST.pack(body['Send_time'])
+    return data + _DELAY_RESPONSE.pack(body['CID'], body['Send_time'], body['Get_time'])
+
+
+def _encode_actions(actions):
+    parts = [_ACTION_COUNT.pack(len(actions))]
+    for action in actions:
+        action_type = action['Action_type']
+        if set(action) != _ACTION_KEYS[action_type]:
+            raise KeyError('Unexpected keys in action')
+        args, keys = _ACTION_ARGS[action_type]
+        parts.append(_ACTION.pack(action_type, action['CID'], action['Step'], bool(action['Sync'])))
+        parts.append(args.pack(*[_to_degree_e7(action[key]) if key in _DEGREE_KEYS else action[key]
+                                 for key in keys]))
+    return b''.join(parts)
+
+
+def _decode_binary(data):
+    magic, mavc_type = _HEADER.unpack_from(data, 0)
+    offset = _HEADER.size
+    msg = [{'Header': _SENDER[mavc_type], 'Type': mavc_type}]
+
+    if mavc_type == MAVC_STAT:
+        cid, armed, mode, lat, lon, alt = _STAT.unpack_from(data, offset)
+        msg.append({
+            'CID': cid,
+            'Armed': bool(armed),
+            'Mode': MODES[mode],
+            'Lat': lat * 1.0e-7,
+            'Lon': lon * 1.0e-7,
+            'Alt': alt * 1.0e-3
+        })
+        _decode_time(data, offset + _STAT.size, msg[1])
+    elif mavc_type == MAVC_ARRIVED:
+        cid, step = _ARRIVED.unpack_from(data, offset)
+        msg.append({'CID': cid, 'Step': step})
+        _decode_time(data, offset + _ARRIVED.size, msg[1])
+    elif mavc_type == MAVC_DELAY_TEST:
+        msg.append({'Send_time': _DELAY_TEST.unpack_from(data, offset)[0]})
+    elif mavc_type == MAVC_DELAY_RESPONSE:
+        cid, send_time, get_time = _DELAY_RESPONSE.unpack_from(data, offset)
+        msg.append({'CID': cid, 'Send_time': send_time, 'Get_time': get_time})
+    elif mavc_type == MAVC_CID_ACTION:
+        cid, step, flags = _CID_ACTION.unpack_from(data, offset)
+        meta = {'CID': cid, 'Step': step, 'Sync': bool(flags & _FLAG_SYNC)}
+        if flags & _FLAG_HOLD:
+            meta['Hold'] = True
+        msg.append(meta)
+        msg.extend(_decode_actions(data, offset + _CID_ACTION.size))
+    elif mavc_type == MAVC_RELEASE:
+        msg.append({'Step': _RELEASE.unpack_from(data, offset)[0]})
+    else:
+        msg.extend(_decode_actions(data, offset))
+    return msg
+
+
+def _decode_actions(data, offset):
+    actions = []
+    count = _ACTION_COUNT.unpack_from(data, offset)[0]
+    offset += _ACTION_COUNT.size
+    for n in range(count):
+        action_type, cid, step, sync = _ACTION.unpack_from(data, offset)
+        offset += _ACTION.size
+        args, keys = _ACTION_ARGS[action_type]
+        action = {'Action_type': action_type, 'CID': cid, 'Step': step, 'Sync': bool(sync)}
+        for key, value in zip(keys, args.unpack_from(data, offset)):
+            # Single precision is kept to millimetres and milliseconds
+            action[key] = value * 1.0e-7 if key in _DEGREE_KEYS else round(value, 3)
+        offset += args.size
+        actions.append(action)
+    return actions
+
+
+def _encode_time(body):
+    """Time of the message if it has one."""
+    return _TIME.pack(body['Time']) if 'Time' in body else b''
+
+
+def _decode_time(data, offset, body):
+    """Time of the message if the data goes on with it, messages of older agents have none."""
+    if len(data) >= offset + _TIME.size:
+        body['Time'] = _TIME.unpack_from(data, offset)[0]
+
+
+def _to_degree_e7(degree):
+    return int(round(degree * 1.0e7))
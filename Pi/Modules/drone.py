@@ -6,9 +6,17 @@ Modules.drone
 
 Implement the methods for the communication between monitor and drone mainly through UDP protocol.
 """
-import json
+from functools import partial
 from drone_controller import *
-from threading import Thread, Timer
+from agent_loop import MAVCLink, get_loop
+from barrier import BARRIER_CANCELLED
+from clock import monotonic
+from executor import ActionExecutor
+from geofence import GeofenceMonitor, parse_geofence
+from mission import plan_actions
+from params import REQUIRED_PARAMETERS
+from subtask import SubtaskStage, is_held, unpack_actions
+from telemetry import TelemetrySender, get_scheduler
 
 # Constant value definition of communication type
 MAVC_REQ_CID = 0            # Request the Connection ID
@@ -17,6 +25,9 @@ MAVC_STAT = 2               # Report the state of drone
 MAVC_SET_GEOFENCE = 3       # Set geofence of the drone
 MAVC_ACTION = 4             # Action to be performed
 MAVC_ARRIVED = 5            # Tell the monitor that the drone has arrived at the target
+MAVC_CID_ACTION = 7         # Actions of this drone only
+MAVC_RELEASE = 8            # Start the subtask held for a step
+MAVC_FAILED = 10            # Tell the monitor that the drone has failed the actions of a step
 
 # Constant value definition of action type in MAVC_ACTION message
 ACTION_ARM_AND_TAKEOFF = 0  # Ask drone to arm and takeoff
@@ -27,26 +38,37 @@ ACTION_LAND = 3          # Ask drone to land at current or a specific location
 
 class Drone:
     """Maintain an connection between the drone and monitor."""
-    def __init__(self, vehicle, host, port, index=0):
+    def __init__(self, vehicle, host, port, index=0, report_rate=2.0, report_policy=None, telemetry=None,
+                 router=None, batch_missions=False, follow_paths=False, barrier=None, fence_lookahead=0.0,
+                 param_cache=None, vehicle_key=None, time_scale=1.0):
         self.__host = host          # The host of Monitor
-        self.__port = port+index    # The port of Monitor
+        self.__port = port          # The port of Monitor
         self.__index = index        # To decide which port to bind for MAVC_REQ
         self.__CID = -1             # Connection ID used to identify specific the drone.
         self.__task_done = False    # Indicate that whether the connection should be closed
-        self.__action_queue = []    # Queue of actions
-        self.__geofence = None      # Information of geofence
+        self.__geofence = GeofenceMonitor(self.__on_breach)    # Check every position against the geofence
+        self.__fence_lookahead = fence_lookahead    # Seconds ahead at the current velocity checked against it
+        self.__fence_listening = False
         self.__vehicle = vehicle
-        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        # Set battery failsafe
-        self.__vehicle.parameters['FS_BATT_ENABLE'] = 2
-        while not self.__vehicle.parameters['FS_BATT_ENABLE'] == 2:
-            pass
-
-        # Restart mission when switch to AUTO again
-        self.__vehicle.parameters['MIS_RESTART'] = 1
-        while not self.__vehicle.parameters['MIS_RESTART'] == 1:
-            pass
+        self.__loop = get_loop()    # Event loop serving the network of every drone in this process
+        self.__link = None          # Network of this drone on the loop
+        self.__executor = ActionExecutor(self.__loop.pool)  # Perform actions one after another in order
+        self.__stage = SubtaskStage()   # Subtasks received ahead of time, waiting for MAVC_RELEASE
+        self.__telemetry = telemetry or TelemetrySender()  # UDP socket of this drone, may be shared by a fleet
+        self.__own_telemetry = telemetry is None
+        self.__router = router      # DatagramRouter of the shared UDP socket
+        self.__report_rate = report_rate        # Number of MAVC_STAT messages per second
+        self.__report_policy = report_policy    # AdaptiveReport to send MAVC_STAT only on changes, or None
+        self.__report_stream = None
+        self.__batch_missions = batch_missions  # Fly runs of movements in a subtask as one mission in AUTO mode
+        self.__follow_paths = follow_paths      # Fly runs of movements in a subtask continuously in GUIDED mode
+        self.__barrier = barrier    # PeerBarrier shared by the drones of this process, or None to wait for the monitor
+        self.__time_scale = time_scale  # Real seconds per second of Time of actions, below 1 if simulated faster
+
+        # Battery failsafe and restarting mission, confirmed by the vehicle
+        self.__params = sync_parameters(self.__vehicle, REQUIRED_PARAMETERS, param_cache, vehicle_key)
+        self.__startup = {'params': self.__params.get_stats()['ready_time'], 'cid': None}   # Seconds of each stage
+        self.__requested_at = monotonic()
 
         self.__establish_connection()
 
@@ -56,69 +78,51 @@ class Drone:
         drone state in the monitor process, then they should "maintain" the connection identified by an unique ID
         till all tasks are done and the drone has landed safely.
 
-        Currently we use UDP protocol to communicate.
-
-        To-do:
-            Resend MAVC_REQ_CID message while there's no response from the monitor for a long time
+        The CID is requested through UDP and the MAVC_REQ_CID message is resent while there's no response from the
+        monitor for a while, then a TCP connection is built. All of these happen on the event loop, this method
+        returns at once.
         """
 
-        # Send msg to monitor to ask CID
         home = self.__vehicle.location.global_relative_frame
-        msg = [
-            {
-                'Header': 'MAVCluster_Drone',
-                'Type': MAVC_REQ_CID
-            },
-            {
-                'Lat': home.lat,
-                'Lon': home.lon
-            }
-        ]
-        s = self.send_msg_to_monitor(msg)
-
+        self.__link = MAVCLink(self.__loop, self.__telemetry, self.__host, self.__port, (home.lat, home.lon),
+                               self.__on_message, on_connected=self.__on_connected, index=self.__index,
+                               router=self.__router)
+        self.__link.start()
         print("MAVC_REQ_CID sent out")
 
-        # Listen to the monitor to get CID
-        while True:
-            data_json, addr = s.recvfrom(1024)
-            print(data_json)
-            if not addr[0] == self.__host:  # This message is not sent from the Monitor
-                continue
-
-            data_dict = json.loads(data_json)
-            try:
-                if data_dict[0]['Header'] == 'MAVCluster_Monitor' and data_dict[0]['Type'] == MAVC_CID:
-                    self.__CID = data_dict[1]['CID']
-                    self.__port = self.__port - self.__index + self.__CID
-                    s.close()
-                    # Build TCP connection to monitor
-                    self.__sock.connect((self.__host, self.__port))
-                    print 'Drone-%d receives the CID from %s:%s' % (self.__CID, addr[0], addr[1])
-                    break
-            except KeyError:  # This message is not a MAVC message
-                continue
-
-        # Start listening and reporting
-        try:
-            report = Thread(target=self.__report_to_monitor, name='Report-To-Monitor')
-            hear = Thread(target=self.__listen_to_monitor, name='Hear-From-Monitor')
-            # execute = Thread(target=self.__perform_actions, name='Execute-Tasks-In-Queue')
-            report.start()
-            hear.start()
-            # execute.start()
-        except:
-            print "Error: unable to start new thread!"
-            exit(0)
+    def __on_connected(self):
+        """Start reporting once the connection has been established."""
+        self.__CID = self.__link.cid
+        if self.__barrier is not None:
+            self.__barrier.register(self.__CID)
+        self.__startup['cid'] = monotonic() - self.__requested_at
+        print("Drone-%d: parameters ready in %.2fs, CID got in %.2fs" % (self.__CID, self.__startup['params'],
+                                                                         self.__startup['cid']))
+        self.__report_to_monitor()
+
+    def __on_message(self, mavc_type, data_dict):
+        """Hand the message received from monitor to the worker threads.
+
+        Actions are only put into the queue of the executor or held, which is quick enough to be done on the event loop
+        and keeps the order they were received in, and so are releases of the subtasks held. Other messages are handled
+        by the worker threads.
+        """
+        if mavc_type in (MAVC_ACTION, MAVC_CID_ACTION, MAVC_RELEASE):
+            self.__msg_handler(mavc_type, data_dict)
+        else:
+            self.__loop.run_in_executor(self.__msg_handler, mavc_type, data_dict)
 
     def __report_to_monitor(self):
-        """Report the states of drone to the monitor on time while task hasn't done."""
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        print "Drone-%d starts reporting to the monitor" % self.__CID
+        """Report the states of drone to the monitor on time while task hasn't done.
 
-        t = None
+        The report is sent by the scheduler shared by every drone in this process instead of a thread of its own.
+        With a report policy the state is sampled at the max rate of the policy and sent only if the policy agrees.
+        """
+        print "Drone-%d starts reporting to the monitor" % self.__CID
 
         def send_state_to_monitor():
             """Get current state of drone and send to monitor"""
+            captured = monotonic()
             location = self.__vehicle.location.global_relative_frame
             state = [
                 {
@@ -131,31 +135,44 @@ class Drone:
                     'Mode': self.__vehicle.mode.name,
                     'Lat': location.lat,
                     'Lon': location.lon,
-                    'Alt': location.alt
+                    'Alt': location.alt,
+                    'Time': self.__link.clock.to_monitor_time(captured)
                 }
             ]
-            s = self.send_msg_to_monitor(state)
-            if not self.__task_done:
-                t = Timer(0.5, send_state_to_monitor)
-                t.start()
-
-        t = Timer(0.5, send_state_to_monitor)
-        t.start()
+            if self.__report_policy is None or self.__report_policy.should_report(state[1]):
+                self.send_msg_to_monitor(state)
+
+        rate = self.__report_rate if self.__report_policy is None else self.__report_policy.max_rate
+        self.__report_stream = get_scheduler().add_stream('Drone-%d' % self.__CID, send_state_to_monitor, rate)
+
+    def get_stats(self):
+        """Statistics of the messages sent to the monitor."""
+        stats = {'CID': self.__CID, 'link': dict(self.__link.stats), 'actions': self.__executor.get_stats(),
+                 'subtasks': self.__stage.get_stats(), 'params': self.__params.get_stats(),
+                 'startup': dict(self.__startup), 'clock': self.__link.clock.get_stats()}
+        if self.__fence_listening:
+            stats['geofence'] = self.__geofence.get_stats()
+        stats['actions']['records'] = stats['actions']['records'][-10:]     # Only the latest ones are of interest
+        if self.__own_telemetry:
+            stats['udp'] = self.__telemetry.get_stats()
+        if self.__report_stream is not None:
+            stats['report'] = self.__report_stream.get_stats()
+        if self.__report_policy is not None:
+            stats['policy'] = self.__report_policy.get_stats()
+        return stats
 
     def send_msg_to_monitor(self, msg):
         """Send message to monitor using UDP protocol.
 
         By Deafult we use port 4396 on Monitor to handle the request of CID and port 4396+cid to handle other
-        messages from the the Pi whose CID=cid.
+        messages from the the Pi whose CID=cid. Every message goes through the same socket, a newer message of the
+        same type replaces the one still waiting to be sent.
 
         Args:
             msg: MAVC message.
         """
 
-        msg = json.dumps(msg)
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.sendto(msg, (self.__host, self.__port))
-        return s  # Return the socket in case the caller function need to call s.recvfrom() later
+        self.__link.send(msg)
 
     def write_data_to_monitor(self, data):
         """Send data to monitor using TCP protocol
@@ -163,7 +180,7 @@ class Drone:
         Args:
             data: MAVC message.
         """
-        self.__sock.send(json.dumps(data))
+        self.__link.write(data)
 
     def set_speed(self, speed):
         """Set the speed of drone
@@ -173,39 +190,6 @@ class Drone:
         """
         set_speed(self.__vehicle, speed)
 
-    def __listen_to_monitor(self):
-        """Deal with instructions sent by monitor.
-
-        Keep listening the message sent by monitor, once messages arrived this method will push the specified actions
-        sent from monitor into a queue and perfome them one by one in another thread.
-        """
-
-        buf = ''
-        # Listen to the monitor
-        try:
-            while not self.__task_done:
-                data_json = self.__sock.recv(1024)
-                print(data_json)
-
-                buf += data_json
-                # Not a complete message yet
-                if not buf.endswith('$$'):
-                    continue
-                # A complete message has been received
-                data_dict = json.loads(buf[:-2])
-                buf = ''
-                try:
-                    if data_dict[0]['Header'] == 'MAVCluster_Monitor':
-                        mavc_type = data_dict[0]['Type']
-                        handler = Thread(target=self.__msg_handler, args=(mavc_type, data_dict))
-                        handler.start()
-                        # self.__msg_handler(mavc_type, data_dict)
-                except KeyError:  # This message is not a MAVC message
-                    continue
-        except socket.error:
-            # self.close_connection()
-            pass
-
     def __msg_handler(self, mavc_type, *opargs):
         """Handle the message received from monitor
 
@@ -217,35 +201,22 @@ class Drone:
         """
 
         def mavc_action(args):
-            """Perform action."""
-
-            perform_action = {
-                ACTION_ARM_AND_TAKEOFF: arm_and_takeoff,
-                ACTION_GO_TO: go_to,
-                ACTION_GO_BY: go_by,
-                ACTION_LAND: land
-            }
-            data_dict = args[0]
-            for n in range(1, len(data_dict)):
-                # Pick actions about this drone out
-                if data_dict[n]['CID'] == self.__CID:
-                    action = data_dict[n]
-                    # Perform the action
-                    action_type = action['Action_type']
-                    perform_action[action_type](self.__vehicle, action)
-
-            # Send report back if needed
-            if data_dict[-1]['Sync']:
-                self.write_data_to_monitor([
-                    {
-                        'Header': 'MAVCluster_Drone',
-                        'Type': MAVC_ARRIVED
-                    },
-                    {
-                        'CID': self.__CID,
-                        'Step': data_dict[-1]['Step']
-                    }
-                ])
+            """Put actions into the queue of executor, or hold them until released."""
+            # Pick actions about this drone out, unless only those have been sent
+            actions, step, sync = unpack_actions(mavc_type, args[0], self.__CID)
+            if self.__batch_missions or self.__follow_paths:
+                plan = plan_actions(actions)
+            else:
+                plan = [(False, [action]) for action in actions]
+            if is_held(mavc_type, args[0]) and self.__stage.hold(step, (plan, step, sync)):
+                return
+            self.__start_subtask(plan, step, sync)
+
+        def mavc_release(args):
+            """Start the subtask held for the step, or once it is received."""
+            subtask = self.__stage.release(args[0][1]['Step'])
+            if subtask is not None:
+                self.__start_subtask(*subtask)
 
         def mavc_set_geofence(args):
             """Set the geofence of drone."""
@@ -255,77 +226,147 @@ class Drone:
         # Handle MAVC message
         handler = {
             MAVC_ACTION: mavc_action,
+            MAVC_CID_ACTION: mavc_action,
+            MAVC_RELEASE: mavc_release,
             MAVC_SET_GEOFENCE: mavc_set_geofence
         }
         handler[mavc_type](opargs)
 
-    def __perform_actions(self):
-        """perform actions from the queue. """
+    def __start_subtask(self, plan, step, sync):
+        """Put the actions of a subtask into the queue of executor.
 
-        while not self.__task_done:
-            perform_action = {
-                ACTION_ARM_AND_TAKEOFF: arm_and_takeoff,
-                ACTION_GO_TO: go_to,
-                ACTION_GO_BY: go_by,
-                ACTION_LAND: land
-            }
+        A movement which ends stalled or out of GUIDED mode fails the subtask: the rest of its actions are skipped
+        and MAVC_FAILED is sent instead of MAVC_ARRIVED.
 
-            while len(self.__action_queue) > 0:
-                # Initialize the
-                # Choose the first action
-                action = self.__action_queue.pop(0)
-                # Perform the action
-                sync = action['Sync']
-                step = action['Step']
-                action_type = action['Action_type']
-                del action['Sync']
-                del action['Step']
-                del action['Action_type']
-                perform_action[action_type](self.__vehicle, action)
-                # Report the end of the action if needed
-                if sync:
-                    self.write_data_to_monitor([
-                        {
-                            'Header': 'MAVCluster_Drone',
-                            'Type': MAVC_ARRIVED
-                        },
-                        {
-                            'CID': self.__CID,
-                            'Step': step
-                        }
-                    ])
+        Args:
+            plan: List of tuples (is_run, actions) given by plan_actions().
+            step: Step of the subtask.
+            sync: Whether to report MAVC_ARRIVED once the actions are done.
+        """
+        perform_action = {
+            ACTION_ARM_AND_TAKEOFF: arm_and_takeoff,
+            ACTION_GO_TO: go_to,
+            ACTION_GO_BY: go_by,
+            ACTION_LAND: land
+        }
+        release = monotonic()   # Time of each action is relative to the instant the subtask is started
+        failure = {}            # Result of the movement the subtask has failed at, shared by its actions
+        self.__stage.mark_busy()
+        fly_run = fly_mission if self.__batch_missions else follow_path
+        for is_run, group in plan:
+            # A run is started at the time of its first movement
+            at = release + group[0]['Time'] * self.__time_scale if group[0].get('Time') else None
+            if is_run:
+                self.__submit_action(fly_run.__name__, step, partial(self.__perform, failure, step, fly_run),
+                                     self.__vehicle, group, at=at)
+                continue
+            action = group[0]
+            action_type = action['Action_type']
+            if action_type in (ACTION_GO_TO, ACTION_GO_BY):
+                # Compute the target once the previous action is done, ahead of the time to start
+                self.__submit_action(perform_action[action_type].__name__, step,
+                                     partial(self.__perform, failure, step, fly_to), self.__vehicle, action,
+                                     at=at, prepare=stage_movement)
+            else:
+                self.__submit_action(perform_action[action_type].__name__, step,
+                                     partial(self.__perform, failure, step, perform_action[action_type]),
+                                     self.__vehicle, action, at=at)
+
+        # Send report back if needed, it is dropped with the actions once they are preempted
+        if sync:
+            self.__submit_action('arrived', step, self.__report_arrived, failure, step)
+
+    def __submit_action(self, name, step, fn, *args, **kwargs):
+        """Put an action into the queue of executor, warn if it is discarded as the queue is full.
+
+        Keyword arguments are passed to ActionExecutor.submit().
+        """
+        if not self.__executor.submit(name, fn, *args, step=step, **kwargs):
+            print "Drone-%d: action queue is full, %s of step %d discarded" % (self.__CID, name, step)
+
+    def __perform(self, failure, step, fn, *args, **kwargs):
+        """Perform an action of the subtask unless it has failed, and fail it if the drone could not get there."""
+        if failure:
+            return None
+        result = fn(*args, **kwargs)
+        if isinstance(result, dict) and result.get('Result') in (STALLED, MODE_CHANGED):
+            failure.update(result)
+            print "Drone-%d: step %d failed, %s" % (self.__CID, step, result['Result'])
+            self.write_data_to_monitor([
+                {
+                    'Header': 'MAVCluster_Drone',
+                    'Type': MAVC_FAILED
+                },
+                {
+                    'CID': self.__CID,
+                    'Step': step,
+                    'Result': result['Result'],
+                    'Time': self.__link.clock.to_monitor_time(monotonic())
+                }
+            ])
+        return result
+
+    def __report_arrived(self, failure, step, cancel=None):
+        """Tell the monitor that actions of the step have been done, unless the subtask has failed.
+
+        With a peer barrier, the drone then waits for the other drones and starts the next subtask held itself, the
+        actions queued after it wait as well.
+        """
+        if failure:
+            # Neither the monitor nor the other drones should go on as if it had arrived
+            return {'Skipped': failure['Result']}
+        if not self.__executor.pending():
+            # Waiting at the barrier from now on, marked before the monitor can release the next subtask
+            self.__stage.mark_idle()
+        self.write_data_to_monitor([
+            {
+                'Header': 'MAVCluster_Drone',
+                'Type': MAVC_ARRIVED
+            },
+            {
+                'CID': self.__CID,
+                'Step': step,
+                'Time': self.__link.clock.to_monitor_time(monotonic())
+            }
+        ])
+        if self.__barrier is None:
+            return None
+        result = self.__barrier.wait(step, self.__CID, cancel)
+        if result != BARRIER_CANCELLED:
+            subtask = self.__stage.release_after(step)
+            if subtask is not None:
+                self.__start_subtask(*subtask)
+        return {'Barrier': result}
+
+    def abort(self):
+        """Discard the actions in the queue and those held, stop the current one and return to launch."""
+        self.__stage.clear()
+        self.__executor.preempt('return_to_launch', return_to_launch, self.__vehicle)
 
     def __set_geofence(self, args):
-        """Set Geofence of the drone
+        """Set Geofence of the drone, checked every time DroneKit updates the position
 
         Args:
-            args: Dictionary of parameters
+            args: Dictionary of parameters, either one circle to stay in
                 Radius: Radius of circle(meters).
                 Lat: Latitude of center.
                 Lon: Longitude of center.
+            or circles and polygons described in parse_geofence().
         """
+        self.__geofence.set_geofence(parse_geofence(args, self.__fence_lookahead))
+        if not self.__fence_listening:
+            self.__fence_listening = True
+            self.__vehicle.add_attribute_listener('location.global_relative_frame', self.__check_geofence)
+
+    def __check_geofence(self, vehicle, name, location):
+        """Check the position updated, called by DroneKit."""
+        velocity = vehicle.velocity or (0.0, 0.0, 0.0)
+        self.__geofence.update(location.lat, location.lon, velocity[0], velocity[1])
 
-        self.__geofence = args
-        if self.__geofence is None:
-
-            # Monitor the location of drone in case of escaping
-            def monitor_escaping():
-                while not self.__task_done:
-                    # Calculate the distance
-                    current_location = self.__vehicle.location.global_relative_frame
-                    d_lat = current_location.lat - self.__geofence['Lat']
-                    d_lon = current_location.lon - self.__geofence['Lon']
-                    distance = math.sqrt((d_lat * d_lat) + (d_lon * d_lon)) * 1.113195e5
-                    # Almost exceed the borderand
-                    if distance + 0.1 > self.__geofence['Radius']:
-                        # empty the action queue
-                        self.__action_queue = []
-                        # return to launch
-                        return_to_launch(self.__vehicle)
-
-            # Monitor in a new thread
-            work = Thread(target=monitor_escaping, name='Monitor_escaping')
-            work.start()
+    def __on_breach(self, breach):
+        """Return to launch once the drone is out of the geofence, or about to be."""
+        print "Drone-%d: geofence breached %s, return to launch" % (self.__CID, breach.get_record())
+        self.__loop.run_in_executor(self.abort)
 
     def close_connection(self):
         """Close the connection that maintained by the instance
@@ -334,9 +375,14 @@ class Drone:
             A boolean variable that indicate whether the connection closed successfully.
         """
         self.__task_done = True
+        if self.__report_stream is not None:
+            get_scheduler().remove_stream(self.__report_stream)
+        self.__link.close()
+        if self.__fence_listening:
+            self.__vehicle.remove_attribute_listener('location.global_relative_frame', self.__check_geofence)
+        if self.__own_telemetry:
+            self.__telemetry.close()
 
         if self.__vehicle.armed:
-            # empty the action queue
-            self.__action_queue = []
-            # return to launch
-            return_to_launch(self.__vehicle)
+            # Stop every action and return to launch
+            self.abort()
@@ -10,21 +10,68 @@ Package some drone commands as the safety of drone and correctness of tasks cons
 import exceptions
 from dronekit import *
 from pymavlink import mavutil
-
-
-def connect_vehicle(connection_string, baud=115200):
+from threading import Event, Lock
+from Modules.clock import monotonic
+from Modules.mission import compile_waypoints
+from Modules.params import ParamSync
+from Modules.path_follow import MAV_FRAME_LOCAL_NED, VELOCITY_TYPE_MASK, LocalFrame, PathFollower, PathSettings
+
+# Results of waiting for the drone to arrive
+ARRIVED = 'arrived'
+CANCELLED = 'cancelled'
+MODE_CHANGED = 'mode_changed'     # No longer in GUIDED mode, e.g. switched to RTL by the pilot
+STALLED = 'stalled'
+
+_WATCHDOG_PERIOD = 0.25         # Seconds between checks of cancellation and stall, arrival is detected at once
+
+
+class ArrivalCriteria(object):
+    """When the drone is taken as arrived at the target and when the command should be resent."""
+
+    def __init__(self, radius=1.0, settle_time=0.0, settle_speed=None, stall_time=4.0, stall_distance=2.0,
+                 max_resends=5, takeoff_ratio=0.95):
+        """
+        Args:
+            radius: Horizontal distance in meters to the target.
+            settle_time: Seconds the drone should stay within the radius.
+            settle_speed: Max ground speed in m/s within the radius, None for any speed.
+            stall_time: Seconds after a command before the drone is checked for a stall.
+            stall_distance: The command is resent if the drone has moved less than this in meters since it was sent.
+            max_resends: Times the command is resent before giving up.
+            takeoff_ratio: Ratio of target altitude at which the takeoff is done.
+        """
+        self.radius = radius
+        self.settle_time = settle_time
+        self.settle_speed = settle_speed
+        self.stall_time = stall_time
+        self.stall_distance = stall_distance
+        self.max_resends = max_resends
+        self.takeoff_ratio = takeoff_ratio
+
+
+# Criteria used by actions of every drone in this process, may be replaced by the script
+arrival_criteria = ArrivalCriteria()
+
+# How every drone in this process follows paths, may be replaced by the script
+path_settings = PathSettings()
+
+
+def connect_vehicle(connection_string, baud=115200, heartbeat_timeout=30):
     """Connect to the vehicle through the connection string
 
     Args:
         connection_string: It contains address to be connected and some connection options
         baud: Baudrate
+        heartbeat_timeout: Seconds to wait for the first heartbeat
 
     Returns:
         An object from which you can get/set parameters and attributes, and control vehicle movement.
     """
 
     try:
-        vehicle = connect(connection_string, wait_ready=True, baud=baud)
+        # Parameters are fetched in background, those required are confirmed one by one by sync_parameters()
+        vehicle = connect(connection_string, wait_ready=['gps_0', 'armed', 'mode', 'attitude'], baud=baud,
+                          heartbeat_timeout=heartbeat_timeout)
     except socket.error:
         print 'No server exists!'
     except exceptions.OSError as e:
@@ -35,7 +82,45 @@ def connect_vehicle(connection_string, baud=115200):
         return vehicle
 
 
-def arm_and_takeoff(vehicle, args):
+def sync_parameters(vehicle, required, cache=None, key=None, timeout=1.0, retries=3):
+    """Set the parameters on the vehicle and wait for PARAM_VALUE of each one, resending those not confirmed in time.
+
+    Args:
+        vehicle: Vehicle connected.
+        required: Dictionary of parameter names and values.
+        cache: ParamCache, or None not to cache the parameters.
+        key: Key of the vehicle in the cache.
+        timeout: Seconds to wait for PARAM_VALUE before resending.
+        retries: Times a parameter is resent before giving up.
+
+    Returns:
+        ParamSync with the statistics, and the parameters which have not been confirmed.
+    """
+    def send_set(name, value):
+        vehicle.send_mavlink(vehicle.message_factory.param_set_encode(
+            0, 0, name, value, mavutil.mavlink.MAV_PARAM_TYPE_REAL32))
+
+    def send_read(name):
+        vehicle.send_mavlink(vehicle.message_factory.param_request_read_encode(0, 0, name, -1))
+
+    sync = ParamSync(send_set, send_read, cache, key, timeout, retries)
+
+    def on_param_value(self, name, msg):
+        sync.on_param_value(msg.param_id.rstrip('\x00'), msg.param_value)
+
+    vehicle.add_message_listener('PARAM_VALUE', on_param_value)
+    try:
+        failed = sync.apply(required)
+    finally:
+        vehicle.remove_message_listener('PARAM_VALUE', on_param_value)
+    stats = sync.get_stats()
+    print 'Parameters ready in %.2fs, %d set and %d read back' % (stats['ready_time'], stats['set'], stats['read'])
+    if failed:
+        print 'Parameters not confirmed: %s' % ', '.join(sorted(failed))
+    return sync
+
+
+def arm_and_takeoff(vehicle, args, cancel=None, criteria=None):
     """Arms vehicle and fly to the altitude.
 
     Args:
@@ -43,36 +128,45 @@ def arm_and_takeoff(vehicle, args):
         args: Dictionary that contains action information
             * Alt: The height which the drone should arrive at after the taking off.
             * Sync: Whether report to monitor after reaching the target.
+        cancel: Event set to stop waiting, e.g. when the drone is asked to return to launch.
+        criteria: ArrivalCriteria, arrival_criteria by default.
+
+    Returns:
+        Dictionary of the result, see fly_to().
     """
     altitude = args['Alt']
+    criteria = criteria or arrival_criteria
+    started = monotonic()
 
     print "Arming motors"
     # Copter should arm in GUIDED mode
     vehicle.mode = VehicleMode("GUIDED")
     vehicle.armed = True
 
-    while not vehicle.armed:
-        print " Waiting for arming..."
-        time.sleep(1)
+    with _Watch(vehicle, ('armed',), lambda: vehicle.armed) as watch:
+        if not _wait_until(watch, cancel):
+            return _result(CANCELLED, started, watch)
     print "Armed, Taking off!"
     vehicle.simple_takeoff(altitude)  # Take off to target altitude
 
     # Wait until the vehicle reaches a safe height before processing the goto (otherwise the command
     #  after Vehicle.simple_takeoff will execute immediately).
-    while True:
-        print " Altitude: ", vehicle.location.global_relative_frame.alt
-        if vehicle.location.global_relative_frame.alt >= altitude * 0.95:  # Trigger just below target alt.
-            print "Reached target altitude"
-            break
-        time.sleep(1)
+    def reached():
+        alt = vehicle.location.global_relative_frame.alt
+        return alt is not None and alt >= altitude * criteria.takeoff_ratio  # Trigger just below target alt.
+
+    with _Watch(vehicle, ('location.global_relative_frame',), reached) as watch:
+        if not _wait_until(watch, cancel):
+            return _result(CANCELLED, started, watch)
+    print "Reached target altitude"
+    return _result(ARRIVED, started, watch)
 
 
-def go_by(vehicle, args):
+def go_by(vehicle, args, cancel=None, criteria=None):
     """Make an movement of drone according to the distance at North and East inputted
 
     We think that the drone has arrived the target position when the remaining distance decreases to a so small
-    value that we can ignore it. There isn't any callback function provided since the script runs synchronously,
-    but it can be added easily if needed one day.
+    value that we can ignore it, see fly_to().
 
     Args:
         vehicle: Object of drone.
@@ -80,6 +174,11 @@ def go_by(vehicle, args):
             * N: Distance at North direction.
             * E: Distance at East direction.
             * Speed: Expected speed of the drone.
+        cancel: Event set to stop the movement.
+        criteria: ArrivalCriteria, arrival_criteria by default.
+
+    Returns:
+        Dictionary of the result, see fly_to().
     """
 
     dNorth = args['N']
@@ -87,15 +186,14 @@ def go_by(vehicle, args):
     current_location = vehicle.location.global_relative_frame
     print 'Go by (N: %d, E:%d)' % (dNorth, dEast)
     target_location = _get_location_metres(current_location, dNorth, dEast)
-    fly_to(vehicle, target_location)
+    return fly_to(vehicle, target_location, cancel, criteria)
 
 
-def go_to(vehicle, args):
+def go_to(vehicle, args, cancel=None, criteria=None):
     """Make an movement of drone according to the latitude/longitude inputted
 
     We think that the drone has arrived the target position when the remaining distance decreases to a so small
-    value that we can ignore it. There isn't any callback function provided since the script runs synchronously,
-    but it can be added easily if needed one day.
+    value that we can ignore it, see fly_to().
 
     Args:
         vehicle: Object of drone.
@@ -103,48 +201,215 @@ def go_to(vehicle, args):
             * Lat: Latitude of target position.
             * Lon: Longitude of target position.
             * Speed: Expected speed of the drone.
+        cancel: Event set to stop the movement.
+        criteria: ArrivalCriteria, arrival_criteria by default.
+
+    Returns:
+        Dictionary of the result, see fly_to().
     """
 
     lat = args['Lat']
     lon = args['Lon']
     alt = args['Alt']
-    fly_to(vehicle, LocationGlobalRelative(lat, lon, alt))
+    return fly_to(vehicle, LocationGlobalRelative(lat, lon, alt), cancel, criteria)
+
+
+def stage_movement(vehicle, args):
+    """Compute the target of a go_by or go_to action before the time to start it.
+
+    Args:
+        vehicle: Object of drone.
+        args: Dictionary of a go_by or go_to action.
+
+    Returns:
+        Tuple of the arguments of fly_to().
+    """
+    if 'N' in args:
+        target = _get_location_metres(vehicle.location.global_relative_frame, args['N'], args['E'])
+    else:
+        target = LocationGlobalRelative(args['Lat'], args['Lon'], args['Alt'])
+    return vehicle, target
 
 
-def fly_to(vehicle, target):
-    """Implementation of function go_by and go_to"""
+def fly_to(vehicle, target, cancel=None, criteria=None):
+    """Implementation of function go_by and go_to
 
-    init_location = vehicle.location.global_relative_frame
-    wait_time = 0
-    resend_cmd = False
+    Arrival is checked by a listener of the location as soon as DroneKit receives a new position, rather than by
+    polling. A watchdog resends the command if the drone has hardly moved for a while after it was sent.
 
-    vehicle.simple_goto(target)
+    Args:
+        vehicle: Object of drone.
+        target: LocationGlobalRelative of the target.
+        cancel: Event set to stop the movement.
+        criteria: ArrivalCriteria, arrival_criteria by default.
 
-    while vehicle.mode.name == "GUIDED":  # Stop action if we are no longer in guided mode.
-        time.sleep(1)
-        wait_time += 1
-        current_location = vehicle.location.global_relative_frame
+    Returns:
+        Dictionary of the result
+            * Result: ARRIVED, CANCELLED, MODE_CHANGED or STALLED.
+            * Resends: Times the command has been resent.
+            * Duration: Seconds from the first command to the end.
+            * Detect_latency: Seconds from the position satisfying the criteria to the action noticing it.
+    """
 
-        # Resend movement cmd if the drone nearly keeps staying in the original position
-        moved_distance = _get_distance_metres(init_location, current_location)
-        # if wait_time > 4 and moved_distance < vehicle.groundspeed * wait_time * 0.3:
-        if wait_time > 4 and moved_distance < 2:
+    criteria = criteria or arrival_criteria
+    started = monotonic()
+    arrival = _Arrival(vehicle, target, criteria)
+    resends = 0
+
+    with _Watch(vehicle, ('location.global_relative_frame', 'mode'), arrival.check) as watch:
+        while True:
+            init_location = vehicle.location.global_relative_frame
+            sent_at = monotonic()
+            vehicle.simple_goto(target)
+
+            result = None
+            while result is None:
+                if watch.wait(_WATCHDOG_PERIOD):
+                    # Stop action if we are no longer in guided mode.
+                    result = ARRIVED if vehicle.mode.name == "GUIDED" else MODE_CHANGED
+                elif cancel is not None and cancel.is_set():
+                    result = CANCELLED
+                elif monotonic() - sent_at > criteria.stall_time and \
+                        _get_distance_metres(init_location, vehicle.location.global_relative_frame) < \
+                        criteria.stall_distance:
+                    # The drone nearly keeps staying in the original position
+                    result = STALLED
+
+            if result != STALLED or resends >= criteria.max_resends:
+                break
             print "Redo fly_to"
-            resend_cmd = True
-            break
+            resends += 1
+
+    if result == ARRIVED:
+        print "Reached target"
+    return _result(result, started, watch, resends)
 
-        # To judge whether the drone has arrived the target position
-        remaining_distance = _get_distance_metres(current_location, target)
-        print "Distance to target: ", remaining_distance
-        if remaining_distance <= 1:  # Just below target, in case of undershoot.
-            print "Reached target"
-            break
 
-    if resend_cmd:
-        fly_to(vehicle, target)
+def fly_mission(vehicle, actions, cancel=None, criteria=None):
+    """Fly through the targets of a run of go_by and go_to actions without stopping at each one.
 
+    The targets are uploaded as one mission and flown in AUTO mode, the run is done once MISSION_ITEM_REACHED of
+    the last waypoint is received. The drone is switched back to GUIDED mode afterwards for the following actions.
 
-def land(vehicle, args):
+    Args:
+        vehicle: Object of drone.
+        actions: List of go_by and go_to actions.
+        cancel: Event set to stop the movement.
+        criteria: Unused, ArduPilot decides when a waypoint has been reached.
+
+    Returns:
+        Dictionary of the result, see fly_to(), with the number of waypoints and the seconds spent on uploading.
+    """
+
+    started = monotonic()
+    location = vehicle.location.global_relative_frame
+    waypoints = compile_waypoints(actions, {'lat': location.lat, 'lon': location.lon, 'alt': location.alt})
+
+    cmds = vehicle.commands
+    cmds.clear()
+    for waypoint in waypoints:
+        cmds.add(Command(0, 0, 0, mavutil.mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT, mavutil.mavlink.MAV_CMD_NAV_WAYPOINT,
+                         0, 0, 0, 0, 0, 0, waypoint['lat'], waypoint['lon'], waypoint['alt']))
+    cmds.upload()
+    uploaded = monotonic()
+    print "Mission of %d waypoints uploaded" % len(waypoints)
+
+    # Item 0 is the home location, so the last waypoint is the item len(waypoints). This listener is added before
+    # the one of watch so that it has seen the message when the condition is checked.
+    reached = [-1]
+
+    def on_reached(vehicle, name, message):
+        reached[0] = max(reached[0], message.seq)
+
+    vehicle.add_message_listener('MISSION_ITEM_REACHED', on_reached)
+    try:
+        vehicle.mode = VehicleMode("AUTO")
+        with _Watch(vehicle, ('mode',), lambda: vehicle.mode.name == "AUTO") as watch:
+            if not _wait_until(watch, cancel):
+                return _mission_result(CANCELLED, started, watch, waypoints, uploaded)
+
+        # Stop action if we are no longer in auto mode
+        done = lambda: reached[0] >= len(waypoints) or vehicle.mode.name != "AUTO"
+        with _Watch(vehicle, ('mode',), done, messages=('MISSION_ITEM_REACHED',)) as watch:
+            if not _wait_until(watch, cancel):
+                return _mission_result(CANCELLED, started, watch, waypoints, uploaded)
+    finally:
+        vehicle.remove_message_listener('MISSION_ITEM_REACHED', on_reached)
+
+    if vehicle.mode.name != "AUTO":
+        return _mission_result(MODE_CHANGED, started, watch, waypoints, uploaded)
+    print "Mission completed"
+    vehicle.mode = VehicleMode("GUIDED")
+    return _mission_result(ARRIVED, started, watch, waypoints, uploaded)
+
+
+def follow_path(vehicle, actions, cancel=None, criteria=None):
+    """Fly along the targets of a run of go_by and go_to actions continuously in GUIDED mode.
+
+    Velocity setpoints are streamed at the rate of path_settings towards a point ahead along the path, so the drone
+    cuts corners instead of stopping at every target. It is asked to hold the last target at the end.
+
+    Args:
+        vehicle: Object of drone.
+        actions: List of go_by and go_to actions.
+        cancel: Event set to stop the movement.
+        criteria: Unused, the end of path is reached within the radius of path_settings.
+
+    Returns:
+        Dictionary of the result, see fly_to(), with the number of waypoints and the length of path in meters.
+    """
+
+    settings = path_settings
+    started = monotonic()
+    location = vehicle.location.global_relative_frame
+    start = {'lat': location.lat, 'lon': location.lon, 'alt': location.alt}
+    waypoints = compile_waypoints(actions, start)
+    frame = LocalFrame(start['lat'], start['lon'])
+    follower = PathFollower([frame.to_local(start)] + [frame.to_local(waypoint) for waypoint in waypoints], settings)
+    # Give up if the drone is far slower than expected, e.g. blocked by wind
+    timeout = started + follower.length / settings.speed * 3 + 10
+    period = 1.0 / settings.rate
+    deadline = started
+
+    print "Follow path of %d waypoints (%.1f m)" % (len(waypoints), follower.length)
+    while True:
+        if vehicle.mode.name != "GUIDED":
+            # Stop action if we are no longer in guided mode.
+            result = MODE_CHANGED
+            break
+        location = vehicle.location.global_relative_frame
+        velocity = follower.update(frame.to_local({'lat': location.lat, 'lon': location.lon, 'alt': location.alt}))
+        if velocity is None:
+            result = ARRIVED
+            break
+        vehicle.send_mavlink(vehicle.message_factory.set_position_target_local_ned_encode(
+            0, 0, 0, MAV_FRAME_LOCAL_NED, VELOCITY_TYPE_MASK, 0, 0, 0, velocity[0], velocity[1], velocity[2],
+            0, 0, 0, 0, 0))
+
+        now = monotonic()
+        if now > timeout:
+            result = STALLED
+            break
+        deadline = max(deadline + period, now)
+        if _sleep_until(deadline, cancel):
+            result = CANCELLED
+            break
+
+    if result == ARRIVED:
+        end = waypoints[-1]
+        vehicle.simple_goto(LocationGlobalRelative(end['lat'], end['lon'], end['alt']))
+        print "Reached end of path"
+    return {
+        'Result': result,
+        'Resends': 0,
+        'Duration': monotonic() - started,
+        'Detect_latency': None,
+        'Waypoints': len(waypoints),
+        'Length': follower.length
+    }
+
+
+def land(vehicle, args, cancel=None, criteria=None):
     """Ask the drone to land at a specific location.
 
     If the latitude equals zero, then the drone will land at the current location.
@@ -154,6 +419,8 @@ def land(vehicle, args):
         args: Dictionary of parameters.
             Lat: Latitude.
             Lon: Longitude.
+        cancel: Unused, landing is never cancelled.
+        criteria: Unused.
     """
     # Get latitude and longitude
     lat = args['Lat']
@@ -161,7 +428,7 @@ def land(vehicle, args):
     vehicle.mode = VehicleMode("LAND")
 
 
-def return_to_launch(vehicle):
+def return_to_launch(vehicle, cancel=None):
     """Ask the drone to return to launch"""
     vehicle.mode = VehicleMode('RTL')
 
@@ -171,6 +438,138 @@ def set_speed(vehicle, speed):
     vehicle.groundspeed = speed
 
 
+class _Watch(object):
+    """Wake up the action waiting for a condition as soon as DroneKit updates any of the attributes or receives any
+    of the messages.
+
+    The condition is checked in the thread of DroneKit on every update, so it should be cheap.
+    """
+
+    def __init__(self, vehicle, attributes, condition, messages=()):
+        self.__vehicle = vehicle
+        self.__attributes = attributes
+        self.__messages = messages
+        self.__condition = condition
+        self.__lock = Lock()
+        self.__met = Event()
+        self.met_at = None      # When the condition has been met
+        self.woken_at = None    # When the action has noticed it
+
+    def __enter__(self):
+        for name in self.__attributes:
+            self.__vehicle.add_attribute_listener(name, self.__listener)
+        for name in self.__messages:
+            self.__vehicle.add_message_listener(name, self.__listener)
+        self.__check()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        for name in self.__attributes:
+            self.__vehicle.remove_attribute_listener(name, self.__listener)
+        for name in self.__messages:
+            self.__vehicle.remove_message_listener(name, self.__listener)
+        return False
+
+    def wait(self, timeout):
+        """Wait for the condition for at most timeout seconds.
+
+        Returns:
+            Whether the condition has been met.
+        """
+        if not self.__met.wait(timeout):
+            # Time based conditions (e.g. settling) can be met without any update
+            self.__check()
+        if not self.__met.is_set():
+            return False
+        if self.woken_at is None:
+            self.woken_at = monotonic()
+        return True
+
+    def __listener(self, vehicle, name, value):
+        self.__check()
+
+    def __check(self):
+        with self.__lock:
+            if self.__met.is_set():
+                return
+            try:
+                met = self.__condition()
+            except (AttributeError, TypeError):
+                # Attributes not received yet
+                met = False
+            if met:
+                self.met_at = monotonic()
+                self.__met.set()
+
+
+class _Arrival(object):
+    """Condition of arriving at the target, checked by _Watch."""
+
+    def __init__(self, vehicle, target, criteria):
+        self.__vehicle = vehicle
+        self.__target = target
+        self.__criteria = criteria
+        self.__inside_since = None  # When the drone entered the radius
+
+    def check(self):
+        if self.__vehicle.mode.name != "GUIDED":
+            return True
+        criteria = self.__criteria
+        inside = _get_distance_metres(self.__vehicle.location.global_relative_frame, self.__target) <= \
+            criteria.radius and (criteria.settle_speed is None or self.__vehicle.groundspeed <= criteria.settle_speed)
+        if not inside:
+            self.__inside_since = None
+            return False
+        now = monotonic()
+        if self.__inside_since is None:
+            self.__inside_since = now
+        return now - self.__inside_since >= criteria.settle_time
+
+
+def _wait_until(watch, cancel):
+    """Wait for the condition of the watch.
+
+    Returns:
+        False if the action has been cancelled.
+    """
+    while not watch.wait(_WATCHDOG_PERIOD):
+        if cancel is not None and cancel.is_set():
+            return False
+    return True
+
+
+def _sleep_until(deadline, cancel):
+    """Sleep until the monotonic time.
+
+    Returns:
+        Whether the action has been cancelled.
+    """
+    remaining = deadline - monotonic()
+    if cancel is None:
+        if remaining > 0:
+            time.sleep(remaining)
+        return False
+    return cancel.wait(max(remaining, 0)) or cancel.is_set()
+
+
+def _result(result, started, watch, resends=0):
+    """Dictionary of the result of an action."""
+    return {
+        'Result': result,
+        'Resends': resends,
+        'Duration': monotonic() - started,
+        'Detect_latency': None if watch.woken_at is None else watch.woken_at - watch.met_at
+    }
+
+
+def _mission_result(result, started, watch, waypoints, uploaded):
+    """Dictionary of the result of a mission."""
+    outcome = _result(result, started, watch)
+    outcome['Waypoints'] = len(waypoints)
+    outcome['Upload_time'] = uploaded - started
+    return outcome
+
+
 def _get_location_metres(original_location, dNorth, dEast):
     """
     Returns a LocationGlobal object containing the latitude/longitude `dNorth` and `dEast` metres from the
@@ -0,0 +1,225 @@
+#  -*- coding: utf-8 -*-
+
+"""
+Modules.executor
+~~~~~~~~~~~~~~~~
+
+Perform the actions of a drone one after another in the order they were received.
+
+Each drone owns one bounded queue of actions. Urgent commands such as RTL preempt it: actions waiting in the queue
+are discarded and the one being performed is asked to stop. The latency from enqueuing to starting and from starting
+to finishing is recorded for every action.
+
+An action may be given a time on the monotonic clock to be triggered at. Its command is staged as soon as the
+previous action is done, and it is started at that time but never before the previous one is done. How late it
+started is recorded.
+"""
+
+import sys
+import traceback
+from collections import deque
+from threading import Condition, Event
+from Modules.clock import monotonic
+
+# Status of an action
+ACTION_QUEUED = 'queued'
+ACTION_RUNNING = 'running'
+ACTION_DONE = 'done'
+ACTION_FAILED = 'failed'
+ACTION_CANCELLED = 'cancelled'
+
+
+class Action(object):
+    """An action waiting in or taken from the queue."""
+
+    __slots__ = ('name', 'step', 'fn', 'args', 'at', 'prepare', 'cancel', 'status', 'result', 'enqueued', 'started',
+                 'finished')
+
+    def __init__(self, name, step, fn, args, at=None, prepare=None):
+        self.name = name
+        self.step = step
+        self.fn = fn
+        self.args = args
+        self.at = at            # Monotonic time to be triggered at, None to start once the previous one is done
+        self.prepare = prepare  # Function staging the command, returning the arguments of fn
+        self.cancel = Event()   # Set when the action should stop as soon as possible
+        self.status = ACTION_QUEUED
+        self.result = None      # What the function returned, e.g. the result of a movement
+        self.enqueued = monotonic()
+        self.started = None
+        self.finished = None
+
+    def get_record(self):
+        """Latency of the action in seconds."""
+        record = {
+            'name': self.name,
+            'step': self.step,
+            'status': self.status,
+            'queue_latency': None if self.started is None else self.started - self.enqueued,
+            'run_time': None if self.finished is None or self.started is None else self.finished - self.started,
+            'total': None if self.finished is None else self.finished - self.enqueued
+        }
+        if self.at is not None and self.started is not None:
+            record['lateness'] = self.started - self.at
+        if isinstance(self.result, dict):
+            record['result'] = self.result
+        return record
+
+
+class ActionExecutor(object):
+    """Ordered, bounded and preemptible queue of actions of one drone.
+
+    Functions submitted are called with the positional arguments given and a keyword argument `cancel`, which is a
+    threading.Event set when the action is preempted. Long-running functions should check it and return early. A
+    dictionary returned by the function is kept in the record of the action.
+    """
+
+    def __init__(self, pool, max_depth=256, history=200):
+        """
+        Args:
+            pool: WorkerPool performing the actions.
+            max_depth: Max number of actions waiting in the queue.
+            history: Number of records of finished actions kept.
+        """
+        self.__pool = pool
+        self.__max_depth = max_depth
+        self.__queue = deque()
+        self.__cond = Condition()
+        self.__running = False
+        self.__current = None
+        self.__records = deque(maxlen=history)
+        self.__counters = {
+            ACTION_DONE: 0,
+            ACTION_FAILED: 0,
+            ACTION_CANCELLED: 0,
+            'rejected': 0,      # Submitted while the queue was full
+            'preempted': 0,     # Times of preemption
+            'timed': 0          # Actions started at a given time
+        }
+        self.__sums = {'queue_latency': 0.0, 'run_time': 0.0, 'total': 0.0}
+        self.__lateness = {'sum': 0.0, 'max': 0.0}
+
+    def submit(self, name, fn, *args, **kwargs):
+        """Put an action at the end of the queue.
+
+        Args:
+            name: Name of the action in records.
+            fn: Function performing the action.
+            args: Arguments of the function.
+            step: Keyword only, step of the action in the task.
+            at: Keyword only, monotonic time to start the action at, None to start it as soon as possible.
+            prepare: Keyword only, function called with args once the previous action is done, returning the
+                arguments of fn. It stages the command before the time to start.
+
+        Returns:
+            False if the queue is full and the action is discarded.
+        """
+        action = Action(name, kwargs.get('step'), fn, args, kwargs.get('at'), kwargs.get('prepare'))
+        with self.__cond:
+            if len(self.__queue) >= self.__max_depth:
+                self.__counters['rejected'] += 1
+                return False
+            self.__queue.append(action)
+            if self.__running:
+                return True
+            self.__running = True
+        self.__pool.submit(self.__drain)
+        return True
+
+    def preempt(self, name, fn, *args):
+        """Discard the actions in the queue, stop the current one and perform the action at once.
+
+        The action is performed in the thread of the caller so that it is never delayed by the one being stopped.
+
+        Args:
+            name: Name of the action in records.
+            fn: Function performing the action, e.g. return to launch.
+            args: Arguments of the function.
+        """
+        action = Action(name, None, fn, args)
+        with self.__cond:
+            self.__counters['preempted'] += 1
+            while self.__queue:
+                self.__finish(self.__queue.popleft(), ACTION_CANCELLED)
+            if self.__current is not None:
+                self.__current.cancel.set()
+        self.__perform(action)
+
+    def pending(self):
+        """Number of actions waiting in the queue."""
+        with self.__cond:
+            return len(self.__queue)
+
+    def get_stats(self):
+        """Counters, mean latency and recent records of actions."""
+        with self.__cond:
+            finished = self.__counters[ACTION_DONE] + self.__counters[ACTION_FAILED]
+            stats = dict(self.__counters)
+            stats['queued'] = len(self.__queue)
+            stats['current'] = None if self.__current is None else self.__current.name
+            for key, total in self.__sums.items():
+                stats['mean_' + key] = total / finished if finished else None
+            stats['mean_lateness'] = self.__lateness['sum'] / stats['timed'] if stats['timed'] else None
+            stats['max_lateness'] = self.__lateness['max']
+            stats['records'] = list(self.__records)
+            return stats
+
+    def __drain(self):
+        while True:
+            with self.__cond:
+                if not self.__queue:
+                    self.__running = False
+                    return
+                action = self.__queue.popleft()
+                self.__current = action
+            self.__perform(action)
+            with self.__cond:
+                self.__current = None
+
+    def __perform(self, action):
+        try:
+            if action.prepare is not None:
+                action.args = action.prepare(*action.args)
+            if action.at is not None and self.__wait_until(action.at, action.cancel):
+                with self.__cond:
+                    self.__finish(action, ACTION_CANCELLED)
+                return
+            action.started = monotonic()
+            action.status = ACTION_RUNNING
+            action.result = action.fn(*action.args, cancel=action.cancel)
+            status = ACTION_CANCELLED if action.cancel.is_set() else ACTION_DONE
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            status = ACTION_FAILED
+        with self.__cond:
+            self.__finish(action, status)
+
+    @staticmethod
+    def __wait_until(at, cancel):
+        """Wait for the time on the monotonic clock.
+
+        Returns:
+            Whether the action has been cancelled while waiting.
+        """
+        while True:
+            remaining = at - monotonic()
+            if remaining <= 0:
+                return cancel.is_set()
+            if cancel.wait(remaining):
+                return True
+
+    def __finish(self, action, status):
+        """Record the action, must be called with the lock held."""
+        action.finished = monotonic()
+        action.status = status
+        record = action.get_record()
+        self.__records.append(record)
+        self.__counters[status] += 1
+        if status != ACTION_CANCELLED:
+            for key in self.__sums:
+                # Nothing to add if it failed before starting
+                self.__sums[key] += record[key] or 0.0
+        if 'lateness' in record:
+            self.__counters['timed'] += 1
+            self.__lateness['sum'] += record['lateness']
+            self.__lateness['max'] = max(self.__lateness['max'], record['lateness'])
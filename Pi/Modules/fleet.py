@@ -0,0 +1,135 @@
+#  -*- coding: utf-8 -*-
+
+"""
+Modules.fleet
+~~~~~~~~~~~~~
+
+Host a fleet of simulated drones in one process.
+
+Every drone of the fleet shares the event loop, the scheduler of reports, one UDP socket and the peer barrier, so the
+number of threads and sockets does not grow with the number of drones or messages. Vehicles are brought up by a few
+worker threads.
+"""
+
+from collections import deque
+from threading import Condition, Thread
+from Modules.agent_loop import DatagramRouter, get_loop
+from Modules.drone import Drone
+from Modules.telemetry import TelemetrySender
+
+
+class FleetHost(object):
+    """Many Drone instances in one process."""
+
+    def __init__(self, host, port, report_rate=2.0, report_policy=None, workers=4, batch_missions=False,
+                 follow_paths=False, barrier=None, fence_lookahead=0.0, param_cache=None, time_scale=1.0):
+        """
+        Args:
+            host: The host of monitor.
+            port: Base port of monitor.
+            report_rate: Number of MAVC_STAT messages per second of each drone.
+            report_policy: Function returning the report policy of a new drone, or None.
+            workers: Number of vehicles brought up at the same time.
+            batch_missions: Whether drones fly runs of movements in a subtask as one mission.
+            follow_paths: Whether drones fly runs of movements in a subtask continuously in GUIDED mode.
+            barrier: PeerBarrier shared by the drones, or None to synchronize through the monitor.
+            fence_lookahead: Seconds ahead at the current velocity checked against the geofence.
+            param_cache: ParamCache shared by the drones, or None not to cache their parameters.
+            time_scale: Seconds of real time per second of Time of actions, below 1 if simulated faster.
+        """
+        self.__host = host
+        self.__port = port
+        self.__report_rate = report_rate
+        self.__report_policy = report_policy
+        self.__batch_missions = batch_missions
+        self.__follow_paths = follow_paths
+        self.__barrier = barrier
+        self.__fence_lookahead = fence_lookahead
+        self.__param_cache = param_cache
+        self.__time_scale = time_scale
+        self.__loop = get_loop()
+        self.__telemetry = TelemetrySender(max_queue=1024)
+        self.__router = DatagramRouter(self.__loop, self.__telemetry.socket)
+        self.__drones = {}          # Index -> Drone
+        self.__failed = {}          # Index -> error while bringing up
+        self.__pending = deque()    # (index, function returning vehicle)
+        self.__cond = Condition()
+
+        for n in range(workers):
+            worker = Thread(target=self.__bring_up, name='Fleet-Bring-Up-%d' % n)
+            worker.daemon = True
+            worker.start()
+
+    def add(self, index, vehicle):
+        """Connect a vehicle to the monitor as the simulator of index.
+
+        Args:
+            index: Index of simulator, beginning from 1.
+            vehicle: Vehicle connected.
+
+        Returns:
+            Object of Drone.
+        """
+        drone = Drone(vehicle, self.__host, self.__port, index, report_rate=self.__report_rate,
+                      report_policy=self.__report_policy() if self.__report_policy else None,
+                      telemetry=self.__telemetry, router=self.__router, batch_missions=self.__batch_missions,
+                      follow_paths=self.__follow_paths, barrier=self.__barrier,
+                      fence_lookahead=self.__fence_lookahead, param_cache=self.__param_cache,
+                      vehicle_key='fleet-%d' % index, time_scale=self.__time_scale)
+        with self.__cond:
+            self.__drones[index] = drone
+        return drone
+
+    def spawn(self, index, connect):
+        """Bring up a vehicle by a worker and add it to the fleet.
+
+        Args:
+            index: Index of simulator, beginning from 1.
+            connect: Function returning the vehicle connected, it may block for a long time.
+        """
+        with self.__cond:
+            self.__pending.append((index, connect))
+            self.__cond.notify()
+
+    def get_stats(self):
+        """Statistics of the fleet and every drone in it."""
+        with self.__cond:
+            drones = dict(self.__drones)
+            failed = dict(self.__failed)
+            pending = len(self.__pending)
+        stats = {
+            'drones': dict((index, drone.get_stats()) for index, drone in drones.items()),
+            'failed': failed,
+            'pending': pending,
+            'udp': self.__telemetry.get_stats(),
+            'udp_unrouted': self.__router.dropped,
+            'workers': self.__loop.pool.threads
+        }
+        if self.__barrier is not None:
+            stats['barrier'] = self.__barrier.get_stats()
+        return stats
+
+    def close(self):
+        """Close the connections of every drone."""
+        with self.__cond:
+            drones = list(self.__drones.values())
+            self.__pending.clear()
+        for drone in drones:
+            drone.close_connection()
+        self.__telemetry.close()
+
+    def __bring_up(self):
+        while True:
+            with self.__cond:
+                while not self.__pending:
+                    self.__cond.wait()
+                index, connect = self.__pending.popleft()
+            try:
+                vehicle = connect()
+                if vehicle is None:
+                    raise RuntimeError('vehicle not connected')
+                self.add(index, vehicle)
+            except Exception as e:
+                print('Failed to bring up simulator %d: %s' % (index, e))
+                with self.__cond:
+                    self.__failed[index] = str(e)
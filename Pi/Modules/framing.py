@@ -0,0 +1,146 @@
+#  -*- coding: utf-8 -*-
+
+"""
+Modules.framing
+~~~~~~~~~~~~~~~
+
+Split the TCP stream between monitor and drone into MAVC messages.
+
+Two kinds of frame can be mixed in one stream and are told apart by their first byte:
+
+* Length-prefixed: 4-byte unsigned length in network byte order followed by the payload. Since a frame is always
+  shorter than 16MB the first byte is 0, which never begins a JSON string.
+* Delimited: the JSON string of the message followed by the end-string '$$', which is what the Electron monitor
+  sends (see docs/task_file.md).
+"""
+
+import struct
+
+FRAMING_DELIMITED = 0           # Payload followed by the end-string
+FRAMING_LENGTH_PREFIXED = 1     # Length of payload followed by the payload
+
+FRAME_DELIMITER = b'$$'
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 0xFFFFFF       # Keep the first byte of a length-prefixed frame to be zero
+
+
+def encode_frame(payload, framing=FRAMING_LENGTH_PREFIXED):
+    """Wrap the payload of a MAVC message into a frame.
+
+    Args:
+        payload: Bytes of the encoded MAVC message.
+        framing: FRAMING_LENGTH_PREFIXED or FRAMING_DELIMITED.
+
+    Returns:
+        Bytes to be written into the TCP stream.
+    """
+    if framing == FRAMING_DELIMITED:
+        return payload + FRAME_DELIMITER
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ValueError('MAVC message of %d bytes is too long to be framed' % len(payload))
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder(object):
+    """Incremental decoder of the frames received from a TCP stream.
+
+    Data is received straight into a preallocated buffer, every complete frame is split out after each read, and
+    only the bytes of a frame are copied out of the buffer. Partial frames are moved to the front of the buffer when
+    the free space runs out, the buffer grows only if a single frame is larger than it.
+    """
+
+    def __init__(self, size=65536):
+        """
+        Args:
+            size: Initial size of the receiving buffer in bytes.
+        """
+        self.__buf = bytearray(size)
+        self.__view = memoryview(self.__buf)
+        self.__start = 0    # Beginning of data not decoded yet
+        self.__end = 0      # End of data received
+        self.__scan = 0     # Where the search of end-string resumes
+
+    def recv_into(self, sock):
+        """Receive data from the socket into the buffer.
+
+        Args:
+            sock: Connected TCP socket.
+
+        Returns:
+            Number of bytes received, 0 means the connection has been closed by peer.
+        """
+        self.__reserve(1)
+        n = sock.recv_into(self.__view[self.__end:])
+        self.__end += n
+        return n
+
+    def feed(self, data):
+        """Append data which has been received in other ways to the buffer.
+
+        Args:
+            data: Bytes from the stream.
+        """
+        self.__reserve(len(data))
+        self.__buf[self.__end:self.__end + len(data)] = data
+        self.__end += len(data)
+
+    def frames(self):
+        """Split out the complete frames in the buffer.
+
+        Returns:
+            List of payloads in the order they were received.
+        """
+        frames = []
+        while self.__start < self.__end:
+            if self.__buf[self.__start] == 0:
+                # Length-prefixed frame
+                if self.__end - self.__start < FRAME_HEADER.size:
+                    break
+                length = FRAME_HEADER.unpack_from(self.__buf, self.__start)[0]
+                begin = self.__start + FRAME_HEADER.size
+                if self.__end - begin < length:
+                    # Make sure that the whole frame fits into the buffer
+                    self.__reserve(begin + length - self.__end)
+                    break
+                frames.append(bytes(self.__buf[begin:begin + length]))
+                self.__start = begin + length
+            else:
+                # Delimited frame, the end-string may have been split by the last read
+                pos = self.__buf.find(FRAME_DELIMITER, max(self.__start, self.__scan - 1), self.__end)
+                if pos < 0:
+                    self.__scan = self.__end
+                    break
+                frames.append(bytes(self.__buf[self.__start:pos]))
+                self.__start = pos + len(FRAME_DELIMITER)
+            self.__scan = self.__start
+
+        if self.__start == self.__end:
+            # Nothing left, rewind without copying
+            self.__start = self.__end = self.__scan = 0
+        return frames
+
+    def pending(self):
+        """Number of bytes received but not decoded yet."""
+        return self.__end - self.__start
+
+    def __reserve(self, n):
+        """Make sure there are at least n free bytes after the end of data."""
+        if len(self.__buf) - self.__end >= n:
+            return
+        pending = self.__end - self.__start
+        if pending + n > MAX_FRAME_SIZE + FRAME_HEADER.size + 1:
+            raise ValueError('MAVC message of more than %d bytes received' % MAX_FRAME_SIZE)
+        if len(self.__buf) - pending >= n and self.__start > 0:
+            # Move the partial frame to the front
+            self.__buf[0:pending] = self.__buf[self.__start:self.__end]
+        else:
+            size = len(self.__buf)
+            while size - pending < n:
+                size *= 2
+            buf = bytearray(size)
+            buf[0:pending] = self.__buf[self.__start:self.__end]
+            self.__buf = buf
+            self.__view = memoryview(self.__buf)
+        self.__scan -= self.__start
+        self.__start = 0
+        self.__end = pending
@@ -0,0 +1,248 @@
+#  -*- coding: utf-8 -*-
+
+"""
+Modules.geofence
+~~~~~~~~~~~~~~~~
+
+Check the position of a drone against its geofence every time the position is updated.
+
+A geofence is made of circles and polygons, each one either an inclusion fence the drone must stay in or an exclusion
+fence it must stay out of. Fences are projected once into a flat frame in meters with their edges precomputed, and
+indexed by a grid of cells, so a check only looks at the fences around the drone. Given the velocity, the position a
+few seconds ahead is checked as well, so a breach is reported before the drone gets across the border.
+"""
+
+import math
+import time
+from threading import Lock
+from Modules.clock import monotonic
+from Modules.path_follow import LocalFrame
+
+CELL_SIZE = 50.0        # Least size in meters of the cells of the index
+MAX_CELLS = 64          # Most cells along the extent of the fences
+
+
+class Breach(object):
+    """A breach of the geofence."""
+
+    __slots__ = ('time', 'wall_time', 'fence', 'exclusion', 'predicted', 'lat', 'lon')
+
+    def __init__(self, fence, exclusion, predicted, lat, lon):
+        self.time = monotonic()         # For the latency of reaction
+        self.wall_time = time.time()    # For the log
+        self.fence = fence              # Index of the fence in the geofence
+        self.exclusion = exclusion
+        self.predicted = predicted      # Whether the drone is about to breach rather than has breached
+        self.lat = lat
+        self.lon = lon
+
+    def get_record(self):
+        """Dictionary of the breach to be printed or kept in statistics."""
+        return {
+            'Time': self.wall_time,
+            'Fence': self.fence,
+            'Exclusion': self.exclusion,
+            'Predicted': self.predicted,
+            'Lat': self.lat,
+            'Lon': self.lon
+        }
+
+
+class _Circle(object):
+    __slots__ = ('x', 'y', 'r2', 'bounds')
+
+    def __init__(self, x, y, radius):
+        self.x, self.y, self.r2 = x, y, radius * radius
+        self.bounds = (x - radius, y - radius, x + radius, y + radius)
+
+    def contains(self, x, y):
+        return (x - self.x) ** 2 + (y - self.y) ** 2 <= self.r2
+
+
+class _Polygon(object):
+    __slots__ = ('edges', 'bounds')
+
+    def __init__(self, points):
+        # Each edge is (x1, y1, x2, y2, dx/dy) for casting a ray along x
+        self.edges = []
+        for n in range(len(points)):
+            (x1, y1), (x2, y2) = points[n - 1], points[n]
+            if y1 != y2:
+                self.edges.append((x1, y1, x2, y2, (x2 - x1) / (y2 - y1)))
+        xs, ys = [p[0] for p in points], [p[1] for p in points]
+        self.bounds = (min(xs), min(ys), max(xs), max(ys))
+
+    def contains(self, x, y):
+        inside = False
+        for x1, y1, x2, y2, slope in self.edges:
+            if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * slope:
+                inside = not inside
+        return inside
+
+
+class Geofence(object):
+    """Circles and polygons of inclusion and exclusion."""
+
+    def __init__(self, fences, lookahead=0.0):
+        """
+        Args:
+            fences: List of dictionaries, each is either a circle with keys 'Lat', 'Lon' and 'Radius' in meters, or a
+                polygon with key 'Points', a list of [lat, lon]. Key 'Exclusion' tells whether the drone must stay
+                out of it, False by default.
+            lookahead: Seconds ahead at the current velocity to be checked as well, 0 to check the position only.
+        """
+        if not fences:
+            raise ValueError('No fence')
+        self.lookahead = lookahead
+        first = fences[0]
+        origin = first['Points'][0] if 'Points' in first else (first['Lat'], first['Lon'])
+        self.__frame = LocalFrame(origin[0], origin[1])
+        self.__fences = []      # (shape, exclusion)
+        for fence in fences:
+            if 'Points' in fence:
+                shape = _Polygon([self.__project(lat, lon) for lat, lon in fence['Points']])
+            else:
+                x, y = self.__project(fence['Lat'], fence['Lon'])
+                shape = _Circle(x, y, fence['Radius'])
+            self.__fences.append((shape, bool(fence.get('Exclusion', False))))
+        self.__inclusions = sum(1 for shape, exclusion in self.__fences if not exclusion)
+        self.__build_index()
+
+    def check(self, lat, lon, v_north=0.0, v_east=0.0):
+        """Check the position and, given the velocity, the positions ahead.
+
+        Args:
+            lat: Latitude of the drone.
+            lon: Longitude of the drone.
+            v_north: Velocity in m/s to the north.
+            v_east: Velocity in m/s to the east.
+
+        Returns:
+            Breach, None if the drone is within the geofence.
+        """
+        x, y = self.__project(lat, lon)
+        fence = self.__check_point(x, y)
+        if fence is not None:
+            return Breach(fence, self.__fences[fence][1], False, lat, lon)
+        if self.lookahead > 0 and (v_north or v_east):
+            for fraction in (0.5, 1.0):
+                t = self.lookahead * fraction
+                fence = self.__check_point(x + v_north * t, y + v_east * t)
+                if fence is not None:
+                    return Breach(fence, self.__fences[fence][1], True, lat, lon)
+        return None
+
+    def __project(self, lat, lon):
+        north, east, down = self.__frame.to_local({'lat': lat, 'lon': lon, 'alt': 0.0})
+        return north, east
+
+    def __check_point(self, x, y):
+        """Index of a fence breached at the point, None if there's none."""
+        candidates = self.__cells.get((int(math.floor(x / self.__cell)), int(math.floor(y / self.__cell))), ())
+        inclusions = 0
+        for n in candidates:
+            shape, exclusion = self.__fences[n]
+            min_x, min_y, max_x, max_y = shape.bounds
+            within = min_x <= x <= max_x and min_y <= y <= max_y and shape.contains(x, y)
+            if exclusion:
+                if within:
+                    return n
+            elif not within:
+                return n
+            else:
+                inclusions += 1
+        if inclusions < self.__inclusions:
+            # Out of the bounds of an inclusion fence
+            for n, (shape, exclusion) in enumerate(self.__fences):
+                if not exclusion and n not in candidates:
+                    return n
+        return None
+
+    def __build_index(self):
+        """Grid of cells, each lists the fences whose bounds overlap it."""
+        bounds = [shape.bounds for shape, exclusion in self.__fences]
+        extent = max(max(b[2] for b in bounds) - min(b[0] for b in bounds),
+                     max(b[3] for b in bounds) - min(b[1] for b in bounds))
+        self.__cell = max(CELL_SIZE, extent / MAX_CELLS)
+        self.__cells = {}
+        for n, (min_x, min_y, max_x, max_y) in enumerate(bounds):
+            for i in range(int(math.floor(min_x / self.__cell)), int(math.floor(max_x / self.__cell)) + 1):
+                for j in range(int(math.floor(min_y / self.__cell)), int(math.floor(max_y / self.__cell)) + 1):
+                    self.__cells.setdefault((i, j), []).append(n)
+        for key in self.__cells:
+            self.__cells[key] = tuple(self.__cells[key])
+
+
+def parse_geofence(body, lookahead=0.0):
+    """Geofence of the body of MAVC_SET_GEOFENCE.
+
+    Args:
+        body: Either one circle to stay in with keys 'Lat', 'Lon' and 'Radius', or a dictionary with key 'Fences' and
+            optionally 'Lookahead' in seconds.
+        lookahead: Seconds ahead to be checked unless the message tells.
+
+    Returns:
+        Geofence.
+    """
+    if 'Fences' in body:
+        return Geofence(body['Fences'], body.get('Lookahead', lookahead))
+    return Geofence([body], lookahead)
+
+
+class GeofenceMonitor(object):
+    """Check every position update of a drone against its geofence and call back once on each breach.
+
+    After a breach nothing is reported again until the drone is back within the geofence.
+    """
+
+    def __init__(self, on_breach):
+        """
+        Args:
+            on_breach: Function called with the Breach, it should return at once.
+        """
+        self.__on_breach = on_breach
+        self.__geofence = None
+        self.__breached = False
+        self.__lock = Lock()
+        self.__stats = {
+            'checks': 0,            # Positions checked
+            'check_total': 0.0,     # Seconds spent checking
+            'breaches': 0,
+            'predicted': 0,         # Breaches reported ahead of the drone getting across the border
+            'last_breach': None
+        }
+
+    def set_geofence(self, geofence):
+        """Replace the geofence, None to remove it."""
+        with self.__lock:
+            self.__geofence = geofence
+            self.__breached = False
+
+    def update(self, lat, lon, v_north=0.0, v_east=0.0):
+        """Check the position of the drone, called on every update of it."""
+        geofence = self.__geofence
+        if geofence is None or lat is None or lon is None:
+            return
+        start = monotonic()
+        breach = geofence.check(lat, lon, v_north or 0.0, v_east or 0.0)
+        with self.__lock:
+            self.__stats['checks'] += 1
+            self.__stats['check_total'] += monotonic() - start
+            if breach is None:
+                self.__breached = False
+                return
+            if self.__breached:
+                return
+            self.__breached = True
+            self.__stats['breaches'] += 1
+            if breach.predicted:
+                self.__stats['predicted'] += 1
+            self.__stats['last_breach'] = breach.get_record()
+        self.__on_breach(breach)
+
+    def get_stats(self):
+        """Counters and the mean time of a check."""
+        with self.__lock:
+            stats = dict(self.__stats)
+        stats['check_mean'] = stats['check_total'] / stats['checks'] if stats['checks'] else None
+        return stats
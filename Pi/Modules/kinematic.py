@@ -0,0 +1,445 @@
+#  -*- coding: utf-8 -*-
+
+"""
+Modules.kinematic
+~~~~~~~~~~~~~~~~~
+
+Kinematic stand-in for the DroneKit Vehicle, so that many agents can be run in one process without ArduPilot SITL.
+
+Only what the agent uses is implemented: the location, velocity, mode, armed state, takeoff, goto, ground speed,
+parameters, missions uploaded through commands, velocity setpoints and the attribute and message listeners. Vehicles
+fly straight at a constant speed towards their targets. Every vehicle of a KinematicWorld is moved by one thread, and
+the world may run faster than real time.
+"""
+
+import math
+import sys
+import time
+import traceback
+from collections import deque
+from threading import Lock, Thread
+from Modules.clock import monotonic
+from Modules.mission import EARTH_RADIUS, MAV_CMD_NAV_WAYPOINT, offset_position
+
+try:
+    from dronekit import LocationGlobal, LocationGlobalRelative
+except ImportError:
+    # Only the attributes are needed without DroneKit
+    class LocationGlobal(object):
+        def __init__(self, lat, lon, alt=None):
+            self.lat, self.lon, self.alt = lat, lon, alt
+
+    class LocationGlobalRelative(LocationGlobal):
+        pass
+
+CRUISE_SPEED = 5.0          # Default horizontal speed in m/s, WPNAV_SPEED of ArduCopter
+CLIMB_SPEED = 2.5           # Vertical speed in m/s of takeoff and altitude changes
+LAND_SPEED = 1.0            # Vertical speed in m/s of landing
+WAYPOINT_RADIUS = 2.0       # Distance in meters at which a waypoint of mission is reached, WPNAV_RADIUS
+VELOCITY_TIMEOUT = 3.0      # Seconds a velocity setpoint is followed, as ArduCopter stops without new ones
+RTL_ALT = 15.0              # Least altitude to return to launch at
+
+
+class KinematicWorld(object):
+    """Clock and thread moving every kinematic vehicle."""
+
+    def __init__(self, speedup=1.0, rate=10.0):
+        """
+        Args:
+            speedup: Seconds of simulation per second of real time.
+            rate: Number of times per second (of real time) vehicles are moved and report their location.
+        """
+        self.speedup = speedup
+        self.__period = 1.0 / rate
+        self.__vehicles = []
+        self.__lock = Lock()
+        self.__closed = False
+        self.__started = monotonic()
+        self.__steps = 0
+        self.__overruns = 0     # Steps which took longer than the period
+
+        worker = Thread(target=self.__run, name='Kinematic-World')
+        worker.daemon = True
+        worker.start()
+
+    def now(self):
+        """Seconds of simulation since the world started."""
+        return (monotonic() - self.__started) * self.speedup
+
+    def add(self, vehicle):
+        with self.__lock:
+            self.__vehicles.append(vehicle)
+
+    def remove(self, vehicle):
+        with self.__lock:
+            if vehicle in self.__vehicles:
+                self.__vehicles.remove(vehicle)
+
+    def close(self):
+        self.__closed = True
+
+    def get_stats(self):
+        """Number of vehicles and steps, and the steps overrunning the period."""
+        with self.__lock:
+            return {'vehicles': len(self.__vehicles), 'steps': self.__steps, 'overruns': self.__overruns,
+                    'speedup': self.speedup}
+
+    def __run(self):
+        last = self.now()
+        deadline = monotonic()
+        while not self.__closed:
+            deadline += self.__period
+            delay = deadline - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            now = self.now()
+            dt, last = now - last, now
+            with self.__lock:
+                vehicles = list(self.__vehicles)
+                self.__steps += 1
+            for vehicle in vehicles:
+                try:
+                    vehicle.step(now, dt)
+                except Exception:
+                    traceback.print_exc(file=sys.stderr)
+            if monotonic() > deadline + self.__period:
+                # Too many vehicles for the rate, don't try to catch up
+                with self.__lock:
+                    self.__overruns += 1
+                deadline = monotonic()
+
+
+class VehicleMode(object):
+    """Flight mode with the name only."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, other):
+        return getattr(other, 'name', other) == self.name
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+class KinematicVehicle(object):
+    """Vehicle flying straight towards its targets at a constant speed."""
+
+    def __init__(self, world, lat, lon, alt=0.0, home_alt=584.0, parameters=None):
+        """
+        Args:
+            world: KinematicWorld moving the vehicle.
+            lat: Latitude of home.
+            lon: Longitude of home.
+            alt: Altitude above home to start at.
+            home_alt: Altitude of home above sea level.
+            parameters: Dictionary of initial parameters.
+        """
+        self.__world = world
+        self.__lock = Lock()
+        self.__home = (lat, lon, home_alt)
+        self.__lat, self.__lon, self.__alt = lat, lon, alt
+        self.__velocity = [0.0, 0.0, 0.0]
+        self.__mode = 'STABILIZE'
+        self.__armed = False
+        self.__arming = False
+        self.__cruise_speed = CRUISE_SPEED
+        self.__target = None            # (lat, lon, alt) flown to in GUIDED or RTL
+        self.__setpoint = None          # (v_north, v_east, v_down, expiry) in GUIDED
+        self.__mission = []             # (lat, lon, alt) of items 1 to n
+        self.__mission_seq = 0          # Item flown to in AUTO, 0 before starting
+        self.__attribute_listeners = {}
+        self.__message_listeners = {}
+        self.__events = deque()         # Attributes and messages to be notified by the world thread
+        self.parameters = dict(parameters or {})
+        self.commands = _Commands(self)
+        self.message_factory = _MessageFactory()
+        world.add(self)
+
+    @property
+    def location(self):
+        with self.__lock:
+            return _Locations(LocationGlobalRelative(self.__lat, self.__lon, self.__alt),
+                              LocationGlobal(self.__lat, self.__lon, self.__alt + self.__home[2]))
+
+    @property
+    def home_location(self):
+        return LocationGlobal(*self.__home)
+
+    @property
+    def velocity(self):
+        with self.__lock:
+            return list(self.__velocity)
+
+    @property
+    def groundspeed(self):
+        with self.__lock:
+            return math.sqrt(self.__velocity[0] ** 2 + self.__velocity[1] ** 2)
+
+    @groundspeed.setter
+    def groundspeed(self, speed):
+        with self.__lock:
+            self.__cruise_speed = speed
+
+    @property
+    def airspeed(self):
+        return self.groundspeed
+
+    @property
+    def mode(self):
+        return VehicleMode(self.__mode)
+
+    @mode.setter
+    def mode(self, mode):
+        name = getattr(mode, 'name', mode)
+        with self.__lock:
+            self.__set_mode(name)
+
+    @property
+    def armed(self):
+        return self.__armed
+
+    @armed.setter
+    def armed(self, armed):
+        with self.__lock:
+            if armed and not self.__armed:
+                # Armed on the next step, as ArduPilot replies some time later
+                self.__arming = True
+            elif not armed and self.__alt <= 0.1:
+                self.__armed = False
+                self.__events.append(('armed', False))
+
+    @property
+    def is_armable(self):
+        return True
+
+    def simple_takeoff(self, alt):
+        with self.__lock:
+            if self.__armed and self.__mode == 'GUIDED':
+                self.__target = (self.__lat, self.__lon, alt)
+                self.__setpoint = None
+
+    def simple_goto(self, location, airspeed=None, groundspeed=None):
+        with self.__lock:
+            if self.__mode != 'GUIDED' or not self.__armed:
+                return
+            alt = location.alt if location.alt is not None else self.__alt
+            self.__target = (location.lat, location.lon, alt)
+            self.__setpoint = None
+            if groundspeed:
+                self.__cruise_speed = groundspeed
+
+    def send_mavlink(self, message):
+        """Handle the messages built by message_factory."""
+        mtype = message.get_type()
+        with self.__lock:
+            if mtype == 'PARAM_SET':
+                self.parameters[message.param_id] = message.param_value
+                self.__events.append(('PARAM_VALUE', _param_value(message.param_id, message.param_value)))
+            elif mtype == 'PARAM_REQUEST_READ':
+                if message.param_id in self.parameters:
+                    value = self.parameters[message.param_id]
+                    self.__events.append(('PARAM_VALUE', _param_value(message.param_id, value)))
+            elif mtype == 'SET_POSITION_TARGET_LOCAL_NED' and self.__mode == 'GUIDED' and self.__armed:
+                self.__target = None
+                self.__setpoint = (message.vx, message.vy, message.vz, self.__world.now() + VELOCITY_TIMEOUT)
+
+    def add_attribute_listener(self, name, fn):
+        with self.__lock:
+            self.__attribute_listeners.setdefault(name, []).append(fn)
+
+    def remove_attribute_listener(self, name, fn):
+        with self.__lock:
+            listeners = self.__attribute_listeners.get(name, [])
+            if fn in listeners:
+                listeners.remove(fn)
+
+    def add_message_listener(self, name, fn):
+        with self.__lock:
+            self.__message_listeners.setdefault(name, []).append(fn)
+
+    def remove_message_listener(self, name, fn):
+        with self.__lock:
+            listeners = self.__message_listeners.get(name, [])
+            if fn in listeners:
+                listeners.remove(fn)
+
+    def close(self):
+        self.__world.remove(self)
+
+    def step(self, now, dt):
+        """Move the vehicle by dt seconds of simulation and notify the listeners, called by the world."""
+        with self.__lock:
+            if self.__arming:
+                self.__arming = False
+                self.__armed = True
+                self.__events.append(('armed', True))
+            if self.__armed:
+                self.__move(now, dt)
+            location = LocationGlobalRelative(self.__lat, self.__lon, self.__alt)
+            self.__events.append(('location.global_relative_frame', location))
+            self.__events.append(('velocity', list(self.__velocity)))
+            events = list(self.__events)
+            self.__events.clear()
+            attribute_listeners = dict((name, list(fns)) for name, fns in self.__attribute_listeners.items())
+            message_listeners = dict((name, list(fns)) for name, fns in self.__message_listeners.items())
+
+        for name, value in events:
+            for fn in attribute_listeners.get(name, ()):
+                fn(self, name, value)
+            for fn in message_listeners.get(name, ()):
+                fn(self, name, value)
+
+    def __set_mode(self, name):
+        if name == self.__mode:
+            return
+        self.__mode = name
+        self.__setpoint = None
+        if name == 'GUIDED':
+            self.__target = None
+        elif name == 'AUTO':
+            self.__mission_seq = 1 if self.__mission else 0
+        elif name == 'RTL':
+            self.__target = (self.__home[0], self.__home[1], max(self.__alt, RTL_ALT))
+        self.__events.append(('mode', VehicleMode(name)))
+
+    def __move(self, now, dt):
+        """Move towards the target of the mode."""
+        mode = self.__mode
+        if mode == 'LAND' or (mode == 'RTL' and self.__target is None):
+            self.__fly(None, None, 0.0, dt, vertical_speed=LAND_SPEED)
+        elif mode == 'AUTO':
+            remaining = dt
+            while 0 < self.__mission_seq <= len(self.__mission) and remaining > 0:
+                lat, lon, alt = self.__mission[self.__mission_seq - 1]
+                remaining = self.__fly(lat, lon, alt, remaining)
+                if self.__distance_to(lat, lon) <= WAYPOINT_RADIUS and abs(self.__alt - alt) <= 0.5:
+                    self.__events.append(('MISSION_ITEM_REACHED', _mission_item_reached(self.__mission_seq)))
+                    self.__mission_seq += 1
+            if not 0 < self.__mission_seq <= len(self.__mission):
+                self.__velocity = [0.0, 0.0, 0.0]
+        elif mode == 'GUIDED' and self.__setpoint is not None:
+            v_north, v_east, v_down, expiry = self.__setpoint
+            if now >= expiry:
+                self.__setpoint = None
+                self.__velocity = [0.0, 0.0, 0.0]
+                return
+            self.__lat, self.__lon = offset_position(self.__lat, self.__lon, v_north * dt, v_east * dt)
+            self.__alt = max(0.0, self.__alt - v_down * dt)
+            self.__velocity = [v_north, v_east, v_down]
+        elif self.__target is not None:
+            lat, lon, alt = self.__target
+            self.__fly(lat, lon, alt, dt)
+            if mode == 'RTL' and self.__distance_to(lat, lon) < 0.1:
+                self.__target = None    # Land at home
+        else:
+            self.__velocity = [0.0, 0.0, 0.0]
+
+        if self.__alt <= 0.0 and mode in ('LAND', 'RTL') and self.__armed:
+            self.__armed = False
+            self.__events.append(('armed', False))
+
+    def __fly(self, lat, lon, alt, dt, vertical_speed=CLIMB_SPEED):
+        """Fly straight towards the position, None to stay over the current one.
+
+        Returns:
+            Seconds left of dt once the position has been reached.
+        """
+        d_north, d_east = (0.0, 0.0) if lat is None else self.__delta_to(lat, lon)
+        distance = math.sqrt(d_north ** 2 + d_east ** 2)
+        d_alt = alt - self.__alt
+        horizontal_time = distance / self.__cruise_speed if self.__cruise_speed > 0 else 0.0
+        vertical_time = abs(d_alt) / vertical_speed
+        needed = max(horizontal_time, vertical_time)
+        if needed <= dt:
+            if lat is not None:
+                self.__lat, self.__lon = lat, lon
+            self.__alt = alt
+            self.__velocity = [0.0, 0.0, 0.0]
+            return dt - needed
+        ratio = dt / needed
+        self.__lat, self.__lon = offset_position(self.__lat, self.__lon, d_north * ratio, d_east * ratio)
+        self.__alt += d_alt * ratio
+        self.__velocity = [d_north / needed, d_east / needed, -d_alt / needed]
+        return 0.0
+
+    def __delta_to(self, lat, lon):
+        d_north = (lat - self.__lat) * math.pi / 180 * EARTH_RADIUS
+        d_east = (lon - self.__lon) * math.pi / 180 * EARTH_RADIUS * math.cos(math.pi * self.__lat / 180)
+        return d_north, d_east
+
+    def __distance_to(self, lat, lon):
+        d_north, d_east = self.__delta_to(lat, lon)
+        return math.sqrt(d_north ** 2 + d_east ** 2)
+
+    def _upload_mission(self, items):
+        """Replace the mission, called by commands.upload()."""
+        with self.__lock:
+            self.__mission = [(item.x, item.y, item.z) for item in items if item.command == MAV_CMD_NAV_WAYPOINT]
+            self.__mission_seq = 0
+
+
+class _Locations(object):
+    __slots__ = ('global_relative_frame', 'global_frame')
+
+    def __init__(self, global_relative_frame, global_frame):
+        self.global_relative_frame = global_relative_frame
+        self.global_frame = global_frame
+
+
+class _Commands(object):
+    """Mission items to be uploaded, as vehicle.commands of DroneKit."""
+
+    def __init__(self, vehicle):
+        self.__vehicle = vehicle
+        self.__items = []
+
+    def clear(self):
+        self.__items = []
+
+    def add(self, command):
+        self.__items.append(command)
+
+    def upload(self, timeout=None):
+        self.__vehicle._upload_mission(self.__items)
+
+    @property
+    def count(self):
+        return len(self.__items)
+
+
+class _Message(object):
+    """MAVLink message with the fields used by the vehicle."""
+
+    def __init__(self, mtype, **fields):
+        self.__type = mtype
+        self.__dict__.update(fields)
+
+    def get_type(self):
+        return self.__type
+
+
+class _MessageFactory(object):
+    """Encoders of the messages sent by the agent, as vehicle.message_factory of DroneKit."""
+
+    @staticmethod
+    def param_set_encode(target_system, target_component, param_id, param_value, param_type):
+        return _Message('PARAM_SET', param_id=param_id, param_value=float(param_value))
+
+    @staticmethod
+    def param_request_read_encode(target_system, target_component, param_id, param_index):
+        return _Message('PARAM_REQUEST_READ', param_id=param_id)
+
+    @staticmethod
+    def set_position_target_local_ned_encode(time_boot_ms, target_system, target_component, coordinate_frame,
+                                             type_mask, x, y, z, vx, vy, vz, afx, afy, afz, yaw, yaw_rate):
+        return _Message('SET_POSITION_TARGET_LOCAL_NED', vx=vx, vy=vy, vz=vz)
+
+
+def _param_value(name, value):
+    return _Message('PARAM_VALUE', param_id=name, param_value=float(value))
+
+
+def _mission_item_reached(seq):
+    return _Message('MISSION_ITEM_REACHED', seq=seq)
+
@@ -0,0 +1,154 @@
+#  -*- coding: utf-8 -*-
+
+"""
+Modules.launcher
+~~~~~~~~~~~~~~~~
+
+Launch simulators of a fleet concurrently.
+
+The firmware is downloaded once for every simulator. Each simulator gets an instance number whose ports are free,
+instead of the index of the drone, and is taken as ready once it says it is waiting for the connection, within a
+timeout. The time taken by every stage of bringing up a vehicle is kept, so that a slow fleet can be told apart.
+"""
+
+import socket
+from threading import Lock
+from dronekit_sitl import SITL
+from Modules.clock import monotonic
+from Modules.drone_controller import connect_vehicle
+
+BASE_PORT = 5760        # TCP port of SERIAL0 of instance 0
+PORT_STRIDE = 10        # Every instance uses BASE_PORT + PORT_STRIDE * instance and the ports after it
+PORTS_PER_INSTANCE = 4  # SERIAL0 to SERIAL3
+
+_READY_MARKS = ('Waiting for connection', 'Ready to FLY')
+
+
+class SitlLauncher(object):
+    """Simulators of one firmware launched by many threads at the same time."""
+
+    def __init__(self, system='copter', version='3.3', model='quad', timeout=60.0):
+        """
+        Args:
+            system: Vehicle system of the firmware.
+            version: Version of the firmware.
+            model: Frame of the simulated vehicle.
+            timeout: Seconds to wait for a simulator to be ready and then for its heartbeat.
+        """
+        self.__system = system
+        self.__version = version
+        self.__model = model
+        self.__timeout = timeout
+        self.__path = None          # Firmware downloaded
+        self.__lock = Lock()
+        self.__download_lock = Lock()
+        self.__instances = set()    # Instance numbers in use
+        self.__sitls = {}           # Key -> SITL
+        self.__timings = {}         # Key -> seconds of each stage
+
+    def prepare(self):
+        """Download the firmware unless it has been, called by the first simulator otherwise."""
+        with self.__download_lock:
+            if self.__path is None:
+                start = monotonic()
+                sitl = SITL()
+                sitl.download(self.__system, self.__version, verbose=True)
+                self.__path = sitl.path
+                print('Firmware %s-%s ready in %.2fs' % (self.__system, self.__version, monotonic() - start))
+            return self.__path
+
+    def start_vehicle(self, key, lat, lon, alt=584, heading=353):
+        """Launch a simulator and connect to it.
+
+        Args:
+            key: Key of the simulator in the statistics, e.g. the index of the drone.
+            lat: Latitude of home.
+            lon: Longitude of home.
+            alt: Altitude of home.
+            heading: Heading of the vehicle at home.
+
+        Returns:
+            Vehicle connected, None if the simulator is not ready or does not reply in time.
+        """
+        path = self.prepare()
+        instance = self.__allocate()
+        start = monotonic()
+        sitl = SITL(path=path)
+        with self.__lock:
+            self.__sitls[key] = sitl
+            self.__timings[key] = {'instance': instance, 'spawn': None, 'heartbeat': None}
+        sitl.launch(['-I%d' % instance, '--model', self.__model, '--home=%f,%f,%d,%d' % (lat, lon, alt, heading)],
+                    await_ready=False)
+        if not self.__wait_ready(sitl, start + self.__timeout):
+            print('Simulator %s is not ready in %.0fs' % (key, self.__timeout))
+            self.stop(key)
+            return None
+        spawned = monotonic()
+
+        vehicle = connect_vehicle('tcp:127.0.0.1:%d' % (BASE_PORT + PORT_STRIDE * instance),
+                                  heartbeat_timeout=self.__timeout)
+        with self.__lock:
+            self.__timings[key]['spawn'] = spawned - start
+            if vehicle is not None:
+                self.__timings[key]['heartbeat'] = monotonic() - spawned
+        if vehicle is None:
+            self.stop(key)
+        return vehicle
+
+    def stop(self, key):
+        """Stop the simulator and release its instance number."""
+        with self.__lock:
+            sitl = self.__sitls.pop(key, None)
+            timings = self.__timings.get(key)
+        if sitl is None:
+            return
+        try:
+            sitl.stop()
+        finally:
+            with self.__lock:
+                self.__instances.discard(timings['instance'])
+
+    def stop_all(self):
+        """Stop every simulator."""
+        with self.__lock:
+            keys = list(self.__sitls)
+        for key in keys:
+            self.stop(key)
+
+    def get_stats(self):
+        """Seconds taken by each stage of bringing up every simulator."""
+        with self.__lock:
+            return dict((key, dict(timings)) for key, timings in self.__timings.items())
+
+    def __allocate(self):
+        """Least instance number whose ports are free."""
+        with self.__lock:
+            instance = 0
+            while instance in self.__instances or not _ports_free(BASE_PORT + PORT_STRIDE * instance):
+                instance += 1
+            self.__instances.add(instance)
+            return instance
+
+    @staticmethod
+    def __wait_ready(sitl, deadline):
+        """Wait for the simulator to say it is ready, False if it exits or the deadline passes."""
+        while monotonic() < deadline:
+            if sitl.poll() is not None:
+                return False
+            line = sitl.stdout.readline(0.01)
+            if line and any(mark in line for mark in _READY_MARKS):
+                return True
+        return False
+
+
+def _ports_free(first_port):
+    """Whether the ports of an instance beginning from the one can be listened on."""
+    for port in range(first_port, first_port + PORTS_PER_INSTANCE):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.bind(('127.0.0.1', port))
+        except socket.error:
+            return False
+        finally:
+            sock.close()
+    return True
@@ -0,0 +1,93 @@
+#  -*- coding: utf-8 -*-
+
+"""
+Modules.mission
+~~~~~~~~~~~~~~~
+
+Compile the movements of a subtask into one mission flown in AUTO mode.
+
+In GUIDED mode the drone comes to a stop at every target before it is given the next one. A run of GO_BY and GO_TO
+actions received in one MAVC_ACTION message can instead be uploaded at once as a mission, so the drone flies through
+the waypoints without stopping, and MISSION_ITEM_REACHED of the last waypoint tells that the run has been done.
+
+Only the start of a run can be scheduled, so a movement with a Time begins a run of its own and is started at that
+Time like a single action.
+"""
+
+import math
+
+# Action types which can be compiled into waypoints
+ACTION_GO_TO = 1
+ACTION_GO_BY = 2
+MOVEMENTS = (ACTION_GO_TO, ACTION_GO_BY)
+
+# MAVLink definitions used by missions
+MAV_CMD_NAV_WAYPOINT = 16
+MAV_FRAME_GLOBAL_RELATIVE_ALT = 3
+
+MIN_WAYPOINTS = 2   # A shorter run is not worth a mission
+
+EARTH_RADIUS = 6378137.0    # Radius of "spherical" earth
+
+
+def plan_actions(actions, min_waypoints=MIN_WAYPOINTS):
+    """Group the actions of one drone into runs of movements and single actions.
+
+    Args:
+        actions: Actions of one drone in a subtask, in order.
+        min_waypoints: Least number of movements in a run to be flown as a mission.
+
+    Returns:
+        List of tuples (is_mission, actions), each is either a run of movements to be flown as one mission or a
+        single action to be performed on its own. Every movement with a Time is the first one of its run.
+    """
+    plan = []
+    run = []
+    for action in actions + [None]:
+        is_movement = action is not None and action['Action_type'] in MOVEMENTS
+        if is_movement and not (run and action.get('Time')):
+            run.append(action)
+            continue
+        if len(run) >= min_waypoints:
+            plan.append((True, run))
+        else:
+            plan.extend((False, [movement]) for movement in run)
+        run = []
+        if is_movement:
+            # The run is started at the Time of its first movement only
+            run.append(action)
+        elif action is not None:
+            plan.append((False, [action]))
+    return plan
+
+
+def compile_waypoints(actions, origin):
+    """Positions of the movements, each one relative to where the previous one leaves the drone.
+
+    Args:
+        actions: GO_BY and GO_TO actions.
+        origin: Dictionary of the position where the run begins, with keys 'lat', 'lon' and 'alt'.
+
+    Returns:
+        List of dictionaries with keys 'lat', 'lon' and 'alt' (relative to home).
+    """
+    waypoints = []
+    lat, lon, alt = origin['lat'], origin['lon'], origin['alt']
+    for action in actions:
+        if action['Action_type'] == ACTION_GO_TO:
+            lat, lon = action['Lat'], action['Lon']
+        else:
+            lat, lon = offset_position(lat, lon, action['N'], action['E'])
+        alt = action.get('Alt', alt)
+        waypoints.append({'lat': lat, 'lon': lon, 'alt': alt})
+    return waypoints
+
+
+def offset_position(lat, lon, d_north, d_east):
+    """Latitude and longitude d_north and d_east metres from the position.
+
+    The algorithm is relatively accurate over small distances (10m within 1km) except close to the poles.
+    """
+    d_lat = d_north / EARTH_RADIUS
+    d_lon = d_east / (EARTH_RADIUS * math.cos(math.pi * lat / 180))
+    return lat + (d_lat * 180 / math.pi), lon + (d_lon * 180 / math.pi)
@@ -0,0 +1,181 @@
+#  -*- coding: utf-8 -*-
+
+"""
+Modules.params
+~~~~~~~~~~~~~~
+
+Make sure the parameters required by the agent are set on the vehicle, without blocking on a lost acknowledgement.
+
+Every parameter is sent at once, each PARAM_VALUE received acknowledges the one of its name, and those not
+acknowledged in time are resent a few times before giving up. The parameters seen are cached on disk for each vehicle,
+so on later boots the parameters already set are only read back to be confirmed instead of being set again.
+"""
+
+import json
+import os
+from threading import Condition
+from Modules.clock import monotonic
+
+# Parameters every agent requires
+REQUIRED_PARAMETERS = {
+    'FS_BATT_ENABLE': 2,    # Battery failsafe: return to launch
+    'MIS_RESTART': 1        # Restart mission when switch to AUTO again
+}
+
+
+class ParamCache(object):
+    """Parameter tables of vehicles in a JSON file."""
+
+    def __init__(self, path):
+        """
+        Args:
+            path: Path of the file, created if it does not exist.
+        """
+        self.__path = path
+
+    def load(self, key):
+        """Parameter table of the vehicle, empty if unknown."""
+        try:
+            with open(self.__path, 'r') as cache_file:
+                return json.load(cache_file).get(key, {})
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save(self, key, table):
+        """Replace the parameter table of the vehicle."""
+        try:
+            with open(self.__path, 'r') as cache_file:
+                tables = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            tables = {}
+        tables[key] = table
+        temp_path = self.__path + '.tmp'
+        try:
+            with open(temp_path, 'w') as cache_file:
+                json.dump(tables, cache_file, sort_keys=True)
+            os.rename(temp_path, self.__path)
+        except (IOError, OSError) as e:
+            print('Failed to save parameters to %s: %s' % (self.__path, e))
+
+
+class ParamSync(object):
+    """Set parameters of one vehicle and wait for their acknowledgements."""
+
+    def __init__(self, send_set, send_read, cache=None, key=None, timeout=1.0, retries=3):
+        """
+        Args:
+            send_set: Function sending PARAM_SET of the name and value.
+            send_read: Function sending PARAM_REQUEST_READ of the name.
+            cache: ParamCache, or None not to cache the parameters.
+            key: Key of the vehicle in the cache.
+            timeout: Seconds to wait for PARAM_VALUE before resending.
+            retries: Times a parameter is resent before giving up.
+        """
+        self.__send_set = send_set
+        self.__send_read = send_read
+        self.__cache = cache
+        self.__key = key
+        self.__timeout = timeout
+        self.__retries = retries
+        self.__table = cache.load(key) if cache is not None else {}     # Name -> value known
+        self.__changed = False      # Whether the table differs from the cache
+        self.__cond = Condition()
+        self.__stats = {
+            'set': 0,               # PARAM_SET sent
+            'read': 0,              # PARAM_REQUEST_READ sent, for parameters the cache says are set already
+            'resent': 0,            # Requests resent as PARAM_VALUE was not received in time
+            'acked': 0,             # Parameters confirmed
+            'failed': 0,            # Parameters given up
+            'received': 0,          # PARAM_VALUE received
+            'ready_time': None      # Seconds taken by the latest apply()
+        }
+
+    def on_param_value(self, name, value):
+        """Feed a PARAM_VALUE received from the vehicle."""
+        with self.__cond:
+            self.__stats['received'] += 1
+            if self.__table.get(name) != value:
+                self.__table[name] = value
+                self.__changed = True
+            self.__cond.notify_all()
+
+    def apply(self, required, cancel=None):
+        """Set the parameters on the vehicle and wait until every one is confirmed or given up.
+
+        Args:
+            required: Dictionary of parameter names and values.
+            cancel: threading.Event to stop waiting.
+
+        Returns:
+            List of names of the parameters not confirmed.
+        """
+        start = monotonic()
+        with self.__cond:
+            # Those the cache says are set already are only read back
+            pending = dict((name, [None, 0, _equal(self.__table.get(name), value)])
+                           for name, value in required.items())     # Name -> [time sent, tries, read only]
+            for name in pending:
+                self.__table.pop(name, None)    # Wait for a fresh PARAM_VALUE
+
+        failed = []
+        while pending:
+            to_send = []
+            with self.__cond:
+                now = monotonic()
+                for name, entry in list(pending.items()):
+                    value = self.__table.get(name)
+                    if value is not None and _equal(value, required[name]):
+                        del pending[name]
+                        self.__stats['acked'] += 1
+                    elif value is not None and entry[2]:
+                        # Differs from the cache, set it
+                        entry[0], entry[1], entry[2] = None, 0, False
+                        del self.__table[name]
+                        to_send.append(name)
+                    elif entry[0] is None or now - entry[0] >= self.__timeout:
+                        if entry[1] > self.__retries:
+                            del pending[name]
+                            failed.append(name)
+                            self.__stats['failed'] += 1
+                        else:
+                            to_send.append(name)
+                if not to_send and pending:
+                    if cancel is not None and cancel.is_set():
+                        failed.extend(pending)
+                        break
+                    next_timeout = min(entry[0] for entry in pending.values()) + self.__timeout
+                    self.__cond.wait(max(0.0, min(next_timeout - now, 0.25)))
+                    continue
+                for name in to_send:
+                    entry = pending[name]
+                    if entry[1] > 0:
+                        self.__stats['resent'] += 1
+                    self.__stats['read' if entry[2] else 'set'] += 1
+                    entry[0] = now
+                    entry[1] += 1
+            # Send out of the lock, PARAM_VALUE may be handled in the thread sending
+            for name in to_send:
+                if pending[name][2]:
+                    self.__send_read(name)
+                else:
+                    self.__send_set(name, required[name])
+
+        with self.__cond:
+            self.__stats['ready_time'] = monotonic() - start
+            changed, self.__changed = self.__changed, False
+            table = dict(self.__table)
+        if changed and self.__cache is not None:
+            self.__cache.save(self.__key, table)
+        return failed
+
+    def get_stats(self):
+        """Counters and the time taken to get the parameters ready."""
+        with self.__cond:
+            return dict(self.__stats)
+
+
+def _equal(value, expected):
+    """Whether the value of a parameter, sent as a 32-bit float, equals the one expected."""
+    if value is None:
+        return False
+    return abs(value - expected) <= 1.0e-5 * max(1.0, abs(expected))
@@ -0,0 +1,138 @@
+#  -*- coding: utf-8 -*-
+
+"""
+Modules.path_follow
+~~~~~~~~~~~~~~~~~~~
+
+Follow the polyline of consecutive movements continuously by streaming velocity setpoints.
+
+Instead of stopping at every target, the drone heads for a point a lookahead distance ahead along the path (pure
+pursuit), so corners are blended into curves and the whole polyline is flown at the task speed. The drone slows
+down only when approaching the end of the path.
+"""
+
+import math
+
+# MAVLink definitions of SET_POSITION_TARGET_LOCAL_NED
+MAV_FRAME_LOCAL_NED = 1
+VELOCITY_TYPE_MASK = 0x0DC7     # Ignore position, acceleration and yaw, use velocity only
+
+EARTH_RADIUS = 6378137.0        # Radius of "spherical" earth
+
+
+class PathSettings(object):
+    """How a path is followed."""
+
+    def __init__(self, speed=4.0, lookahead=3.0, rate=10.0, radius=1.0):
+        """
+        Args:
+            speed: Speed in m/s along the path.
+            lookahead: Distance in meters along the path of the point the drone heads for.
+            rate: Number of setpoints sent per second.
+            radius: Distance in meters to the end of the path at which it is done.
+        """
+        self.speed = speed
+        self.lookahead = lookahead
+        self.rate = rate
+        self.radius = radius
+
+
+class LocalFrame(object):
+    """Flat north-east-down frame around an origin, accurate enough within a few kilometers."""
+
+    def __init__(self, lat, lon):
+        self.__lat = lat
+        self.__lon = lon
+        self.__scale_lat = math.pi / 180 * EARTH_RADIUS
+        self.__scale_lon = self.__scale_lat * math.cos(math.pi * lat / 180)
+
+    def to_local(self, position):
+        """North, east and down in meters of the dictionary of position with keys 'lat', 'lon' and 'alt'."""
+        return ((position['lat'] - self.__lat) * self.__scale_lat,
+                (position['lon'] - self.__lon) * self.__scale_lon,
+                -position['alt'])
+
+
+class PathFollower(object):
+    """Velocity setpoints following a polyline in the local frame."""
+
+    def __init__(self, points, settings):
+        """
+        Args:
+            points: Tuples of north, east and down in meters, the first one is where the drone starts.
+            settings: PathSettings.
+        """
+        self.__points = points
+        self.__settings = settings
+        self.__segment = 0      # Index of the segment the drone is on, never goes back
+        self.__lengths = [_distance(points[n], points[n + 1]) for n in range(len(points) - 1)]
+        self.length = sum(self.__lengths)
+
+    def update(self, position):
+        """Velocity to be sent for the current position.
+
+        Args:
+            position: Tuple of north, east and down in meters.
+
+        Returns:
+            Tuple of velocity north, east and down in m/s, None if the end of path has been reached.
+        """
+        settings = self.__settings
+        end = self.__points[-1]
+        if _distance(position, end) <= settings.radius:
+            return None
+
+        travelled, remaining = self.__project(position)
+        target = self.__point_at(travelled + settings.lookahead)
+        direction = [target[n] - position[n] for n in range(3)]
+        norm = math.sqrt(sum(d * d for d in direction))
+        if norm < 1.0e-6:
+            return 0.0, 0.0, 0.0
+        # Slow down within the lookahead of the end so that the drone stops on it instead of overshooting
+        speed = settings.speed * min(1.0, max(remaining, _distance(position, end)) / settings.lookahead)
+        speed = max(speed, 0.5)
+        return tuple(d / norm * speed for d in direction)
+
+    def __project(self, position):
+        """Distance along the path of the closest point on the current or following segments, and the remaining.
+
+        The drone moves on to the next segment once it is closer to it, so it never goes back along the path.
+        """
+        best = None
+        travelled = sum(self.__lengths[:self.__segment])
+        for n in range(self.__segment, len(self.__lengths)):
+            t, distance = _project_on_segment(position, self.__points[n], self.__points[n + 1])
+            if best is None or distance < best[1]:
+                best = (n, distance, travelled + t * self.__lengths[n])
+            elif distance > best[1] + self.__settings.lookahead:
+                # Far behind the closest segment
+                break
+            travelled += self.__lengths[n]
+        self.__segment = best[0]
+        return best[2], self.length - best[2]
+
+    def __point_at(self, distance):
+        """Point at the distance along the path, the end if the path is shorter."""
+        for n, length in enumerate(self.__lengths):
+            if distance <= length and length > 0:
+                t = distance / length
+                start, end = self.__points[n], self.__points[n + 1]
+                return tuple(start[k] + (end[k] - start[k]) * t for k in range(3))
+            distance -= length
+        return self.__points[-1]
+
+
+def _distance(p1, p2):
+    return math.sqrt(sum((p2[n] - p1[n]) ** 2 for n in range(3)))
+
+
+def _project_on_segment(position, start, end):
+    """Fraction along the segment of the closest point to the position and the distance to it."""
+    segment = [end[n] - start[n] for n in range(3)]
+    length2 = sum(d * d for d in segment)
+    if length2 == 0:
+        return 0.0, _distance(position, start)
+    t = sum((position[n] - start[n]) * segment[n] for n in range(3)) / length2
+    t = min(1.0, max(0.0, t))
+    closest = tuple(start[n] + segment[n] * t for n in range(3))
+    return t, _distance(position, closest)
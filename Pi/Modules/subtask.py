@@ -0,0 +1,220 @@
+#  -*- coding: utf-8 -*-
+
+"""
+Modules.subtask
+~~~~~~~~~~~~~~~
+
+Split a task into subtasks and pack them into MAVC messages.
+
+A subtask is sent either as one MAVC_ACTION message carrying the actions of every drone, which each drone filters by
+its CID, or as one MAVC_CID_ACTION message per drone carrying only the actions of that drone and the step to be
+synchronized. The per-CID form keeps the bytes received and parsed by every drone independent of the fleet size.
+Drones accept both of them.
+
+A per-CID subtask marked "Hold" is sent ahead of time: the drone parses it and holds it until a MAVC_RELEASE message
+of its step arrives, so that nothing but a few bytes is transferred between a barrier and the next movement.
+"""
+
+from threading import Lock
+from Modules.clock import monotonic
+
+MAVC_ACTION = 4             # Actions of every drone in a subtask
+MAVC_CID_ACTION = 7         # Actions of one drone in a subtask
+MAVC_RELEASE = 8            # Start the subtask held for a step
+
+
+def unpack_actions(mavc_type, msg, cid):
+    """Actions of the drone in a subtask message of either form.
+
+    Args:
+        mavc_type: MAVC_ACTION or MAVC_CID_ACTION.
+        msg: MAVC message.
+        cid: CID of the drone.
+
+    Returns:
+        Tuple of the list of actions of the drone in order, the step and whether the drone should report
+        MAVC_ARRIVED once they are done, both taken from the last action of the drone.
+    """
+    if mavc_type == MAVC_CID_ACTION:
+        meta = msg[1]
+        return msg[2:], meta['Step'], meta['Sync']
+    actions = [action for action in msg[1:] if action['CID'] == cid]
+    last = actions[-1] if actions else msg[-1]
+    return actions, last['Step'], last['Sync']
+
+
+def is_held(mavc_type, msg):
+    """Whether the subtask message should be held until released."""
+    return mavc_type == MAVC_CID_ACTION and bool(msg[1].get('Hold'))
+
+
+def split_task(actions):
+    """Split the actions of a task into subtasks.
+
+    Every drone's actions are cut after each of its synchronization actions, the n-th subtask is made of the n-th
+    piece of every drone. Actions keep the order of the task file, as the Electron monitor does.
+
+    Args:
+        actions: Actions of every drone in the task file, in order of step for each drone.
+
+    Returns:
+        List of subtasks, each is a list of actions.
+    """
+    subtasks = []
+    indexes = {}    # CID -> index of the subtask the drone is in
+    for action in actions:
+        index = indexes.get(action['CID'], 0)
+        if index == len(subtasks):
+            subtasks.append([])
+        subtasks[index].append(action)
+        if action.get('Sync'):
+            indexes[action['CID']] = index + 1
+    return subtasks
+
+
+def subtask_steps(actions):
+    """Step of every drone in a subtask and whether it reports MAVC_ARRIVED, from the last action of the drone.
+
+    Returns:
+        Dictionary of CID and the tuple of step and sync.
+    """
+    return dict((action['CID'], (action['Step'], bool(action['Sync']))) for action in actions)
+
+
+def pack_subtask(actions):
+    """MAVC_ACTION message of a subtask, carrying the actions of every drone."""
+    return [{'Header': 'MAVCluster_Monitor', 'Type': MAVC_ACTION}] + actions
+
+
+def pack_cid_subtasks(actions, hold=False):
+    """MAVC_CID_ACTION messages of a subtask, one per drone.
+
+    Args:
+        actions: Actions of every drone in the subtask.
+        hold: Whether drones should hold the subtask until MAVC_RELEASE of its step.
+
+    Returns:
+        Dictionary of CID and the message to be sent to the drone.
+    """
+    steps = subtask_steps(actions)
+    messages = {}
+    for action in actions:
+        cid = action['CID']
+        if cid not in messages:
+            meta = {'CID': cid, 'Step': steps[cid][0], 'Sync': steps[cid][1]}
+            if hold:
+                meta['Hold'] = True
+            messages[cid] = [{'Header': 'MAVCluster_Monitor', 'Type': MAVC_CID_ACTION}, meta]
+        messages[cid].append(action)
+    return messages
+
+
+def pack_release(step):
+    """MAVC_RELEASE message starting the subtasks held for the step."""
+    return [{'Header': 'MAVCluster_Monitor', 'Type': MAVC_RELEASE}, {'Step': step}]
+
+
+class SubtaskStage(object):
+    """Subtasks of a drone received ahead of time and held until released.
+
+    It also measures how long the drone stays idle at each barrier, from the moment it has reported MAVC_ARRIVED
+    with nothing left to do until the next subtask starts.
+    """
+
+    def __init__(self):
+        self.__staged = {}          # Step -> subtask parsed
+        self.__released = set()     # Steps released before their subtasks were received
+        self.__released_after = None    # Barrier passed among drones before the next subtask was received
+        self.__idle_since = None
+        self.__lock = Lock()
+        self.__stats = {
+            'held': 0,              # Subtasks held
+            'released': 0,          # Subtasks released after held
+            'early_releases': 0,    # Releases arrived before their subtasks
+            'barriers': 0,          # Times of waiting at a barrier
+            'idle_total': 0.0,      # Seconds idle at barriers
+            'idle_max': 0.0
+        }
+
+    def hold(self, step, subtask):
+        """Hold the subtask until the step is released.
+
+        Args:
+            step: Step of the subtask.
+            subtask: Anything the drone needs to start it, parsed in advance.
+
+        Returns:
+            False if the step has already been released, so the subtask should be started at once.
+        """
+        with self.__lock:
+            if step in self.__released:
+                self.__released.discard(step)
+                return False
+            if self.__released_after is not None and step > self.__released_after:
+                self.__released_after = None
+                return False
+            self.__staged[step] = subtask
+            self.__stats['held'] += 1
+            return True
+
+    def release(self, step):
+        """Take the subtask held for the step.
+
+        Returns:
+            The subtask, None if it has not been received yet, in which case it is started once received.
+        """
+        with self.__lock:
+            subtask = self.__staged.pop(step, None)
+            if subtask is None:
+                self.__released.add(step)
+                self.__stats['early_releases'] += 1
+            else:
+                self.__stats['released'] += 1
+            return subtask
+
+    def release_after(self, step):
+        """Take the first subtask held after the step, once the barrier of the step is passed among drones.
+
+        Returns:
+            The subtask, None if it has not been received yet, in which case it is started once received.
+        """
+        with self.__lock:
+            later = [held for held in self.__staged if held > step]
+            if not later:
+                self.__released_after = step
+                self.__stats['early_releases'] += 1
+                return None
+            self.__stats['released'] += 1
+            return self.__staged.pop(min(later))
+
+    def clear(self):
+        """Discard every subtask held, e.g. when the drone is asked to return to launch."""
+        with self.__lock:
+            self.__staged.clear()
+            self.__released.clear()
+            self.__released_after = None
+            self.__idle_since = None
+
+    def mark_idle(self):
+        """The drone has reported MAVC_ARRIVED and has nothing else to do."""
+        with self.__lock:
+            self.__idle_since = monotonic()
+
+    def mark_busy(self):
+        """The next subtask starts."""
+        with self.__lock:
+            if self.__idle_since is None:
+                return
+            idle = monotonic() - self.__idle_since
+            self.__idle_since = None
+            self.__stats['barriers'] += 1
+            self.__stats['idle_total'] += idle
+            self.__stats['idle_max'] = max(self.__stats['idle_max'], idle)
+
+    def get_stats(self):
+        """Counters and the mean time idle at barriers."""
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats['staged'] = len(self.__staged)
+            stats['idle_mean'] = stats['idle_total'] / stats['barriers'] if stats['barriers'] else None
+            return stats
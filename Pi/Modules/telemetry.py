@@ -0,0 +1,367 @@
+#  -*- coding: utf-8 -*-
+
+"""
+Modules.telemetry
+~~~~~~~~~~~~~~~~~
+
+Send the UDP messages of a drone (e.g. MAVC_STAT) to the monitor through one long-lived socket, and report them
+periodically from one scheduler thread shared by every drone in the process. Reports can also be sent only when the
+state has changed enough, within a bandwidth budget shared by the drones.
+"""
+
+import heapq
+import math
+import socket
+import sys
+import traceback
+from collections import deque
+from threading import Condition, Lock, Thread
+from Modules.clock import monotonic
+
+
+class TelemetrySender(object):
+    """Long-lived UDP sender of one agent.
+
+    Messages are put into a bounded queue and sent by a background thread, so reporting never blocks on the network.
+    When the queue is full the oldest message is dropped since a newer state is more useful than a stale one. With
+    superseding enabled, a message replaces the one of the same key still waiting in the queue, so that only the
+    latest sample of a stream is sent once the network catches up. Every message is still sent as a datagram of its
+    own.
+    """
+
+    def __init__(self, max_queue=32, supersede=True, bind_addr=('', 0)):
+        """
+        Args:
+            max_queue: Maximum number of messages waiting to be sent.
+            supersede: Whether a message replaces the one of the same key waiting in the queue.
+            bind_addr: Address the socket is bound to, any free port by default.
+        """
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__sock.bind(bind_addr)
+        self.__queue = deque()
+        self.__max_queue = max_queue
+        self.__supersede = supersede
+        self.__cond = Condition()
+        self.__closed = False
+        self.__stats = {
+            'queued': 0,        # Messages accepted
+            'sent': 0,          # Datagrams sent
+            'dropped': 0,       # Messages dropped as the queue was full
+            'superseded': 0,    # Messages replaced by a newer one of the same key
+            'failed': 0         # Datagrams failed to be sent
+        }
+
+        worker = Thread(target=self.__send_in_queue, name='Telemetry-Sender')
+        worker.daemon = True
+        worker.start()
+
+    @property
+    def socket(self):
+        """The socket messages are sent through, replies to them can be received from it."""
+        return self.__sock
+
+    def send(self, data, address, key=None):
+        """Put a message into the queue.
+
+        Args:
+            data: Bytes to be sent.
+            address: Tuple of host and port.
+            key: A message replaces the one of the same key still in the queue, None to never replace.
+
+        Returns:
+            False if the message has replaced another one or an older message has been dropped.
+        """
+        with self.__cond:
+            if self.__closed:
+                return False
+            self.__stats['queued'] += 1
+            if self.__supersede and key is not None:
+                for entry in self.__queue:
+                    if entry[0] == key and entry[2] == address:
+                        entry[1] = data
+                        self.__stats['superseded'] += 1
+                        return False
+
+            intact = True
+            if len(self.__queue) >= self.__max_queue:
+                self.__queue.popleft()
+                self.__stats['dropped'] += 1
+                intact = False
+            self.__queue.append([key, data, address])
+            self.__cond.notify()
+            return intact
+
+    def get_stats(self):
+        """Copy of the counters of the sender."""
+        with self.__cond:
+            stats = dict(self.__stats)
+            stats['pending'] = len(self.__queue)
+            return stats
+
+    def close(self):
+        """Stop sending, messages still in the queue are discarded."""
+        with self.__cond:
+            self.__closed = True
+            self.__queue.clear()
+            self.__cond.notify()
+        self.__sock.close()
+
+    def __send_in_queue(self):
+        """Send messages in the queue one by one."""
+        while True:
+            with self.__cond:
+                while not self.__queue and not self.__closed:
+                    self.__cond.wait()
+                if self.__closed:
+                    return
+                key, data, address = self.__queue.popleft()
+
+            try:
+                self.__sock.sendto(data, address)
+                sent = True
+            except socket.error:
+                sent = False
+            with self.__cond:
+                self.__stats['sent' if sent else 'failed'] += 1
+
+
+class TelemetryStream(object):
+    """A periodic report served by TelemetryScheduler."""
+
+    def __init__(self, name, callback, rate):
+        self.name = name
+        self.callback = callback
+        self.period = 1.0 / rate
+        self.deadline = None    # When the callback should be called next time
+        self.active = True
+        self.calls = 0          # Times the callback has been called
+        self.missed = 0         # Periods skipped since the callback could not keep up
+        self.late_mean = 0.0    # Mean of lateness in seconds
+        self.late_m2 = 0.0      # Sum of squared deviations of lateness
+        self.late_max = 0.0     # Max lateness in seconds
+
+    def set_rate(self, rate):
+        """Change the number of calls per second, takes effect from the next call."""
+        self.period = 1.0 / rate
+
+    def record(self, lateness):
+        """Update the statistics of lateness (Welford's algorithm)."""
+        self.calls += 1
+        delta = lateness - self.late_mean
+        self.late_mean += delta / self.calls
+        self.late_m2 += delta * (lateness - self.late_mean)
+        self.late_max = max(self.late_max, lateness)
+
+    def get_stats(self):
+        """Statistics of the stream."""
+        return {
+            'rate': 1.0 / self.period,
+            'calls': self.calls,
+            'missed': self.missed,
+            'late_mean': self.late_mean,
+            'late_max': self.late_max,
+            'jitter': math.sqrt(self.late_m2 / self.calls) if self.calls > 1 else 0.0
+        }
+
+
+class TelemetryScheduler(object):
+    """Call the callbacks of every stream periodically in one thread.
+
+    Deadlines are computed from the previous deadline on the monotonic clock instead of the time the callback
+    finished, so the period does not drift with the time spent in the callbacks. Callbacks should return quickly,
+    e.g. by putting messages into a TelemetrySender.
+    """
+
+    def __init__(self):
+        self.__heap = []            # (deadline, sequence, stream)
+        self.__seq = 0              # Keep the order of streams with the same deadline
+        self.__cond = Condition()
+        self.__thread = None
+
+    def add_stream(self, name, callback, rate=2.0):
+        """Start calling the callback periodically.
+
+        Args:
+            name: Name of the stream in statistics.
+            callback: Function to be called without arguments.
+            rate: Number of calls per second.
+
+        Returns:
+            Object of the stream which can be passed to remove_stream().
+        """
+        stream = TelemetryStream(name, callback, rate)
+        with self.__cond:
+            stream.deadline = monotonic() + stream.period
+            self.__push(stream)
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__run, name='Telemetry-Scheduler')
+                self.__thread.daemon = True
+                self.__thread.start()
+            self.__cond.notify()
+        return stream
+
+    def remove_stream(self, stream):
+        """Stop calling the callback of the stream."""
+        with self.__cond:
+            stream.active = False
+
+    def get_stats(self):
+        """Statistics of every active stream keyed by the name."""
+        with self.__cond:
+            return dict((stream.name, stream.get_stats()) for _, _, stream in self.__heap if stream.active)
+
+    def __push(self, stream):
+        self.__seq += 1
+        heapq.heappush(self.__heap, (stream.deadline, self.__seq, stream))
+
+    def __run(self):
+        """Wait for the earliest deadline and call the callback."""
+        while True:
+            with self.__cond:
+                while True:
+                    while self.__heap and not self.__heap[0][2].active:
+                        heapq.heappop(self.__heap)
+                    if not self.__heap:
+                        self.__cond.wait()
+                        continue
+                    timeout = self.__heap[0][0] - monotonic()
+                    if timeout <= 0:
+                        break
+                    self.__cond.wait(timeout)
+                deadline, _, stream = heapq.heappop(self.__heap)
+
+                now = monotonic()
+                stream.record(now - deadline)
+                # Skip the periods already passed rather than calling the callback in a burst
+                stream.deadline = deadline + stream.period
+                if stream.deadline <= now:
+                    skipped = int((now - stream.deadline) / stream.period) + 1
+                    stream.missed += skipped
+                    stream.deadline += skipped * stream.period
+                self.__push(stream)
+
+            try:
+                stream.callback()
+            except Exception:
+                # One broken stream should not stop the others
+                traceback.print_exc(file=sys.stderr)
+
+
+class TelemetryBudget(object):
+    """Token bucket limiting the total number of reports per second of every drone sharing it."""
+
+    def __init__(self, rate, burst=None):
+        """
+        Args:
+            rate: Reports allowed per second.
+            burst: Reports allowed at once, the same as rate by default.
+        """
+        self.__rate = float(rate)
+        self.__burst = float(burst if burst is not None else max(rate, 1))
+        self.__tokens = self.__burst
+        self.__last = monotonic()
+        self.__lock = Lock()
+
+    def acquire(self):
+        """Take a token if there is one.
+
+        Returns:
+            Whether a report can be sent now.
+        """
+        with self.__lock:
+            now = monotonic()
+            self.__tokens = min(self.__burst, self.__tokens + (now - self.__last) * self.__rate)
+            self.__last = now
+            if self.__tokens < 1:
+                return False
+            self.__tokens -= 1
+            return True
+
+
+class AdaptiveReport(object):
+    """Decide whether a state sampled at a high rate is worth reporting.
+
+    A state is reported when the position, altitude, armed state or mode has changed beyond the deadbands since the
+    last report, or when nothing has been reported for the heartbeat interval. So the drone reports at up to max_rate
+    while maneuvering and at min_rate while nothing changes.
+    """
+
+    def __init__(self, max_rate=10.0, min_rate=0.5, pos_deadband=0.5, alt_deadband=0.3, budget=None):
+        """
+        Args:
+            max_rate: Rate of sampling the state, which is also the max rate of reports.
+            min_rate: Rate of reports while the state does not change.
+            pos_deadband: Horizontal movement in meters to be reported.
+            alt_deadband: Change of altitude in meters to be reported.
+            budget: TelemetryBudget shared by drones, None for no limit.
+        """
+        self.max_rate = max_rate
+        self.__heartbeat = 1.0 / min_rate
+        self.__pos_deadband = pos_deadband
+        self.__alt_deadband = alt_deadband
+        self.__budget = budget
+        self.__last_state = None
+        self.__last_time = None
+        self.__stats = {
+            'changed': 0,       # Reports sent for the change of state
+            'heartbeat': 0,     # Reports sent for the heartbeat
+            'suppressed': 0,    # Samples not reported as nothing changed
+            'throttled': 0      # Reports not sent because of the budget
+        }
+
+    def should_report(self, state):
+        """Whether the state should be reported, it is taken as reported if so.
+
+        Args:
+            state: Dictionary with keys 'Armed', 'Mode', 'Lat', 'Lon' and 'Alt'.
+        """
+        now = monotonic()
+        if self.__has_changed(self.__last_state, state):
+            reason = 'changed'
+        elif now - self.__last_time >= self.__heartbeat:
+            reason = 'heartbeat'
+        else:
+            self.__stats['suppressed'] += 1
+            return False
+
+        if self.__budget is not None and not self.__budget.acquire():
+            self.__stats['throttled'] += 1
+            return False
+        self.__stats[reason] += 1
+        self.__last_state = dict(state)
+        self.__last_time = now
+        return True
+
+    def get_stats(self):
+        """Copy of the counters."""
+        return dict(self.__stats)
+
+    def __has_changed(self, last, state):
+        """Whether the state is beyond the deadbands of the last one reported."""
+        if last is None or state['Armed'] != last['Armed'] or state['Mode'] != last['Mode']:
+            return True
+        if None in (state['Lat'], state['Alt'], last['Lat'], last['Alt']):
+            # No position before GPS fix
+            return (state['Lat'], state['Alt']) != (last['Lat'], last['Alt'])
+        return abs(state['Alt'] - last['Alt']) >= self.__alt_deadband or \
+            _get_distance_metres(last, state) >= self.__pos_deadband
+
+
+def _get_distance_metres(state1, state2):
+    """Approximate ground distance in meters between the positions in two states."""
+    d_lat = state2['Lat'] - state1['Lat']
+    d_lon = state2['Lon'] - state1['Lon']
+    return math.sqrt((d_lat*d_lat) + (d_lon*d_lon)) * 1.113195e5
+
+
+_scheduler = None
+_scheduler_lock = Lock()
+
+
+def get_scheduler():
+    """The scheduler shared by every drone in this process."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = TelemetryScheduler()
+        return _scheduler
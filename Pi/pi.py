@@ -11,9 +11,17 @@ To start a simulator drone in SEU: dronekit-sitl copter-3.3 --home=31.8872318,11
 """
 
 from Modules import drone
-from Modules.drone_controller import connect_vehicle
-from threading import Thread
+from Modules import drone_controller
+from Modules.barrier import PeerBarrier
+from Modules.drone_controller import ArrivalCriteria, connect_vehicle
+from Modules.path_follow import PathSettings
+from Modules.fleet import FleetHost
+from Modules.params import ParamCache
+from Modules.telemetry import AdaptiveReport, TelemetryBudget
 import argparse
+import json
+import os
+import time
 
 if __name__ == '__main__':
     # Parse arguments from the cmd line
@@ -22,63 +30,161 @@ if __name__ == '__main__':
     parser.add_argument('--host', default='172.20.10.4', help='IPv4 address where the monitor on')
     parser.add_argument('--port', default=4396, type=int, help='Port which the monitor are listening to')
     parser.add_argument('--sitl', type=int, help='Number of simulators to start')
+    parser.add_argument('--sitl-timeout', default=60.0, type=float, help='Seconds to wait for a simulator to be '
+                                                                         'ready and then for its heartbeat')
+    parser.add_argument('--kinematic', action='store_true', help='Fly the --sitl drones with kinematic vehicles in '
+                                                                 'this process instead of simulators of ArduPilot')
+    parser.add_argument('--speedup', default=1.0, type=float, help='Seconds of flight per second of kinematic '
+                                                                   'vehicles')
     parser.add_argument('--lat', default=31.8871046, type=float, help='Latitude of home-location of the simulator')
     parser.add_argument('--lon', default=118.8134928, type=float, help='Longitude of home-location of the simulator')
     parser.add_argument('--speed', default=4.0, type=float, help='Speed of the flight')
     parser.add_argument('--baud', default=115200, type=int, help='Baudrate')
+    parser.add_argument('--rate', default=2.0, type=float, help='Number of state reports per second without '
+                                                                '--adaptive')
+    parser.add_argument('--adaptive', action='store_true', help='Report state only when it changes, at --min-rate '
+                                                                'at least')
+    parser.add_argument('--min-rate', default=0.5, type=float, help='Number of state reports per second of adaptive '
+                                                                    'reporting while the state does not change')
+    parser.add_argument('--max-rate', default=10.0, type=float, help='Max number of state reports per second of '
+                                                                     'adaptive reporting')
+    parser.add_argument('--budget', type=float, help='Max number of state reports per second of all simulators')
+    parser.add_argument('--workers', default=4, type=int, help='Number of simulators brought up at the same time')
+    parser.add_argument('--stats', type=float, help='Print statistics of the fleet every STATS seconds')
+    parser.add_argument('--arrival-radius', default=1.0, type=float, help='Distance in meters to the target at '
+                                                                          'which the drone has arrived')
+    parser.add_argument('--settle-time', default=0.0, type=float, help='Seconds the drone should stay within the '
+                                                                       'arrival radius')
+    parser.add_argument('--settle-speed', type=float, help='Max ground speed in m/s within the arrival radius')
+    movement = parser.add_mutually_exclusive_group()
+    movement.add_argument('--mission', action='store_true', help='Fly runs of movements in a subtask as one mission '
+                                                                 'in AUTO mode')
+    movement.add_argument('--path', action='store_true', help='Fly runs of movements in a subtask continuously '
+                                                              'along the path in GUIDED mode')
+    parser.add_argument('--lookahead', default=3.0, type=float, help='Distance in meters ahead along the path the '
+                                                                     'drone heads for with --path')
+    parser.add_argument('--peers', type=int, help='Synchronize steps among PEERS drones over UDP broadcast instead '
+                                                  'of waiting for the monitor')
+    parser.add_argument('--peer-address', default='255.255.255.255', help='Broadcast or multicast address of '
+                                                                          'drones with --peers')
+    parser.add_argument('--peer-port', default=4397, type=int, help='UDP port of drones with --peers')
+    parser.add_argument('--peer-timeout', default=30.0, type=float, help='Seconds to wait for the other drones at '
+                                                                         'a step before going on with --peers')
+    parser.add_argument('--fence-lookahead', default=0.0, type=float, help='Seconds ahead at the current velocity '
+                                                                           'checked against the geofence as well')
+    parser.add_argument('--param-cache', default=os.path.join(os.path.expanduser('~'), '.mavcluster_params.json'),
+                        help='File caching parameters of vehicles, empty not to cache')
     args = parser.parse_args()
     connection_string = args.master
     host = args.host
     port = args.port
     baud = args.baud
     speed = args.speed
+    # Kinematic vehicles fly speedup times faster, and so does every timed wait of the agent
+    speedup = args.speedup if args.kinematic else 1.0
+    rate = args.rate * speedup
+    budget = TelemetryBudget(args.budget) if args.budget else None
+    param_cache = ParamCache(args.param_cache) if args.param_cache else None
+    drone_controller.arrival_criteria = ArrivalCriteria(radius=args.arrival_radius,
+                                                        settle_time=args.settle_time / speedup,
+                                                        settle_speed=args.settle_speed)
+    drone_controller.arrival_criteria.stall_time /= speedup
+    drone_controller.path_settings = PathSettings(speed=speed, lookahead=args.lookahead, radius=args.arrival_radius)
+    # Keep the setpoints as many per second of flight as in real time
+    drone_controller.path_settings.rate *= speedup
+
+    def report_policy():
+        """Policy of reporting state for a new drone"""
+        if not args.adaptive:
+            return None
+        return AdaptiveReport(max_rate=args.max_rate * speedup, min_rate=args.min_rate * speedup, budget=budget)
+
+    # Barrier among drones, shared by every drone of this process
+    barrier = None
+    if args.peers:
+        barrier = PeerBarrier(args.peers, port=args.peer_port, address=args.peer_address,
+                              timeout=args.peer_timeout / speedup)
 
     # To create and start simulators of copter
-    sitl = None
+    launcher = None
+    world = None
+    fleet = None
     if args.sitl:
-        sitls = []
-        cnt_strs = []
+        if args.kinematic:
+            # Every vehicle is moved by one thread of this process
+            from Modules.kinematic import KinematicWorld, KinematicVehicle
+            world = KinematicWorld(speedup=args.speedup)
+
+            def launch_simulator(index):
+                """Create the kinematic vehicle"""
+                vehicle = KinematicVehicle(world, args.lat, args.lon + 5e-5 * (index - 1))
+                vehicle.groundspeed = speed
+                return vehicle
+        else:
+            # Simulators share the firmware downloaded once and are given free ports
+            from Modules.launcher import SitlLauncher
+            launcher = SitlLauncher(timeout=args.sitl_timeout)
+            launcher.prepare()
 
-        def connect_to_monitor(h, p, idx):
-            sitls[idx-1][0].launch(sitls[idx-1][1], await_ready=True)
-            vehicle = connect_vehicle(cnt_strs[idx-1])
-            vehicle.groundspeed = speed
-            sitls[idx-1] = drone.Drone(vehicle, h, p, idx)
+            def launch_simulator(index):
+                """Start the simulator and connect to it"""
+                vehicle = launcher.start_vehicle(index, args.lat, args.lon + 5e-5 * (index - 1))
+                if vehicle is not None:
+                    vehicle.groundspeed = speed
+                return vehicle
 
-        # Preparation for starting multiple separated simulators
-        from dronekit_sitl import SITL, start_default
         if args.sitl == 1:
-            sitl = start_default(args.lat, args.lon)
-            connection_string = sitl.connection_string()
-            vehicle = connect_vehicle(connection_string)
-            mav = drone.Drone(vehicle, host, port)
+            vehicle = launch_simulator(1)
+            if vehicle is None:
+                if launcher is not None:
+                    launcher.stop_all()
+                exit(1)
+            mav = drone.Drone(vehicle, host, port, report_rate=rate, report_policy=report_policy(),
+                              batch_missions=args.mission, follow_paths=args.path, barrier=barrier,
+                              fence_lookahead=args.fence_lookahead, param_cache=param_cache, vehicle_key='sitl-1',
+                              time_scale=1.0 / speedup)
             mav.set_speed(speed)
         else:
-            for i in range(0, args.sitl):
-                sitl = SITL()
-                sitl.download('copter', '3.3', verbose=True)
-                sitl_args = ['-I%d' % i, '--model', 'quad', '--home=%f,%f,584,353' % (args.lat, args.lon + 5e-5 * i)]
-                sitls.append([sitl, sitl_args])
-                cnt_strs.append('tcp:127.0.0.1:%d' % (5760 + 10*i))
-                c = Thread(target=connect_to_monitor, args=(host, port, i+1), name="SITL_%d" % (i+1))
-                c.start()
+            # Every simulator is hosted by one fleet sharing the event loop and UDP socket
+            fleet = FleetHost(host, port, report_rate=rate, report_policy=report_policy, workers=args.workers,
+                              batch_missions=args.mission, follow_paths=args.path, barrier=barrier,
+                              fence_lookahead=args.fence_lookahead, param_cache=param_cache, time_scale=1.0 / speedup)
+            for i in range(1, args.sitl + 1):
+                fleet.spawn(i, lambda index=i: launch_simulator(index))
     else:
         # Connect to the Vehicle
         print("Connecting to vehicle on: %s" % connection_string)
         vehicle = connect_vehicle(connection_string, baud=baud)
 
         # Connect to the Monitor
-        mav = drone.Drone(vehicle, host, port)
+        mav = drone.Drone(vehicle, host, port, report_rate=rate, report_policy=report_policy(),
+                          batch_missions=args.mission, follow_paths=args.path, barrier=barrier,
+                          fence_lookahead=args.fence_lookahead, param_cache=param_cache,
+                          vehicle_key=connection_string)
         mav.set_speed(speed)
 
     try:
         while True:
-            pass
+            time.sleep(args.stats or 1)
+            if args.stats and fleet is not None:
+                stats = fleet.get_stats()
+                if launcher is not None:
+                    stats['sitl'] = launcher.get_stats()
+                else:
+                    stats['kinematic'] = world.get_stats()
+                print(json.dumps(stats, sort_keys=True))
     except KeyboardInterrupt:
         if not args.sitl:
             mav.close_connection()
         else:
-            sitl.stop()
+            if fleet is not None:
+                fleet.close()
+            if launcher is not None:
+                launcher.stop_all()
+            if world is not None:
+                world.close()
+        if barrier is not None:
+            barrier.close()
         print("Completed")
         exit(0)
 
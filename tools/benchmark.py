@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+"""
+Fleet Benchmark
+~~~~~~~~~~~~~~~
+
+This script measures the MAVC protocol with synthetic agents, without DroneKit or simulators, against the headless
+monitor (monitor.py) in this process. It needs Python 3.5 or later.
+
+Every run of the sweep starts one child process hosting N agents, which use the network stack of the real ones
+(AgentLoop, MAVCLink, TelemetrySender and the shared TelemetryScheduler) but arrive as soon as a subtask is received,
+or after --work seconds. For each combination of fleet size, telemetry rate and subtask size it measures:
+
+* handshake: seconds from the first MAVC_REQ_CID of an agent to its TCP connection;
+* stat: MAVC_STAT received by the monitor per second, against the rate sent;
+* delivery: seconds from the monitor sending (or releasing) a subtask to an agent receiving it;
+* barrier: seconds from the monitor sending a subtask to the last MAVC_ARRIVED of it;
+* stat_age and arrival_age: milliseconds from a state or an arrival stamped by an agent to its message received;
+* agents: CPU seconds and max RSS of the child process.
+
+Agents and monitor run on the same host, so the delivery latency is measured on one clock. The results are written
+as JSON to be compared between versions of the protocol.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import abspath, dirname, join
+
+sys.path.append(join(dirname(abspath(__file__)), "..", "Pi"))
+from Modules import subtask
+from Modules.agent_loop import DatagramRouter, MAVCLink, get_loop
+from Modules.clock import monotonic
+from Modules.codec import MAVC_ARRIVED, MAVC_STAT
+from Modules.telemetry import TelemetrySender, get_scheduler
+from monitor import BarrierTimeout, Monitor
+
+ACTION_GO_BY = 2
+
+
+class SyntheticAgent(object):
+    """Agent speaking MAVC without a vehicle, arriving once the actions of a subtask have been received."""
+
+    def __init__(self, loop, telemetry, router, host, port, index, rate, work):
+        """
+        Args:
+            loop: AgentLoop shared by the agents.
+            telemetry: TelemetrySender shared by the agents.
+            router: DatagramRouter of the socket of telemetry.
+            host: The host of monitor.
+            port: Base port of monitor.
+            index: Index of the agent, the CID is requested from port+index.
+            rate: Number of MAVC_STAT messages per second.
+            work: Seconds taken to perform a subtask.
+        """
+        self.__loop = loop
+        self.__rate = rate
+        self.__work = work
+        self.__stage = subtask.SubtaskStage()
+        self.__stream = None
+        self.__lat, self.__lon = 31.8871046, 118.8134928 + 5e-5 * index
+        self.received = {}          # Step -> when the subtask was received or released
+        self.link = MAVCLink(loop, telemetry, host, port, (self.__lat, self.__lon), self.__on_message,
+                             on_connected=self.__on_connected, index=index, router=router)
+
+    def start(self):
+        self.link.start()
+
+    def close(self):
+        if self.__stream is not None:
+            get_scheduler().remove_stream(self.__stream)
+        self.link.close()
+
+    def __on_connected(self):
+        self.__stream = get_scheduler().add_stream('Agent-%d' % self.link.cid, self.__report, self.__rate)
+
+    def __report(self):
+        self.link.send([
+            {'Header': 'MAVCluster_Drone', 'Type': MAVC_STAT},
+            {'CID': self.link.cid, 'Armed': True, 'Mode': 'GUIDED', 'Lat': self.__lat, 'Lon': self.__lon, 'Alt': 10.0,
+             'Time': self.link.clock.to_monitor_time(monotonic())}
+        ])
+
+    def __on_message(self, mavc_type, msg):
+        if mavc_type in (subtask.MAVC_ACTION, subtask.MAVC_CID_ACTION):
+            actions, step, sync = subtask.unpack_actions(mavc_type, msg, self.link.cid)
+            if subtask.is_held(mavc_type, msg) and self.__stage.hold(step, sync):
+                return
+            self.__start(step, sync)
+        elif mavc_type == subtask.MAVC_RELEASE:
+            step = msg[1]['Step']
+            sync = self.__stage.release(step)
+            if sync is not None:
+                self.__start(step, sync)
+
+    def __start(self, step, sync):
+        self.received[step] = time.time()
+        if sync:
+            self.__loop.call_later(self.__work, self.__arrive, step)
+
+    def __arrive(self, step):
+        self.link.write([{'Header': 'MAVCluster_Drone', 'Type': MAVC_ARRIVED},
+                         {'CID': self.link.cid, 'Step': step, 'Time': self.link.clock.to_monitor_time(monotonic())}])
+
+
+def run_agents(args):
+    """Host the synthetic agents till stdin is closed, then write what they measured."""
+    loop = get_loop()
+    telemetry = TelemetrySender(max_queue=max(1024, args.count * 4))
+    router = DatagramRouter(loop, telemetry.socket)
+    agents = [SyntheticAgent(loop, telemetry, router, args.host, args.port, index, args.rate, args.work)
+              for index in range(1, args.count + 1)]
+    for agent in agents:
+        agent.start()
+
+    sys.stdin.read()
+    for agent in agents:
+        agent.close()
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    streams = get_scheduler().get_stats().values()
+    result = {
+        'agents': dict((agent.link.cid, {'handshake_time': agent.link.stats['handshake_time'],
+                                         'received': agent.received, 'clock': agent.link.clock.get_stats()})
+                       for agent in agents),
+        'cpu': usage.ru_utime + usage.ru_stime,
+        'rss_kb': usage.ru_maxrss if platform.system() != 'Darwin' else usage.ru_maxrss // 1024,
+        'telemetry': telemetry.get_stats(),
+        'report_late_max': max([stream['late_max'] for stream in streams] or [None]),
+        'report_missed': sum(stream['missed'] for stream in streams)
+    }
+    with open(args.result, 'w') as result_file:
+        json.dump(result, result_file)
+
+
+def make_task(drones, subtasks, size):
+    """Task of the subtasks, each of size GO_BY actions of every drone with the last one synchronous."""
+    actions = []
+    for n in range(subtasks):
+        for cid in range(1, drones + 1):
+            for k in range(size):
+                actions.append({'Action_type': ACTION_GO_BY, 'CID': cid, 'N': 1.0, 'E': 0.0, 'Alt': 10,
+                                'Time': 0, 'Step': n * size + k, 'Sync': k == size - 1})
+    return actions
+
+
+def percentiles(values):
+    """Nearest-rank percentiles of the values."""
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values))) - 1))]
+
+    return {'p50': rank(50), 'p90': rank(90), 'p99': rank(99), 'max': values[-1], 'mean': sum(values) / len(values),
+            'count': len(values)}
+
+
+async def run_once(loop, args, drones, rate, size):
+    """Measure one combination of the sweep."""
+    monitor = Monitor(loop, args.host, args.port, drones, codec=args.codec, per_cid=args.messages, hold=args.hold,
+                      barrier_timeout=args.barrier_timeout, verbose=False)
+    await monitor.start()
+    result_file, result_path = tempfile.mkstemp(suffix='.json', prefix='mavc-bench-')
+    os.close(result_file)
+    child = subprocess.Popen([sys.executable, abspath(__file__), 'agents', '--count', str(drones),
+                              '--rate', str(rate), '--work', str(args.work), '--host', args.host,
+                              '--port', str(args.port), '--result', result_path],
+                             stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    run = {'drones': drones, 'rate': rate, 'size': size}
+    try:
+        await asyncio.wait_for(monitor.all_connected.wait(), args.connect_timeout)
+
+        stats_before, started = monitor.stats['stats_in'], time.time()
+        await asyncio.sleep(args.duration)
+        ingest = (monitor.stats['stats_in'] - stats_before) / (time.time() - started)
+        run['stat'] = {'sent_rate': drones * rate, 'ingest_rate': ingest, 'ratio': ingest / (drones * rate)}
+
+        await monitor.run_task(make_task(drones, args.subtasks, size))
+    except asyncio.TimeoutError:
+        run['error'] = 'agents not connected in %.0fs' % args.connect_timeout
+    except BarrierTimeout as e:
+        run['error'] = str(e)
+    finally:
+        child.stdin.close()
+        child.wait()
+        monitor.close()
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    with open(result_path, 'r') as result_file:
+        result = json.load(result_file)
+    os.remove(result_path)
+    stats = monitor.get_stats()
+    delivery = []
+    for agent in result['agents'].values():
+        for step, received in agent['received'].items():
+            sent = monitor.started_at.get(int(step))
+            if sent is not None:
+                delivery.append(received - sent)
+    run.update({
+        'connect_time': monitor.stats['connect_time'],
+        'handshake': percentiles([agent['handshake_time'] for agent in result['agents'].values()
+                                  if agent['handshake_time'] is not None]),
+        'delivery': percentiles(delivery),
+        'barrier': percentiles([barrier['wait'] for barrier in monitor.barriers]),
+        'spread': percentiles([barrier['spread'] for barrier in monitor.barriers]),
+        'stat_age': stats['stat_age'],
+        'arrival_age': stats['arrival_age'],
+        'bytes_out': stats['monitor']['bytes_out'],
+        'bytes_in': stats['monitor']['bytes_in'],
+        'agents': {'cpu': result['cpu'], 'rss_kb': result['rss_kb'], 'telemetry': result['telemetry'],
+                   'report_late_max': result['report_late_max'], 'report_missed': result['report_missed']},
+        'monitor': {'cpu': usage_after.ru_utime + usage_after.ru_stime - usage.ru_utime - usage.ru_stime}
+    })
+    # Let the ports be released before the next run
+    await asyncio.sleep(0.5)
+    return run
+
+
+async def sweep(loop, args):
+    runs = []
+    for drones, rate, size in itertools.product(args.fleet, args.rates, args.sizes):
+        run = await run_once(loop, args, drones, rate, size)
+        runs.append(run)
+        summary = [run.get('error')] if 'error' in run else [
+            'handshake p99 %s' % _p99(run['handshake']),
+            'stat %.0f/%.0f per s' % (run['stat']['ingest_rate'], run['stat']['sent_rate']),
+            'delivery p99 %s' % _p99(run['delivery']),
+            'barrier p99 %s' % _p99(run['barrier']),
+            'agents %.2fs CPU %d KB' % (run['agents']['cpu'], run['agents']['rss_kb'])]
+        print('%d drones, %g Hz, %d actions: %s' % (drones, rate, size, ', '.join(summary)))
+    return runs
+
+
+def _p99(samples):
+    """The 99th percentile of percentiles() in seconds, n/a if there was no sample."""
+    return 'n/a' if samples is None else '%.4fs' % samples['p99']
+
+
+def _numbers(text, kind=int):
+    return [kind(value) for value in text.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fleet", default="10,50,100", type=_numbers, help="Fleet sizes, separated by commas")
+    parser.add_argument("--rates", default="2,10", type=lambda text: _numbers(text, float),
+                        help="MAVC_STAT messages per second of each agent, separated by commas")
+    parser.add_argument("--sizes", default="1,10", type=_numbers, help="Actions of each drone in a subtask, "
+                                                                       "separated by commas")
+    parser.add_argument("--subtasks", default=20, type=int, help="Synchronous subtasks of each run")
+    parser.add_argument("--duration", default=5.0, type=float, help="Seconds of measuring MAVC_STAT before the task")
+    parser.add_argument("--work", default=0.0, type=float, help="Seconds an agent takes to perform a subtask")
+    parser.add_argument("--host", default="127.0.0.1", help="Address of the monitor")
+    parser.add_argument("--port", default=4396, type=int, help="Base port of the monitor")
+    parser.add_argument("--codec", choices=["json", "binary"], help="Codec to use instead of the one agents prefer")
+    parser.add_argument("--messages", action="store_true", help="Send MAVC_CID_ACTION instead of MAVC_ACTION")
+    parser.add_argument("--hold", action="store_true", help="Send the subtasks held ahead and MAVC_RELEASE them")
+    parser.add_argument("--connect-timeout", default=60.0, type=float, help="Seconds to wait for the agents")
+    parser.add_argument("--barrier-timeout", default=30.0, type=float, help="Seconds to wait at a barrier")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file of the results")
+    subparsers = parser.add_subparsers(dest="command")
+    agents_parser = subparsers.add_parser("agents", help="Host synthetic agents, used by the benchmark itself")
+    agents_parser.add_argument("--count", type=int, required=True)
+    agents_parser.add_argument("--rate", type=float, required=True)
+    agents_parser.add_argument("--work", type=float, default=0.0)
+    agents_parser.add_argument("--host", required=True)
+    agents_parser.add_argument("--port", type=int, required=True)
+    agents_parser.add_argument("--result", required=True)
+    args = parser.parse_args()
+
+    if args.command == "agents":
+        run_agents(args)
+        sys.exit(0)
+
+    loop = asyncio.get_event_loop()
+    started = time.time()
+    runs = loop.run_until_complete(sweep(loop, args))
+    loop.close()
+    results = {
+        "time": started,
+        "python": platform.python_version(),
+        "host": platform.node(),
+        "config": {"subtasks": args.subtasks, "duration": args.duration, "work": args.work,
+                   "codec": args.codec, "messages": args.messages, "hold": args.hold},
+        "runs": runs
+    }
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, sort_keys=True, indent=4)
+    print("Results written to %s" % args.output)
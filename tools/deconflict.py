@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+"""
+Trajectory Deconfliction
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+This script checks before a flight that the drones of a task keep a safe distance from each other. It needs Python
+3.5 or later.
+
+The task is replayed as task_validator.py does, which resolves the relative go_by legs, the go_to legs and the waits
+in the air of every drone into straight segments of absolute position against time. The flight is then swept in
+slices of time: in each slice every drone is put into the cells of a uniform spatial hash grid covered by the box of
+its motion, and only drones sharing a cell are compared. For every such pair the closest approach within the slice is
+solved exactly, piece by piece of linear motion, so neither all pairs of drones nor all pairs of legs are compared.
+
+It reports the minimum separation, exact whenever it is below --separation, and every pair of steps of two drones
+which come closer than --separation, with when the conflict begins and ends and when the drones are the closest.
+Drones on the ground, before their takeoff and after their landing, are left out. The exit status is 1 if there is
+any conflict.
+"""
+
+import argparse
+import json
+import math
+import sys
+import time
+from collections import defaultdict
+
+from task_validator import ERROR, add_model_arguments, load_task, model_from_args, task_file_paths, validate
+
+
+class Conflict(object):
+    """Two drones closer than the separation while flying a step each."""
+
+    def __init__(self, cids, steps, start, end, distance, at):
+        self.cids = cids            # Tuple of the CIDs, in ascending order
+        self.steps = steps          # Tuple of the steps of either drone
+        self.start = start          # Seconds since the task was started
+        self.end = end
+        self.distance = distance    # Closest approach in meters
+        self.at = at                # When they are the closest
+
+    def merge(self, start, end, distance, at):
+        self.start = min(self.start, start)
+        self.end = max(self.end, end)
+        if distance < self.distance:
+            self.distance, self.at = distance, at
+
+    def to_dict(self):
+        return {"CID": list(self.cids), "Step": list(self.steps), "start": self.start, "end": self.end,
+                "distance": self.distance, "at": self.at}
+
+
+class Sweep(object):
+    """Closest approaches of every pair of drones over their trajectories."""
+
+    def __init__(self, legs, separation, slice_time=None):
+        """
+        Args:
+            legs: Dictionary of CID and its list of Leg in order of time, the drone is on the ground between legs
+                which are not contiguous.
+            separation: Distance in meters drones should keep.
+            slice_time: Seconds of a slice of the sweep, the time to fly the separation at the highest speed of
+                the task by default.
+        """
+        self.__legs = dict((cid, drone_legs) for cid, drone_legs in legs.items() if drone_legs)
+        self.__separation = separation
+        self.__cell = 2.0 * separation
+        max_speed = max([_length(leg.origin, leg.target) / (leg.end - leg.start)
+                         for drone_legs in self.__legs.values() for leg in drone_legs if leg.end > leg.start] or [0])
+        self.slice_time = slice_time or (separation / max_speed if max_speed > 0 else 1.0)
+        self.conflicts = {}         # (CIDs, steps) -> Conflict
+        self.closest = None         # Tuple of distance, CIDs, steps and when of the closest approach
+        self.stats = {
+            "drones": len(self.__legs),
+            "legs": sum(len(drone_legs) for drone_legs in self.__legs.values()),
+            "slices": 0,
+            "candidates": 0,        # Pairs of drones sharing a cell in a slice
+            "time": 0.0             # Seconds taken by the sweep
+        }
+
+    def run(self):
+        started = time.time()
+        if not self.__legs:
+            return self
+        begin = min(drone_legs[0].start for drone_legs in self.__legs.values())
+        finish = max(drone_legs[-1].end for drone_legs in self.__legs.values())
+        cursors = dict.fromkeys(self.__legs, 0)    # CID -> index of the first leg not over yet
+        slices = max(1, int(math.ceil((finish - begin) / self.slice_time)))
+        for k in range(slices):
+            low = begin + k * self.slice_time
+            high = min(finish, low + self.slice_time)
+            self.__sweep_slice(low, high, cursors)
+        self.stats["slices"] = slices
+        self.stats["time"] = time.time() - started
+        return self
+
+    def __sweep_slice(self, low, high, cursors):
+        half = self.__separation / 2.0
+        cell = self.__cell
+        grid = defaultdict(list)
+        pieces = {}                 # CID -> legs overlapping the slice
+        for cid, drone_legs in self.__legs.items():
+            i = cursors[cid]
+            while i < len(drone_legs) and drone_legs[i].end < low:
+                i += 1
+            cursors[cid] = i
+            overlapping = []
+            while i < len(drone_legs) and drone_legs[i].start <= high:
+                overlapping.append(drone_legs[i])
+                i += 1
+            if not overlapping:
+                continue
+            pieces[cid] = overlapping
+            # Box of the motion in the slice, grown by half the separation
+            lower, upper = [float("inf")] * 3, [float("-inf")] * 3
+            for leg in overlapping:
+                for point in (_position(leg, max(low, leg.start)), _position(leg, min(high, leg.end))):
+                    for axis in (0, 1, 2):
+                        if point[axis] < lower[axis]:
+                            lower[axis] = point[axis]
+                        if point[axis] > upper[axis]:
+                            upper[axis] = point[axis]
+            ranges = [range(int(math.floor((lower[axis] - half) / cell)),
+                            int(math.floor((upper[axis] + half) / cell)) + 1) for axis in (0, 1, 2)]
+            for x in ranges[0]:
+                for y in ranges[1]:
+                    for z in ranges[2]:
+                        grid[(x, y, z)].append(cid)
+
+        candidates = set()
+        for cids in grid.values():
+            if len(cids) > 1:
+                cids.sort()
+                for m, first in enumerate(cids):
+                    for second in cids[m + 1:]:
+                        candidates.add((first, second))
+        self.stats["candidates"] += len(candidates)
+        for pair in candidates:
+            self.__approach(pair, pieces[pair[0]], pieces[pair[1]], low, high)
+
+    def __approach(self, pair, legs_a, legs_b, low, high):
+        """Closest approach of two drones within the slice, merged into the conflicts if they are too close."""
+        for leg_a in legs_a:
+            for leg_b in legs_b:
+                start = max(low, leg_a.start, leg_b.start)
+                end = min(high, leg_a.end, leg_b.end)
+                if start >= end:
+                    continue        # Positions are continuous, an instant is covered by the pieces around it
+                # Both move linearly from start to end, so does the vector between them
+                r0 = _difference(_position(leg_a, start), _position(leg_b, start))
+                r1 = _difference(_position(leg_a, end), _position(leg_b, end))
+                dr = _difference(r1, r0)
+                a = _dot(dr, dr)
+                b = _dot(r0, dr)
+                c = _dot(r0, r0)
+                s = min(1.0, max(0.0, -b / a)) if a > 0 else 0.0
+                distance = math.sqrt(max(0.0, c + 2 * b * s + a * s * s))
+                at = start + s * (end - start)
+                steps = (leg_a.step, leg_b.step)
+                if self.closest is None or distance < self.closest[0]:
+                    self.closest = (distance, pair, steps, at)
+                if distance >= self.__separation:
+                    continue
+                # Part of the piece closer than the separation, where a*s^2 + 2*b*s + c < separation^2
+                if a > 0:
+                    root = math.sqrt(max(0.0, b * b - a * (c - self.__separation ** 2)))
+                    enter = max(0.0, (-b - root) / a)
+                    leave = min(1.0, (-b + root) / a)
+                else:
+                    enter, leave = 0.0, 1.0
+                key = (pair, steps)
+                interval = (start + enter * (end - start), start + leave * (end - start))
+                if key in self.conflicts:
+                    self.conflicts[key].merge(interval[0], interval[1], distance, at)
+                else:
+                    self.conflicts[key] = Conflict(pair, steps, interval[0], interval[1], distance, at)
+
+
+def check_task(actions, model, separation, slice_time=None):
+    """Replay a task and sweep the trajectories of its drones.
+
+    Returns:
+        Tuple of the problems found by task_validator.validate() and the Sweep done.
+    """
+    issues, flights, _ = validate(actions, model)
+    legs = dict((cid, flight.legs) for cid, flight in flights.items())
+    return issues, Sweep(legs, separation, slice_time).run()
+
+
+def _position(leg, at):
+    """Position on the leg at the moment, linear in time."""
+    origin, target = leg.origin, leg.target
+    if leg.end <= leg.start or origin == target:
+        return target
+    s = (at - leg.start) / (leg.end - leg.start)
+    return (origin[0] + (target[0] - origin[0]) * s, origin[1] + (target[1] - origin[1]) * s,
+            origin[2] + (target[2] - origin[2]) * s)
+
+
+def _difference(p1, p2):
+    return p1[0] - p2[0], p1[1] - p2[1], p1[2] - p2[2]
+
+
+def _dot(v1, v2):
+    return v1[0] * v2[0] + v1[1] * v2[1] + v1[2] * v2[2]
+
+
+def _length(p1, p2):
+    return math.sqrt(_dot(_difference(p1, p2), _difference(p1, p2)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_model_arguments(parser)
+    parser.add_argument("--separation", default=3.0, type=float, help="Distance in meters drones should keep")
+    parser.add_argument("--slice", dest="slice_time", type=float, help="Seconds of a slice of the sweep")
+    parser.add_argument("--max-conflicts", default=50, type=int, help="Number of conflicts printed per file at most")
+    parser.add_argument("--output", help="Write the conflicts to the JSON file, keyed by path")
+    args = parser.parse_args()
+
+    model = model_from_args(args)
+    status = 0
+    results = {}
+    for file_path in task_file_paths(args.path):
+        issues, sweep = check_task(load_task(file_path, args.gcj), model, args.separation, args.slice_time)
+        errors = sum(1 for issue in issues if issue["level"] == ERROR)
+        conflicts = sorted(sweep.conflicts.values(), key=lambda conflict: (conflict.start, conflict.cids))
+        print("%s: %d drones, %d legs swept in %.2fs, %d conflicts" % (
+            file_path, sweep.stats["drones"], sweep.stats["legs"], sweep.stats["time"], len(conflicts)))
+        if errors:
+            print("  %d errors in the task, see task_validator.py, the trajectories may be wrong" % errors)
+        if sweep.closest is not None and sweep.closest[0] < args.separation:
+            distance, cids, steps, at = sweep.closest
+            print("  Minimum separation %.2fm between CID %d (step %d) and CID %d (step %d) at %.1fs" % (
+                distance, cids[0], steps[0], cids[1], steps[1], at))
+        else:
+            print("  No drones within %gm of each other" % args.separation)
+        for conflict in conflicts[:args.max_conflicts]:
+            print("  CID %d step %d and CID %d step %d: %.1fs to %.1fs, %.2fm at %.1fs" % (
+                conflict.cids[0], conflict.steps[0], conflict.cids[1], conflict.steps[1], conflict.start,
+                conflict.end, conflict.distance, conflict.at))
+        if len(conflicts) > args.max_conflicts:
+            print("  ... %d more" % (len(conflicts) - args.max_conflicts))
+        if conflicts:
+            status = 1
+        results[file_path] = {
+            "closest": None if sweep.closest is None else {
+                "distance": sweep.closest[0], "CID": list(sweep.closest[1]), "Step": list(sweep.closest[2]),
+                "at": sweep.closest[3]},
+            "conflicts": [conflict.to_dict() for conflict in conflicts],
+            "stats": sweep.stats
+        }
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, sort_keys=True, indent=4)
+    sys.exit(status)
@@ -0,0 +1,534 @@
+# -*- coding: utf-8 -*-
+
+"""
+Headless Monitor
+~~~~~~~~~~~~~~~~
+
+This script is a monitor without GUI speaking the same MAVC protocol as the Electron one, so that a fleet can be
+tested automatically and the protocol can be measured with hundreds of drones. It needs Python 3.5 or later.
+
+It hands out CIDs through UDP on the base port (real drones) or on the base port + index (simulators), receives
+MAVC_STAT on the UDP port and MAVC_ARRIVED on the TCP port 4396 + CID of every drone, and once the expected number
+of drones have connected it splits the task into subtasks and sends them one after another, waiting at the barrier
+of every synchronous subtask for all of its drones to arrive. Everything runs on one asyncio event loop.
+
+The statistics (handshakes, reports and the time spent at every barrier) are printed in JSON when the task is done.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import sys
+import time
+from os.path import abspath, dirname, join
+
+sys.path.append(join(dirname(abspath(__file__)), "..", "Pi"))
+from Modules import subtask
+from Modules.clock import LatencyHistogram
+from Modules.codec import CODEC_JSON, MAVC_ARRIVED, MAVC_DELAY_RESPONSE, MAVC_DELAY_TEST, MAVC_STAT, choose_codec, \
+    decode_msg, encode_msg, encode_stream_msg
+from Modules.framing import FrameDecoder
+
+MAVC_REQ_CID = 0
+MAVC_CID = 1
+MAVC_SET_GEOFENCE = 3
+MAVC_FAILED = 10
+ACTION_GO_TO = 1
+
+
+class BarrierTimeout(Exception):
+    """Drones of a synchronous subtask have not arrived in time."""
+
+
+class SubtaskFailed(Exception):
+    """A drone has failed the actions of a subtask, e.g. stalled on the way."""
+
+
+class StreamSplitter(object):
+    """Split the TCP stream from a drone into MAVC messages.
+
+    Drones write binary messages length-prefixed and JSON messages followed by '$$', the frames are split out as the
+    drones do it with FrameDecoder. Only complete frames are decoded, and one which can not be decoded is skipped.
+    """
+
+    def __init__(self):
+        self.__decoder = FrameDecoder()
+
+    def feed(self, data):
+        """Append the data received and split out every complete message.
+
+        Returns:
+            List of MAVC messages.
+
+        Raises:
+            ValueError: A frame longer than 16MB is on the way.
+        """
+        self.__decoder.feed(data)
+        messages = []
+        for payload in self.__decoder.frames():
+            try:
+                messages.append(decode_msg(payload))
+            except ValueError:
+                continue        # Malformed, the frames after it are still good
+        return messages
+
+
+class DroneState(object):
+    """What the monitor knows about one drone."""
+
+    def __init__(self, cid):
+        self.cid = cid
+        self.addr = None            # Address the CID was requested from
+        self.codec = CODEC_JSON
+        self.home = None
+        self.status = {}            # Latest MAVC_STAT
+        self.transport = None       # TCP connection
+        self.requested_at = None
+        self.connected_at = None
+        self.stats = 0              # MAVC_STAT received
+        self.arrivals = 0           # MAVC_ARRIVED received
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, monitor, offset):
+        self.monitor = monitor
+        self.offset = offset
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.monitor.datagram_received(self, data, addr)
+
+
+class _StreamProtocol(asyncio.Protocol):
+    def __init__(self, monitor, cid):
+        self.monitor = monitor
+        self.cid = cid
+        self.splitter = StreamSplitter()
+
+    def connection_made(self, transport):
+        self.monitor.drone_connected(self.cid, transport)
+
+    def data_received(self, data):
+        self.monitor.stats["bytes_in"] += len(data)
+        try:
+            messages = self.splitter.feed(data)
+        except (ValueError, KeyError, IndexError, TypeError):
+            return
+        for msg in messages:
+            self.monitor.stream_received(self.cid, msg)
+
+    def connection_lost(self, exc):
+        self.monitor.drone_lost(self.cid)
+
+
+class Monitor(object):
+    """Monitor of a fleet running on an asyncio event loop."""
+
+    def __init__(self, loop, host, port, drones, codec=None, per_cid=False, hold=False, peers=False,
+                 geofence=None, barrier_timeout=None, verbose=True):
+        """
+        Args:
+            loop: asyncio event loop.
+            host: Address to listen on.
+            port: Base port, usually 4396.
+            drones: Number of drones expected, CIDs from 1 to drones are served.
+            codec: Codec to use whatever the drones offer, None to pick the most preferred one they support.
+            per_cid: Send every drone MAVC_CID_ACTION messages of its own actions instead of MAVC_ACTION.
+            hold: Send the subtasks ahead of time to be held, and MAVC_RELEASE once a barrier is passed.
+            peers: Drones pass the barriers among themselves, send the subtasks held ahead and never release them.
+            geofence: Body of MAVC_SET_GEOFENCE sent to every drone once connected.
+            barrier_timeout: Seconds to wait at a barrier before giving up the task, None to wait forever.
+            verbose: Whether to print the progress.
+        """
+        self.loop = loop
+        self.host = host
+        self.port = port
+        self.codec = codec
+        self.per_cid = per_cid or hold or peers
+        self.hold = hold or peers
+        self.peers = peers
+        self.geofence = geofence
+        self.barrier_timeout = barrier_timeout
+        self.verbose = verbose
+        self.drones = dict((cid, DroneState(cid)) for cid in range(1, drones + 1))
+        self.by_addr = {}           # Address requesting CID on the base port -> CID
+        self.all_connected = asyncio.Event()
+        self.barrier = None         # Barrier waited for
+        self.barriers = []
+        self.failure = None         # SubtaskFailed of the first MAVC_FAILED received
+        self.started_at = {}        # Step -> when its subtask was sent, or released if held
+        self.stat_age = LatencyHistogram()      # Milliseconds from a state captured to its MAVC_STAT received
+        self.arrival_age = LatencyHistogram()   # Milliseconds from an arrival to its MAVC_ARRIVED received
+        self.servers = []
+        self.started = time.time()
+        self.stats = {
+            "handshakes": 0,        # MAVC_CID sent
+            "connected": 0,         # Drones connected through TCP
+            "lost": 0,              # TCP connections closed
+            "stats_in": 0,          # MAVC_STAT received
+            "arrivals_in": 0,       # MAVC_ARRIVED received
+            "stray_arrivals": 0,    # MAVC_ARRIVED not of the barrier waited for
+            "failures_in": 0,       # MAVC_FAILED received
+            "bytes_in": 0,
+            "messages_out": 0,
+            "bytes_out": 0,
+            "connect_time": None,   # Seconds from start until every drone has connected
+            "task_time": None       # Seconds taken by the task
+        }
+
+    async def start(self):
+        """Listen on the base port and on the ports of every CID."""
+        transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: _DatagramProtocol(self, 0), local_addr=(self.host, self.port))
+        self.servers.append(transport)
+        for cid in self.drones:
+            transport, _ = await self.loop.create_datagram_endpoint(
+                lambda cid=cid: _DatagramProtocol(self, cid), local_addr=(self.host, self.port + cid))
+            self.servers.append(transport)
+            server = await self.loop.create_server(
+                lambda cid=cid: _StreamProtocol(self, cid), self.host, self.port + cid)
+            self.servers.append(server)
+        self.__log("Listening on %s:%d-%d for %d drones" % (self.host, self.port, self.port + len(self.drones),
+                                                            len(self.drones)))
+
+    def close(self):
+        for drone in self.drones.values():
+            if drone.transport is not None:
+                drone.transport.close()
+        for server in self.servers:
+            server.close()
+
+    def datagram_received(self, protocol, data, addr):
+        try:
+            msg = decode_msg(data)
+            header = msg[0]
+        except (ValueError, KeyError, IndexError, TypeError):
+            return
+        if header.get("Header") != "MAVCluster_Drone":
+            return
+        if header["Type"] == MAVC_REQ_CID:
+            self.__answer_cid(protocol, msg, addr)
+        elif header["Type"] == MAVC_STAT and protocol.offset in self.drones:
+            drone = self.drones[protocol.offset]
+            drone.status = msg[1]
+            drone.stats += 1
+            self.stats["stats_in"] += 1
+            if "Time" in msg[1]:
+                self.stat_age.add(time.time() * 1.0e3 - msg[1]["Time"])
+
+    def __answer_cid(self, protocol, msg, addr):
+        if protocol.offset == 0:
+            # Real drones all ask on the base port, the same address gets the same CID again
+            cid = self.by_addr.get(addr)
+            if cid is None:
+                free = [cid for cid, drone in sorted(self.drones.items()) if drone.addr is None]
+                if not free:
+                    return
+                cid = self.by_addr[addr] = free[0]
+        else:
+            cid = protocol.offset
+        drone = self.drones[cid]
+        if drone.addr is None:
+            drone.requested_at = time.time()
+        drone.addr = addr
+        drone.home = (msg[1].get("Lat"), msg[1].get("Lon"))
+        drone.codec = self.codec or choose_codec(msg[1].get("Codec"))
+        body = {"CID": cid, "Clock": True}      # MAVC_DELAY_TEST of drones is answered
+        if drone.codec != CODEC_JSON:
+            body["Codec"] = drone.codec
+        protocol.transport.sendto(encode_msg([{"Header": "MAVCluster_Monitor", "Type": MAVC_CID}, body]), addr)
+        self.stats["handshakes"] += 1
+
+    def drone_connected(self, cid, transport):
+        drone = self.drones[cid]
+        if drone.transport is not None:
+            drone.transport.close()
+        drone.transport = transport
+        drone.connected_at = time.time()
+        self.stats["connected"] += 1
+        if self.geofence is not None:
+            self.__write(drone, [{"Header": "MAVCluster_Monitor", "Type": MAVC_SET_GEOFENCE}, self.geofence])
+        if all(drone.transport is not None for drone in self.drones.values()):
+            if not self.all_connected.is_set():
+                self.stats["connect_time"] = time.time() - self.started
+            self.all_connected.set()
+
+    def drone_lost(self, cid):
+        self.stats["lost"] += 1
+        self.drones[cid].transport = None
+
+    def stream_received(self, cid, msg):
+        try:
+            if msg[0]["Header"] != "MAVCluster_Drone":
+                return
+            if msg[0]["Type"] == MAVC_DELAY_TEST:
+                # Answered at once with the time of receiving, the drone estimates the offset of its clock
+                self.__write(self.drones[cid], [{"Header": "MAVCluster_Monitor", "Type": MAVC_DELAY_RESPONSE},
+                                                {"CID": cid, "Send_time": msg[1]["Send_time"],
+                                                 "Get_time": time.time() * 1.0e3}])
+                return
+            if msg[0]["Type"] == MAVC_FAILED:
+                self.__fail(msg[1]["CID"], msg[1]["Step"], msg[1].get("Result"))
+                return
+            if msg[0]["Type"] != MAVC_ARRIVED:
+                return
+            arrived_cid, step = msg[1]["CID"], msg[1]["Step"]
+        except (KeyError, IndexError, TypeError):
+            return
+        if "Time" in msg[1]:
+            self.arrival_age.add(time.time() * 1.0e3 - msg[1]["Time"])
+        self.stats["arrivals_in"] += 1
+        self.drones[cid].arrivals += 1
+        barrier = self.barrier
+        if barrier is None or barrier["steps"].get(arrived_cid) != step or arrived_cid in barrier["arrived"]:
+            self.stats["stray_arrivals"] += 1
+            return
+        now = time.time()
+        barrier["arrived"].add(arrived_cid)
+        if barrier["first"] is None:
+            barrier["first"] = now
+        if barrier["arrived"] == barrier["expected"]:
+            barrier["last"] = now
+            if not barrier["passed"].done():
+                barrier["passed"].set_result(now)
+
+    def __fail(self, cid, step, result):
+        """Stop the task once a drone has failed a subtask, the barrier waited for is never passed."""
+        self.stats["failures_in"] += 1
+        self.__log("Drone %d has failed step %d: %s" % (cid, step, result))
+        if self.failure is None:
+            self.failure = SubtaskFailed("Drone %d has failed step %d: %s" % (cid, step, result))
+        barrier = self.barrier
+        if barrier is not None and not barrier["passed"].done():
+            barrier["passed"].set_exception(self.failure)
+
+    async def run_task(self, actions):
+        """Send the subtasks of the task one after another, waiting at the barrier of each synchronous one.
+
+        Raises:
+            BarrierTimeout: Drones of a barrier have not arrived within barrier_timeout.
+            SubtaskFailed: A drone has failed a subtask, no more subtasks are sent or released.
+        """
+        subtasks = subtask.split_task(actions)
+        started = time.time()
+        self.__log("Task of %d actions in %d subtasks" % (len(actions), len(subtasks)))
+        if self.hold and subtasks:
+            # Every subtask but the first one is held by the drones until released
+            first_sent = time.time()
+            self.__send_subtask(subtasks[0], hold=False)
+            for actions_of_subtask in subtasks[1:]:
+                self.__send_subtask(actions_of_subtask, hold=True)
+
+        for n, actions_of_subtask in enumerate(subtasks):
+            if self.failure is not None:
+                raise self.failure
+            # Every drone reports its own step, the one of its last action in the subtask
+            steps = subtask.subtask_steps(actions_of_subtask)
+            sent = first_sent if self.hold and n == 0 else time.time()
+            releases = {}       # Step -> drones to release
+            for cid, (step, _) in steps.items():
+                self.started_at[step] = sent
+                releases.setdefault(step, set()).add(cid)
+            if not self.hold:
+                self.__send_subtask(actions_of_subtask)
+            elif n > 0 and not self.peers:
+                for step, cids in sorted(releases.items()):
+                    self.__broadcast(subtask.pack_release(step), cids)
+            if n > 0 and self.barriers and not self.peers:
+                self.barriers[-1]["dispatch"] = sent - self.barriers[-1]["last"]
+            expected = dict((cid, step) for cid, (step, sync) in steps.items() if sync)
+            if not expected:
+                continue
+            await self.__wait_barrier(expected, sent)
+
+        self.barrier = None
+        self.stats["task_time"] = time.time() - started
+
+    async def __wait_barrier(self, steps, sent):
+        """Wait for every drone to arrive at its step, given by the dictionary of CID and step."""
+        steps = dict((cid, step) for cid, step in steps.items() if cid in self.drones)
+        expected = set(steps)
+        step = max(steps.values()) if steps else None  # Step of the barrier in records
+        barrier = self.barrier = {"steps": steps, "expected": expected, "arrived": set(), "first": None,
+                                  "last": None, "passed": self.loop.create_future()}
+        if not expected:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(barrier["passed"]), self.barrier_timeout)
+        except asyncio.TimeoutError:
+            missing = sorted(expected - barrier["arrived"])
+            raise BarrierTimeout("Drones %s have not arrived at step %d" % (missing, step))
+        self.barriers.append({
+            "step": step,
+            "drones": len(expected),
+            "wait": barrier["last"] - sent,             # From the subtask sent to the last drone arrived
+            "spread": barrier["last"] - barrier["first"],   # From the first drone arrived to the last one
+            "last": barrier["last"],
+            "dispatch": None                            # From the last drone arrived to the next subtask sent
+        })
+        self.__log("All %d drones arrived at step %d" % (len(expected), step))
+
+    def __send_subtask(self, actions, hold=False):
+        if self.per_cid:
+            for cid, msg in subtask.pack_cid_subtasks(actions, hold).items():
+                if cid in self.drones:
+                    self.__write(self.drones[cid], msg)
+        else:
+            self.__broadcast(subtask.pack_subtask(actions), set(action["CID"] for action in actions))
+
+    def __broadcast(self, msg, cids):
+        """Send the message to the drones, encoded once per codec."""
+        encoded = {}
+        for cid in sorted(cids):
+            drone = self.drones.get(cid)
+            if drone is None or drone.transport is None:
+                continue
+            if drone.codec not in encoded:
+                encoded[drone.codec] = encode_stream_msg(msg, drone.codec)
+            drone.transport.write(encoded[drone.codec])
+            self.stats["messages_out"] += 1
+            self.stats["bytes_out"] += len(encoded[drone.codec])
+
+    def __write(self, drone, msg):
+        self.__broadcast(msg, [drone.cid])
+
+    def __log(self, text):
+        if self.verbose:
+            print(text)
+
+    def get_stats(self):
+        """Statistics of the monitor, every barrier and every drone."""
+        waits = [barrier["wait"] for barrier in self.barriers]
+        spreads = [barrier["spread"] for barrier in self.barriers]
+        handshakes = [drone.connected_at - drone.requested_at for drone in self.drones.values()
+                      if drone.connected_at is not None and drone.requested_at is not None]
+        return {
+            "monitor": dict(self.stats, barriers=len(self.barriers),
+                            wait_mean=_mean(waits), spread_mean=_mean(spreads),
+                            spread_max=max(spreads) if spreads else None,
+                            handshake_mean=_mean(handshakes), handshake_max=max(handshakes) if handshakes else None),
+            "stat_age": self.stat_age.get_stats(),
+            "arrival_age": self.arrival_age.get_stats(),
+            "barriers": [dict((key, value) for key, value in barrier.items() if key != "last")
+                         for barrier in self.barriers],
+            "drones": dict((cid, {"codec": drone.codec, "stats": drone.stats, "arrivals": drone.arrivals,
+                                  "status": drone.status}) for cid, drone in self.drones.items())
+        }
+
+
+def gcj_to_wgs(lat, lon):
+    """Coordinates of WGS-84 from those of GCJ-02, as transform.gcj2wgs() of the Electron monitor does."""
+    if lon < 72.004 or lon > 137.8347 or lat < 0.8293 or lat > 55.8271:
+        return lat, lon
+    x, y = lon - 105.0, lat - 35.0
+    d = 20.0 * math.sin(6.0 * x * math.pi) + 20.0 * math.sin(2.0 * x * math.pi)
+    d_lat = d + 20.0 * math.sin(y * math.pi) + 40.0 * math.sin(y * math.pi / 3.0) + \
+        160.0 * math.sin(y * math.pi / 12.0) + 320 * math.sin(y * math.pi / 30.0)
+    d_lon = d + 20.0 * math.sin(x * math.pi) + 40.0 * math.sin(x * math.pi / 3.0) + \
+        150.0 * math.sin(x * math.pi / 12.0) + 300.0 * math.sin(x * math.pi / 30.0)
+    d_lat = d_lat * 2.0 / 3.0 - 100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y + 0.1 * x * y + 0.2 * math.sqrt(abs(x))
+    d_lon = d_lon * 2.0 / 3.0 + 300.0 + x + 2.0 * y + 0.1 * x * x + 0.1 * x * y + 0.1 * math.sqrt(abs(x))
+    ee = 0.00669342162296594323
+    rad_lat = lat / 180.0 * math.pi
+    magic = 1 - ee * math.sin(rad_lat) ** 2
+    d_lat = (d_lat * 180.0) / ((6378137.0 * (1 - ee)) / (magic * math.sqrt(magic)) * math.pi)
+    d_lon = (d_lon * 180.0) / (6378137.0 / math.sqrt(magic) * math.cos(rad_lat) * math.pi)
+    return lat - d_lat, lon - d_lon
+
+
+def _mean(values):
+    return sum(values) / len(values) if values else None
+
+
+async def _print_stats(monitor, interval):
+    while True:
+        await asyncio.sleep(interval)
+        print(json.dumps(monitor.get_stats()["monitor"], sort_keys=True))
+
+
+async def main(loop, args, actions, geofence):
+    monitor = Monitor(loop, args.host, args.port, args.drones, codec=args.codec, per_cid=args.messages,
+                      hold=args.hold, peers=args.peers, geofence=geofence, barrier_timeout=args.barrier_timeout)
+    await monitor.start()
+    reporter = asyncio.ensure_future(_print_stats(monitor, args.stats)) if args.stats else None
+    status = 0
+    try:
+        try:
+            await asyncio.wait_for(monitor.all_connected.wait(), args.connect_timeout)
+        except asyncio.TimeoutError:
+            missing = [cid for cid, drone in sorted(monitor.drones.items()) if drone.transport is None]
+            print("Drones %s have not connected in %.0fs" % (missing, args.connect_timeout))
+            return 1
+        print("All %d drones connected in %.2fs" % (args.drones, monitor.stats["connect_time"]))
+
+        if actions is not None:
+            try:
+                await monitor.run_task(actions)
+                print("Task done in %.2fs" % monitor.stats["task_time"])
+            except (BarrierTimeout, SubtaskFailed) as e:
+                print(e)
+                status = 1
+            await asyncio.sleep(args.linger)
+        else:
+            # Serve the drones till interrupted
+            await loop.create_future()
+    finally:
+        if reporter is not None:
+            reporter.cancel()
+        stats = monitor.get_stats()
+        if args.output:
+            with open(args.output, "w") as output_file:
+                json.dump(stats, output_file, sort_keys=True, indent=4)
+        print(json.dumps(stats["monitor"], sort_keys=True))
+        monitor.close()
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("task", nargs="?", help="Path of the task file, serve the drones without a task if absent")
+    parser.add_argument("--drones", default=1, type=int, help="Number of drones expected, CID 1 to DRONES")
+    parser.add_argument("--host", default="0.0.0.0", help="Address to listen on")
+    parser.add_argument("--port", default=4396, type=int, help="Base port, the drone of CID n uses PORT + n")
+    parser.add_argument("--codec", choices=["json", "binary"], help="Codec to use instead of the one drones prefer")
+    parser.add_argument("--messages", action="store_true", help="Send each drone MAVC_CID_ACTION messages of its "
+                                                                "own actions instead of MAVC_ACTION")
+    parser.add_argument("--hold", action="store_true", help="Send the subtasks ahead to be held, and MAVC_RELEASE "
+                                                            "at each barrier, implies --messages")
+    parser.add_argument("--peers", action="store_true", help="Drones run the barriers among themselves, send the "
+                                                             "subtasks held ahead only, implies --hold")
+    parser.add_argument("--gcj", action="store_true", help="Coordinates of GO_TO in the task are of GCJ-02, as "
+                                                           "drawn on the map of the Electron monitor")
+    parser.add_argument("--geofence", help="JSON file of the body of MAVC_SET_GEOFENCE sent to every drone")
+    parser.add_argument("--connect-timeout", default=120.0, type=float, help="Seconds to wait for every drone "
+                                                                             "to connect")
+    parser.add_argument("--barrier-timeout", type=float, help="Seconds to wait at a barrier before giving up")
+    parser.add_argument("--linger", default=0.0, type=float, help="Seconds to keep serving after the task is done")
+    parser.add_argument("--stats", type=float, help="Print statistics every STATS seconds")
+    parser.add_argument("--output", help="Write the statistics to the JSON file when done")
+    args = parser.parse_args()
+
+    actions = None
+    if args.task:
+        with open(args.task, "r") as task_file:
+            actions = json.loads(task_file.read())
+        if args.gcj:
+            for action in actions:
+                if action["Action_type"] == ACTION_GO_TO:
+                    action["Lat"], action["Lon"] = gcj_to_wgs(action["Lat"], action["Lon"])
+    geofence = None
+    if args.geofence:
+        with open(args.geofence, "r") as geofence_file:
+            geofence = json.loads(geofence_file.read())
+
+    loop = asyncio.get_event_loop()
+    try:
+        sys.exit(loop.run_until_complete(main(loop, args, actions, geofence)))
+    except KeyboardInterrupt:
+        print("Completed")
+    finally:
+        loop.close()
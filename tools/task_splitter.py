@@ -6,12 +6,20 @@ Task Splitter
 
 This script picks each drone's actions out from a task file, and then integrates them into one single file at the
 same directory with the task file. Those output files are distinguished by CID wrote in file names.
+
+With --messages it writes the MAVC_CID_ACTION messages to be sent to each drone instead, one per subtask, so that a
+monitor can send every drone only its own actions. With --hold as well, the messages are marked to be held by drones
+until the monitor sends MAVC_RELEASE of their steps, so they can be sent ahead of time.
 """
 
 import argparse
 import json
+import sys
 from os import listdir
-from os.path import isfile, join
+from os.path import abspath, dirname, isfile, join
+
+sys.path.append(join(dirname(abspath(__file__)), '..', 'Pi'))
+from Modules import subtask
 
 
 def split_task(file_path, runnable):
@@ -34,21 +42,42 @@ def split_task(file_path, runnable):
             single_task_file.write(json.dumps(actions, sort_keys=True, indent=4))
 
 
+def split_messages(file_path, hold=False):
+    with open(file_path, 'r') as task_file:
+        actions = json.loads(task_file.read())
+
+    each_drones_messages = {}
+    for actions_of_subtask in subtask.split_task(actions):
+        for cid, message in subtask.pack_cid_subtasks(actions_of_subtask, hold).items():
+            each_drones_messages.setdefault(cid, []).append(message)
+
+    prefix = file_path[:-5]
+    for cid, messages in each_drones_messages.items():
+        output_file_path = prefix + "[CID={cid}].messages.json".format(cid=cid)
+        with open(output_file_path, "w+") as messages_file:
+            messages_file.write(json.dumps(messages, sort_keys=True, indent=4))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("path", help="Path of the task file")
     parser.add_argument("--to-run", dest="runnable", action="store_true")
     parser.add_argument("--not-to-run", dest="runnable", action="store_false")
+    parser.add_argument("--messages", action="store_true", help="Write MAVC_CID_ACTION messages of each subtask")
+    parser.add_argument("--hold", action="store_true", help="Mark the messages to be held until released")
     parser.set_defaults(runnable=False)
     args = parser.parse_args()
 
     path = args.path
     runnable = args.runnable
     if path.endswith(".json"):
-        split_task(path, runnable)
+        task_file_paths = [path]
     else:
         task_file_paths = [join(path, file_name) for file_name in listdir(path) if isfile(join(path, file_name)) and
                         file_name.endswith(".json")]
-        for file_path in task_file_paths:
+    for file_path in task_file_paths:
+        if args.messages:
+            split_messages(file_path, args.hold)
+        else:
             split_task(file_path, runnable)
 
@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+
+"""
+Task Validator
+~~~~~~~~~~~~~~
+
+This script checks task files on the ground, before a broken one leaves drones waiting at a barrier in the air, and
+estimates how long each drone flies and how much energy it takes. It needs Python 3.5 or later.
+
+The actions are indexed by CID in one pass over the file, checking on the way:
+
+* the keys required by the type of every action, and their types;
+* arm_and_takeoff first and land last for every drone, each of them once;
+* steps strictly increasing in the order of the file for every drone;
+* the same number of synchronization actions for every drone, otherwise some of them wait forever.
+
+The flight is then replayed on a simple model: legs are flown straight at --speed, climbing and descending at
+--climb-speed, landing at --land-speed, and every subtask starts once every drone has arrived at the barrier of the
+previous one, as the monitor sends them. A timed action which can not start at its Time because the previous actions
+of the subtask take longer at that speed is reported. The flight time of a drone lasts from its takeoff to the end of
+its landing, waiting at barriers included, and its energy is that of hovering all along plus lifting the drone.
+
+The homes of the drones are placed as the simulators of pi.py are, --spacing degrees of longitude apart from CID 1
+at --lat and --lon. The exit status is 1 if any error is found.
+"""
+
+import argparse
+import json
+import math
+import sys
+from collections import Counter, namedtuple
+from os import listdir
+from os.path import abspath, dirname, isfile, join
+
+sys.path.append(join(dirname(abspath(__file__)), "..", "Pi"))
+from Modules.path_follow import LocalFrame
+from monitor import gcj_to_wgs
+
+ACTION_ARM_AND_TAKEOFF = 0
+ACTION_GO_TO = 1
+ACTION_GO_BY = 2
+ACTION_LAND = 3
+
+ACTION_NAMES = {
+    ACTION_ARM_AND_TAKEOFF: "arm_and_takeoff",
+    ACTION_GO_TO: "go_to",
+    ACTION_GO_BY: "go_by",
+    ACTION_LAND: "land"
+}
+
+REQUIRED_KEYS = {       # Keys read by the drone for each type of action, besides Action_type, CID, Step and Sync
+    ACTION_ARM_AND_TAKEOFF: ("Alt",),
+    ACTION_GO_TO: ("Lat", "Lon", "Alt"),
+    ACTION_GO_BY: ("N", "E"),
+    ACTION_LAND: ("Lat", "Lon")
+}
+NUMBER_KEYS = ("Alt", "Lat", "Lon", "N", "E", "Time")
+_NUMBER_TYPES = (int, float)    # Types of numbers parsed from JSON, bool excluded
+
+ERROR = "error"
+WARNING = "warning"
+
+GRAVITY = 9.80665
+
+Leg = namedtuple("Leg", "start end origin target step kind")    # Positions are (north, east, up) in meters
+
+
+class FlightModel(object):
+    """How drones are assumed to fly when a task is replayed."""
+
+    def __init__(self, speed=4.0, climb_speed=2.5, land_speed=1.0, hover_power=200.0, mass=1.5, lat=31.8871046,
+                 lon=118.8134928, spacing=5e-5, tolerance=0.5):
+        """
+        Args:
+            speed: Horizontal speed in m/s, --speed of pi.py.
+            climb_speed: Vertical speed in m/s of takeoff and legs.
+            land_speed: Descent speed in m/s of landing.
+            hover_power: Electrical power in watts drawn all along the flight.
+            mass: Mass of a drone in kilograms, lifted on every climb.
+            lat: Latitude of the home of CID 1, also the origin of the local frame.
+            lon: Longitude of the home of CID 1.
+            spacing: Degrees of longitude between the homes of consecutive CIDs.
+            tolerance: Seconds a timed action may start late before it is reported.
+        """
+        self.speed = speed
+        self.climb_speed = climb_speed
+        self.land_speed = land_speed
+        self.hover_power = hover_power
+        self.mass = mass
+        self.lat = lat
+        self.lon = lon
+        self.spacing = spacing
+        self.tolerance = tolerance
+        self.__frame = LocalFrame(lat, lon)
+
+    def home(self, cid):
+        """Position of the home of the drone in the local frame."""
+        return self.position(self.lat, self.lon + self.spacing * (cid - 1), 0.0)
+
+    def position(self, lat, lon, alt):
+        """North, east and up in meters of the coordinates."""
+        north, east, down = self.__frame.to_local({"lat": lat, "lon": lon, "alt": alt})
+        return north, east, -down
+
+
+class Flight(object):
+    """Replay of the actions of one drone."""
+
+    def __init__(self, cid, home):
+        self.cid = cid
+        self.position = home
+        self.time = 0.0         # Seconds since the task was started when the last action is done
+        self.airborne = False
+        self.takeoff = None     # When the takeoff was started
+        self.landed = None      # When the landing was done
+        self.legs = []          # Leg of every movement and every wait in the air, in order
+        self.distance = 0.0     # Meters flown, in 3D
+        self.climb = 0.0        # Meters climbed
+        self.late = 0           # Timed actions started late
+
+    def fly(self, target, duration, step, kind):
+        """Move to the target in duration seconds."""
+        end = self.time + duration
+        self.legs.append(Leg(self.time, end, self.position, target, step, kind))
+        self.distance += _distance(self.position, target)
+        self.climb += max(0.0, target[2] - self.position[2])
+        self.position = target
+        self.time = end
+
+    def hover(self, until, step=None):
+        """Stay where the drone is till the moment, on the ground if it is not airborne.
+
+        Args:
+            until: Seconds since the task was started.
+            step: Step waited for, that of the last leg by default as the drone waits at its barrier.
+        """
+        if until <= self.time:
+            return
+        if self.airborne:
+            if step is None:
+                step = self.legs[-1].step
+            self.legs.append(Leg(self.time, until, self.position, self.position, step, "hover"))
+        self.time = until
+
+    def flight_time(self):
+        if self.takeoff is None:
+            return 0.0
+        return (self.landed if self.landed is not None else self.time) - self.takeoff
+
+
+def index_task(actions, issues):
+    """Actions of every drone in the order of the file, checking every action on the way.
+
+    Args:
+        actions: Actions of the task file.
+        issues: List the problems found are appended to.
+
+    Returns:
+        Dictionary of CID and the list of its actions, those which can not be replayed are left out.
+    """
+    drones = {}
+    last_steps = {}         # CID -> last step
+    landed = set()
+    syncs = {}              # CID -> number of synchronization actions
+    for index, action in enumerate(actions):
+        if not isinstance(action, dict):
+            _report(issues, ERROR, None, None, "action #%d is not an object" % index)
+            continue
+        cid, step, action_type = action.get("CID"), action.get("Step"), action.get("Action_type")
+        if not _is_integer(cid) or not _is_integer(step):
+            _report(issues, ERROR, cid, step, "action #%d has no integer CID or Step" % index)
+            continue
+        if action.get("Sync"):
+            # Counted as subtask.split_task() cuts the actions, even if the action itself is broken
+            syncs[cid] = syncs.get(cid, 0) + 1
+        if action_type not in REQUIRED_KEYS:
+            _report(issues, ERROR, cid, step, "unknown Action_type %r" % (action_type,))
+            continue
+        if not isinstance(action.get("Sync"), bool):
+            _report(issues, ERROR, cid, step, "Sync should be true or false")
+        missing = [key for key in REQUIRED_KEYS[action_type] if key not in action]
+        if missing:
+            _report(issues, ERROR, cid, step, "%s misses %s" % (ACTION_NAMES[action_type], ", ".join(missing)))
+            continue
+        wrong = [key for key in NUMBER_KEYS if key in action and not _is_number(action[key])]
+        if wrong:
+            _report(issues, ERROR, cid, step, "%s should be numbers" % ", ".join(wrong))
+            continue
+        if action.get("Time", 0) < 0:
+            _report(issues, ERROR, cid, step, "Time should not be negative")
+
+        drone_actions = drones.setdefault(cid, [])
+        if not drone_actions and action_type != ACTION_ARM_AND_TAKEOFF:
+            _report(issues, ERROR, cid, step, "the first action is %s instead of arm_and_takeoff"
+                    % ACTION_NAMES[action_type])
+        elif drone_actions and action_type == ACTION_ARM_AND_TAKEOFF:
+            _report(issues, ERROR, cid, step, "arm_and_takeoff is not the first action")
+        if cid in landed:
+            _report(issues, ERROR, cid, step, "%s after land" % ACTION_NAMES[action_type])
+        if cid in last_steps and step <= last_steps[cid]:
+            _report(issues, ERROR, cid, step, "step is not greater than the previous one %d" % last_steps[cid])
+        if action_type == ACTION_LAND:
+            landed.add(cid)
+        last_steps[cid] = step
+        drone_actions.append(action)
+
+    for cid in sorted(drones):
+        if cid not in landed:
+            _report(issues, ERROR, cid, last_steps[cid], "the last action is %s instead of land"
+                    % ACTION_NAMES[drones[cid][-1]["Action_type"]])
+
+    for cid in drones:
+        syncs.setdefault(cid, 0)
+    if len(set(syncs.values())) > 1:
+        expected = Counter(syncs.values()).most_common(1)[0][0]
+        for cid in sorted(syncs):
+            if syncs[cid] != expected:
+                _report(issues, ERROR, cid, None, "%d synchronization actions while %d drones have %d, the drones "
+                        "would wait at a barrier forever" % (syncs[cid], list(syncs.values()).count(expected),
+                                                             expected))
+    return drones
+
+
+def replay_task(drones, model, issues):
+    """Replay the actions of every drone on the model.
+
+    Every drone's actions are cut after each of its synchronization actions as subtask.split_task() does, the n-th
+    pieces of every drone are started together once the pieces before them ending with a synchronization action are
+    all done. An action is started when the previous one is done, or at its Time after the start of its subtask if
+    that is later.
+
+    Args:
+        drones: Actions of every drone, from index_task().
+        model: FlightModel.
+        issues: List the problems found are appended to.
+
+    Returns:
+        Dictionary of CID and its Flight.
+    """
+    pieces = {}
+    for cid, drone_actions in drones.items():
+        drone_pieces = pieces[cid] = [[]]
+        for action in drone_actions:
+            drone_pieces[-1].append(action)
+            if action.get("Sync"):
+                drone_pieces.append([])
+        if not drone_pieces[-1]:
+            drone_pieces.pop()
+
+    flights = dict((cid, Flight(cid, model.home(cid))) for cid in drones)
+    start = 0.0             # When the current subtask is started
+    for n in range(max(len(drone_pieces) for drone_pieces in pieces.values()) if pieces else 0):
+        barrier = start
+        for cid in sorted(pieces):
+            if n >= len(pieces[cid]):
+                continue
+            flight = flights[cid]
+            piece = pieces[cid][n]
+            flight.hover(start)
+            for action in piece:
+                if action.get("Time", 0) > 0:
+                    at = start + action["Time"]
+                    if flight.time > at + model.tolerance:
+                        flight.late += 1
+                        _report(issues, WARNING, cid, action["Step"], "Time %gs can not be met, the previous actions "
+                                "of the subtask take %.1fs at %g m/s" % (action["Time"], flight.time - start,
+                                                                         model.speed))
+                    flight.hover(at, action["Step"])
+                _perform(flight, action, model)
+            if piece[-1].get("Sync"):
+                barrier = max(barrier, flight.time)
+        start = barrier
+    return flights
+
+
+def _perform(flight, action, model):
+    """Replay one action, the drone lands where it is whatever the coordinates of land as the drone does."""
+    action_type = action["Action_type"]
+    step = action["Step"]
+    north, east, up = flight.position
+    if action_type == ACTION_ARM_AND_TAKEOFF:
+        if flight.takeoff is None:
+            flight.takeoff = flight.time
+        flight.airborne = True
+        target = (north, east, max(up, action["Alt"]))
+        flight.fly(target, (target[2] - up) / model.climb_speed, step, "takeoff")
+    elif action_type == ACTION_LAND:
+        flight.fly((north, east, 0.0), up / model.land_speed, step, "land")
+        flight.airborne = False
+        flight.landed = flight.time
+    else:
+        if action_type == ACTION_GO_TO:
+            target = model.position(action["Lat"], action["Lon"], action["Alt"])
+        else:
+            target = (north + action["N"], east + action["E"], action.get("Alt", up))
+        horizontal = math.hypot(target[0] - north, target[1] - east)
+        flight.fly(target, max(horizontal / model.speed, abs(target[2] - up) / model.climb_speed), step,
+                   ACTION_NAMES[action_type])
+
+
+def estimate(flights, model):
+    """Flight time, distance and energy of every drone and of the whole task.
+
+    Returns:
+        Dictionary with keys 'drones', of CID and its estimate, and 'total'.
+    """
+    drones = {}
+    for cid, flight in flights.items():
+        flight_time = flight.flight_time()
+        energy = model.hover_power * flight_time + model.mass * GRAVITY * flight.climb     # Joules
+        drones[cid] = {
+            "flight_time": flight_time,
+            "distance": flight.distance,
+            "climb": flight.climb,
+            "energy": energy / 3600.0,          # Wh
+            "late": flight.late
+        }
+    return {
+        "drones": drones,
+        "total": {
+            "task_time": max([flight.time for flight in flights.values()] or [0.0]),
+            "flight_time": sum(drone["flight_time"] for drone in drones.values()),
+            "distance": sum(drone["distance"] for drone in drones.values()),
+            "energy": sum(drone["energy"] for drone in drones.values())
+        }
+    }
+
+
+def validate(actions, model, battery=None):
+    """Check a task and estimate its flight.
+
+    Args:
+        actions: Actions of the task file.
+        model: FlightModel.
+        battery: Energy in Wh a drone may use, drones estimated to use more are reported.
+
+    Returns:
+        Tuple of the list of problems found, the flights replayed and the estimate.
+    """
+    issues = []
+    if not isinstance(actions, list):
+        _report(issues, ERROR, None, None, "the task should be a list of actions")
+        return issues, {}, estimate({}, model)
+    flights = replay_task(index_task(actions, issues), model, issues)
+    result = estimate(flights, model)
+    if battery is not None:
+        for cid in sorted(result["drones"]):
+            energy = result["drones"][cid]["energy"]
+            if energy > battery:
+                _report(issues, WARNING, cid, None, "%.1f Wh estimated is more than the battery of %g Wh"
+                        % (energy, battery))
+    return issues, flights, result
+
+
+def load_task(file_path, gcj=False):
+    """Actions of the task file, coordinates of GO_TO converted to WGS-84 if they are of GCJ-02."""
+    with open(file_path, "r") as task_file:
+        actions = json.loads(task_file.read())
+    if gcj and isinstance(actions, list):
+        for action in actions:
+            if isinstance(action, dict) and action.get("Action_type") == ACTION_GO_TO and \
+                    _is_number(action.get("Lat")) and _is_number(action.get("Lon")):
+                action["Lat"], action["Lon"] = gcj_to_wgs(action["Lat"], action["Lon"])
+    return actions
+
+
+def model_from_args(args):
+    """FlightModel of the arguments added by add_model_arguments()."""
+    return FlightModel(speed=args.speed, climb_speed=args.climb_speed, land_speed=args.land_speed,
+                       hover_power=args.hover_power, mass=args.mass, lat=args.lat, lon=args.lon, spacing=args.spacing)
+
+
+def add_model_arguments(parser):
+    """Arguments of the task files and the FlightModel."""
+    parser.add_argument("path", help="Path of the task file, or of a directory of them")
+    parser.add_argument("--speed", default=4.0, type=float, help="Speed of the flight in m/s")
+    parser.add_argument("--climb-speed", default=2.5, type=float, help="Vertical speed in m/s")
+    parser.add_argument("--land-speed", default=1.0, type=float, help="Descent speed of landing in m/s")
+    parser.add_argument("--hover-power", default=200.0, type=float, help="Power in watts drawn by a drone in flight")
+    parser.add_argument("--mass", default=1.5, type=float, help="Mass of a drone in kilograms")
+    parser.add_argument("--lat", default=31.8871046, type=float, help="Latitude of the home of CID 1")
+    parser.add_argument("--lon", default=118.8134928, type=float, help="Longitude of the home of CID 1")
+    parser.add_argument("--spacing", default=5e-5, type=float, help="Degrees of longitude between the homes of "
+                                                                    "consecutive CIDs")
+    parser.add_argument("--gcj", action="store_true", help="Coordinates of GO_TO in the task are of GCJ-02, as "
+                                                           "drawn on the map of the Electron monitor")
+
+
+def task_file_paths(path):
+    """The task file of the path, or the JSON files in the directory of the path."""
+    if isfile(path):
+        return [path]
+    return sorted(join(path, file_name) for file_name in listdir(path)
+                  if isfile(join(path, file_name)) and file_name.lower().endswith(".json"))
+
+
+def _report(issues, level, cid, step, message):
+    issues.append({"level": level, "CID": cid, "Step": step, "message": message})
+
+
+def _format_issue(issue):
+    where = []
+    if issue["CID"] is not None:
+        where.append("CID %s" % issue["CID"])
+    if issue["Step"] is not None:
+        where.append("step %s" % issue["Step"])
+    return "%s%s: %s" % (issue["level"], " (%s)" % ", ".join(where) if where else "", issue["message"])
+
+
+def _is_integer(value):
+    return type(value) is int      # Not bool
+
+
+def _is_number(value):
+    return type(value) in _NUMBER_TYPES
+
+
+def _distance(p1, p2):
+    return math.sqrt(sum((a - b) * (a - b) for a, b in zip(p1, p2)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_model_arguments(parser)
+    parser.add_argument("--battery", type=float, help="Energy in Wh a drone may use")
+    parser.add_argument("--max-issues", default=50, type=int, help="Number of problems printed per file at most")
+    parser.add_argument("--output", help="Write the problems and the estimates to the JSON file, keyed by path")
+    args = parser.parse_args()
+
+    model = model_from_args(args)
+    status = 0
+    results = {}
+    for file_path in task_file_paths(args.path):
+        issues, flights, result = validate(load_task(file_path, args.gcj), model, args.battery)
+        errors = sum(1 for issue in issues if issue["level"] == ERROR)
+        print("%s: %d errors, %d warnings" % (file_path, errors, len(issues) - errors))
+        for issue in issues[:args.max_issues]:
+            print("  " + _format_issue(issue))
+        if len(issues) > args.max_issues:
+            print("  ... %d more" % (len(issues) - args.max_issues))
+        for cid in sorted(result["drones"]):
+            drone = result["drones"][cid]
+            print("  CID %d: %.1fs in flight, %.0fm flown, %.1f Wh" % (cid, drone["flight_time"], drone["distance"],
+                                                                    drone["energy"]))
+        total = result["total"]
+        print("  Task: %.1fs, %.1fs in flight, %.0fm flown, %.1f Wh in total" % (
+            total["task_time"], total["flight_time"], total["distance"], total["energy"]))
+        if errors:
+            status = 1
+        result["issues"] = issues
+        results[file_path] = result
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, sort_keys=True, indent=4)
+    sys.exit(status)